@@ -1,4 +1,6 @@
 #%%
+import os
+import filecmp
 import pretty_midi
 import numpy as np
 import librosa.display
@@ -45,11 +47,9 @@ def midi_to_note(file_name, pitch_shift, fs=100, start_note=40, end_note=95):
     length_audio = frame_note.shape[1]
     notes = np.zeros(length_audio)
 
-    for i in range(length_audio):
-        note_tmp = np.argmax(frame_note[:, i])
-        if note_tmp > 0:
-            notes[i] = (note_tmp + start_note) + pitch_shift
-            # note[i] = 2 ** ((note_tmp -69) / 12.) * 440
+    note_tmp = np.argmax(frame_note, axis=0)
+    voiced = note_tmp > 0
+    notes[voiced] = (note_tmp[voiced] + start_note) + pitch_shift
     return notes
 
 
@@ -75,7 +75,7 @@ def segment_to_midi(segments, path_output, tempo=120):
     """ Convert segment to .mid
     ----------
     Parameters:
-        segments: [start(s),end(s),pitch] (list) 
+        segments: [start(s),end(s),pitch] (list or array)
         path_output: path of save file (str)
     """
     pm = pretty_midi.PrettyMIDI(initial_tempo=int(tempo))
@@ -83,13 +83,59 @@ def segment_to_midi(segments, path_output, tempo=120):
     inst = pretty_midi.Instrument(program=inst_program)
     for segment in segments:
         note = pretty_midi.Note(
-            velocity=100, start=segment[0], end=segment[1], pitch=np.int(segment[2])
+            velocity=100, start=segment[0], end=segment[1], pitch=int(segment[2])
         )
         inst.notes.append(note)
     pm.instruments.append(inst)
     pm.write(f"{path_output}")
 
 
+
+def write_midi_if_changed(segment, midi_path, tempo):
+    """ Write the MIDI file only when its content changed, so the catalog does not see a rebuilt song
+    ----------
+    Parameters:
+        segment: [start(s),end(s),pitch] (list or array)
+        midi_path: path of save file (str)
+
+    ----------
+    Returns:
+        written: False when the file already had this content (bool)
+    """
+    midi_path = str(midi_path)
+    tmp_path = f"{midi_path}.tmp"
+    segment_to_midi(segment, path_output=tmp_path, tempo=tempo)
+    if os.path.exists(midi_path) and filecmp.cmp(tmp_path, midi_path, shallow=False):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, midi_path)
+    return True
+
+def note_to_segment_array(note):
+    """ Convert note to segment without building Python lists
+    ----------
+    Parameters:
+        note: note/10ms (array)
+    ----------
+    Returns:
+        segments: [start(s),end(s),pitch] rows (array, shape (num_segments, 3))
+    """
+    note = np.asarray(note)
+    if len(note) == 0:
+        return np.zeros((0, 3))
+    starts = np.concatenate([[0], np.flatnonzero(note[1:] != note[:-1]) + 1])
+    ends = np.append(starts[1:], len(note)) - 1
+    voiced = note[starts] > 0
+    # a note still sounding on the last frame has no end and is left out
+    closed = voiced & (ends < len(note) - 1)
+
+    segments = np.empty((int(closed.sum()), 3))
+    segments[:, 0] = 0.01 * starts[closed]
+    segments[:, 1] = 0.01 * ends[closed]
+    segments[:, 2] = note[starts[closed]].astype(np.int64)
+    return segments
+
+
 def note_to_segment(note):
     """ Convert note to segment
     ----------
@@ -99,31 +145,11 @@ def note_to_segment(note):
     Returns: 
         segments: [start(s),end(s),pitch] (list) 
     """
-    startSeg = []
-    endSeg = []
-    notes = []
-    flag = -1
-
-    if note[0] > 0:
-        startSeg.append(0)
-        notes.append(np.int(note[0]))
-        flag *= -1
-    for i in range(0, len(note) - 1):
-        if note[i] != note[i + 1]:
-            if flag < 0:
-                startSeg.append(0.01 * (i + 1))
-                notes.append(np.int(note[i + 1]))
-                flag *= -1
-            else:
-                if note[i + 1] == 0:
-                    endSeg.append(0.01 * i)
-                    flag *= -1
-                else:
-                    endSeg.append(0.01 * i)
-                    startSeg.append(0.01 * (i + 1))
-                    notes.append(np.int(note[i + 1]))
-
-    return list(zip(startSeg, endSeg, notes))
+    segments = note_to_segment_array(note)
+    segment = [(start, end, int(pitch)) for start, end, pitch in segments.tolist()]
+    if segment and len(note) > 0 and note[0] > 0:
+        segment[0] = (0,) + segment[0][1:]
+    return segment
 
 
 def note2Midi(frame_level_pitchscroe, path_output, tempo):
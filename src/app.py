@@ -1,97 +1,70 @@
 import os
 import argparse
-import yt_dlp
 import asyncio
+import fnmatch
+import contextvars
 from concurrent.futures import ThreadPoolExecutor
-from downloadSong import download_youtube_audio
-from singing_transcription import SingingTranscription
+from singing_transcription import SingingTranscription, BACKENDS
 from pathlib import Path
-from model import *
 from featureExtraction import *
 from quantization import *
 from utils import *
 from MIDI import *
+from transcription_cache import TranscriptionCache, transcribe_audio
+from ingest_pipeline import IngestPipeline
+from download_pool import DownloadPool
+from metrics import metrics, stage, start_breakdown
+from profiling import PROFILE_DIR, PROFILE_MODES, SAMPLE_RATE, profiled
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 import uvicorn
 
-async def download_single_video(ydl, entry, output_folder):
-    try:
-        file_path = ydl.prepare_filename(entry).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-        if not os.path.exists(file_path):
-            try:
-                await asyncio.get_event_loop().run_in_executor(
-                    ThreadPoolExecutor(),
-                    lambda: ydl.process_ie_result(entry, download=True)
-                )
-            except yt_dlp.utils.ExtractorError as e:
-                # Check for specific error messages related to video availability
-                if "Video unavailable" in str(e):
-                    print(f"Skipping video {entry['id']} - {e}")  # Skip this video
-                else:
-                    print(f"Error during video download for {entry['id']}: {e}")
-                return None
-            except Exception as e:
-                print(f"Error during video download for {entry['id']}: {e}")
-                return None
-        if os.path.exists(file_path):
-            return file_path
-    except Exception as e:
-        print(f"Error preparing filename for video {entry['id']}: {e}")
-    return None
-
-async def download_youtube_audio(url, output_folder="downloads"):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': f'{output_folder}/%(title)s.%(ext)s',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'quiet': False,
-        'noprogress': False
-    }
+# "keras" or "tflite" (a model written by export_model.py), None takes the backend's file under data/
+MODEL_BACKEND = "keras"
+MODEL_PATH = None
+TRANSCRIPTION_CACHE_DIR = "transcription_cache"
+TRANSCRIPTION_CACHE_MAX_BYTES = 512 * 2 ** 20
+# downloads of a playlist running at the same time, and tries per video
+DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_ATTEMPTS = 3
+
+transcription_cache = None
 
-    try:
-        downloaded_files = []
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            try:
-                info = await asyncio.get_event_loop().run_in_executor(
-                    ThreadPoolExecutor(),
-                    lambda: ydl.extract_info(url, download=False)
-                )
-            except yt_dlp.utils.ExtractorError as e:
-                print(f"Error extracting info for URL {url}: {e}")
-                return None
-            except Exception as e:
-                print(f"Error in extracting info: {e}")
-                return None
-
-            if 'entries' in info:  # Playlist
-                tasks = [
-                    download_single_video(ydl, entry, output_folder)
-                    for entry in info['entries']
-                    if entry
-                ]
-                results = await asyncio.gather(*tasks)
-                downloaded_files = [f for f in results if f]
-            else:  # Single video
-                file_path = await download_single_video(ydl, info, output_folder)
-                if file_path:
-                    downloaded_files.append(file_path)
-
-        return downloaded_files[0] if len(downloaded_files) == 1 else downloaded_files or None
 
+def get_transcription_cache():
+    global transcription_cache
+    if transcription_cache is None:
+        path_weight = MODEL_PATH or SingingTranscription(MODEL_BACKEND).default_weight_path()
+        transcription_cache = TranscriptionCache(TRANSCRIPTION_CACHE_DIR, path_weight, TRANSCRIPTION_CACHE_MAX_BYTES)
+    return transcription_cache
+
+async def download_youtube_audio(url, output_folder="downloads", concurrency=None, ydl_factory=None):
+    pool = DownloadPool(output_folder, concurrency or DOWNLOAD_CONCURRENCY, DOWNLOAD_ATTEMPTS, ydl_factory=ydl_factory)
+    try:
+        items = await pool.download(url)
     except Exception as e:
         print(f"Error in download configuration: {e}")
         return None
+    finally:
+        pool.close()
+
+    downloaded_files = [item.file_path for item in items if item.status == "done"]
+    return downloaded_files[0] if len(downloaded_files) == 1 else downloaded_files or None
+
+def transcribe_to_midi(ST, model_ST, mp3_path, output_folder, cache):
+    with stage("decode"):
+        audio = DecodedAudio.from_file(mp3_path)
+    _, tempo, segment = transcribe_audio(ST, model_ST, audio, cache)
+
+    filename = Path(mp3_path).stem
+    midi_path = os.path.join(output_folder, f"{filename}.mid")
+    with stage("midi_write"):
+        write_midi_if_changed(segment, midi_path, tempo)
+    return midi_path
 
-async def process_youtube_to_midi(youtube_url, output_folder="data1"):
+async def process_youtube_to_midi(youtube_url, output_folder="data1", concurrency=None, ydl_factory=None):
     try:
         downloads_folder = "downloads"
         if not os.path.exists(downloads_folder):
@@ -99,45 +72,74 @@ async def process_youtube_to_midi(youtube_url, output_folder="data1"):
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
-        mp3_paths = await download_youtube_audio(youtube_url)
-        if not mp3_paths:
-            raise Exception("Failed to download audio")
-
-        if isinstance(mp3_paths, str):
-            mp3_paths = [mp3_paths]
-
-        midi_paths = []
-        for mp3_path in mp3_paths:
-            try:
-                # print(f"\nProcessing: {os.path.basename(mp3_path)}")
-                ST = SingingTranscription()
-                model_ST = ST.load_model(f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", TF_summary=False)
-
-                # print("Transcribing audio...")
-                fl_note = ST.predict_melody(model_ST, mp3_path)
+        loop = asyncio.get_event_loop()
+        cache = get_transcription_cache()
+        ST = SingingTranscription(MODEL_BACKEND)
+        # one thread owns the model: it loads it, then transcribes each file as soon as it is downloaded
+        transcriber = ThreadPoolExecutor(max_workers=1)
+        model_future = transcriber.submit(ST.load_inference_model, cache.path_weight)
 
-                tempo = calc_tempo(mp3_path)
-                refined_fl_note = refine_note(fl_note, tempo)
-                segment = note_to_segment(refined_fl_note)
+        def transcribe(mp3_path):
+            return transcribe_to_midi(ST, model_future.result(), mp3_path, output_folder, cache)
 
-                filename = Path(mp3_path).stem
-                midi_path = os.path.join(output_folder, f"{filename}.mid")
-                segment_to_midi(segment, path_output=midi_path, tempo=tempo)
+        pool = DownloadPool(downloads_folder, concurrency or DOWNLOAD_CONCURRENCY, DOWNLOAD_ATTEMPTS,
+                            ydl_factory=ydl_factory)
+        items = []
+        transcriptions = []
+        try:
+            async for item in pool.iter_downloads(youtube_url):
+                items.append(item)
+                metrics.record("download", item.seconds, error=item.status != "done")
+                if item.status == "done":
+                    # the transcriber thread adds its stages to the breakdown of this request
+                    context = contextvars.copy_context()
+                    transcriptions.append(
+                        (item, loop.run_in_executor(transcriber, context.run, transcribe, item.file_path))
+                    )
+        finally:
+            pool.close()
 
-                midi_paths.append(midi_path)
-                # print(f"Successfully created MIDI file: {midi_path}")
+        if not transcriptions:
+            transcriber.shutdown(wait=False)
+            raise Exception("Failed to download audio")
 
+        midi_paths = []
+        for item, future in transcriptions:
+            try:
+                midi_paths.append(await future)
             except Exception as e:
-                print(f"Error processing {os.path.basename(mp3_path)}: {e}")
-                continue
+                print(f"Error processing {os.path.basename(item.file_path)}: {e}")
+        transcriber.shutdown(wait=False)
 
+        failed = [item.video_id for item in items if item.status == "failed"]
+        retried = sum(item.attempts > 1 for item in items)
+        print(f"Downloaded {len(transcriptions)}/{len(items)} videos ({retried} retried, failed: {failed})")
         return midi_paths
 
     except Exception as e:
         print(f"Error during processing: {e}")
         return []
 
-def process_folder_to_midi(input_folder, output_folder="data1"):
+def profile_folder_to_midi(jobs, cache, profile, profile_rate=SAMPLE_RATE, profile_dir=PROFILE_DIR, profile_match="*"):
+    """ Transcribe the files one at a time, each under its own profiler
+
+    The pipeline overlaps files across processes, so a file is only profiled on
+    its own: cProfile sees every step on this thread.
+    """
+    ST = SingingTranscription(MODEL_BACKEND)
+    model_ST = ST.load_inference_model(cache.path_weight)
+    midi_paths = []
+    for mp3_path, midi_path in jobs:
+        mode = profile if fnmatch.fnmatch(mp3_path.name, profile_match) else None
+        try:
+            with profiled(f"ingest-{mp3_path.stem}", mode, profile_rate, profile_dir):
+                midi_paths.append(transcribe_to_midi(ST, model_ST, str(mp3_path), str(midi_path.parent), cache))
+        except Exception as e:
+            print(f"Error processing {mp3_path.name}: {e}")
+    return midi_paths
+
+def process_folder_to_midi(input_folder, output_folder="data1", workers=None, batch_size=256, profile=None,
+                           profile_rate=SAMPLE_RATE, profile_dir=PROFILE_DIR, profile_match="*"):
     try:
         input_path = Path(input_folder)
         output_path = Path(output_folder)
@@ -148,36 +150,24 @@ def process_folder_to_midi(input_folder, output_folder="data1"):
             print(f"No MP3 files found in {input_folder}")
             return []
             
-        successful_conversions = []
+        # unchanged audio is served from the transcription cache, whatever its file name
+        jobs = [(mp3_path, output_path / f"{mp3_path.stem}.mid") for mp3_path in mp3_files]
         
-        for mp3_path in mp3_files:
-            try:
-                midi_path = output_path / f"{mp3_path.stem}.mid"
-                
-                # Check if the MIDI file already exists
-                if midi_path.exists():
-                    print(f"Skipping {mp3_path.name}, MIDI file already exists: {midi_path.name}")
-                    continue
-                
-                print(f"\nProcessing: {mp3_path.name}")
-                
-                ST = SingingTranscription()
-                model_ST = ST.load_model(f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", TF_summary=False)
-                fl_note = ST.predict_melody(model_ST, str(mp3_path))
-                
-                tempo = calc_tempo(str(mp3_path))
-                refined_fl_note = refine_note(fl_note, tempo)
-                segment = note_to_segment(refined_fl_note)
-                
-                segment_to_midi(segment, path_output=str(midi_path), tempo=tempo)
-                
-                successful_conversions.append(midi_path)
-                print(f"Successfully created: {midi_path.name}")
-                
-            except Exception as e:
-                print(f"Error processing {mp3_path.name}: {e}")
-                continue
+        cache = get_transcription_cache()
+        if profile:
+            return profile_folder_to_midi(jobs, cache, profile, profile_rate, profile_dir, profile_match)
+
+        ST = SingingTranscription(MODEL_BACKEND)
+        # the worker pools fork before the model is loaded
+        pipeline = IngestPipeline(ST, decode_workers=workers, batch_size=batch_size, cache=cache)
+        try:
+            model_ST = ST.load_inference_model(cache.path_weight)
+            successful_conversions, report = pipeline.run(model_ST, jobs)
+        finally:
+            pipeline.close()
                 
+        print(f"Pipeline: {report}")
+        print(f"Transcription cache: {cache.stats()}")
         return successful_conversions
         
     except Exception as e:
@@ -198,37 +188,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """ Duration, count and errors of each ingestion stage, in the Prometheus text format """
+    return metrics.render()
+
 @app.post("/convert")
-async def convert_youtube_to_midi(request: YouTubeRequest):
+async def convert_youtube_to_midi(request: YouTubeRequest, stages: bool = False):
     try:
+        breakdown = start_breakdown()
         midi_paths = await process_youtube_to_midi(request.url)
         if not midi_paths:
             raise HTTPException(status_code=400, detail="Failed to convert YouTube audio to MIDI")
         
-        return {
+        response = {
             "status": "success",
             "midi_files": midi_paths if isinstance(midi_paths, list) else [midi_paths]
         }
+        if stages:
+            # seconds per stage, summed over the videos of the request
+            response["stages"] = breakdown
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--api", action="store_true", help="Run as API server")
-    args = parser.parse_args()
+    parser.add_argument("--backend", choices=BACKENDS, default=MODEL_BACKEND, help="Inference backend of the transcription model")
+    parser.add_argument("--model", default=MODEL_PATH, help="Weights (keras) or .tflite file (tflite) to load")
+    args, _ = parser.parse_known_args()
+    MODEL_BACKEND = args.backend
+    MODEL_PATH = args.model
 
     if args.api:
         uvicorn.run(app, host="0.0.0.0", port=8000)
     else:
-        parser = argparse.ArgumentParser(description="Convert YouTube video or MP3 files to MIDI")
+        parser = argparse.ArgumentParser(description="Convert YouTube video or MP3 files to MIDI", parents=[parser],
+                                         add_help=False)
         parser.add_argument("--url", help="YouTube URL of the song or playlist")
         parser.add_argument("--folder", help="Folder containing MP3 files")
         parser.add_argument("--output", default="output", help="Output folder for MIDI files")
+        parser.add_argument("--download-concurrency", type=int, default=DOWNLOAD_CONCURRENCY, help="Parallel downloads for --url")
+        parser.add_argument("--workers", type=int, default=None, help="Decoding processes for --folder (default: half the CPUs)")
+        parser.add_argument("--batch-size", type=int, default=256, help="Spectrogram windows per model call for --folder")
+        parser.add_argument("--profile", choices=PROFILE_MODES, help="Transcribe --folder one file at a time, each under this profiler")
+        parser.add_argument("--profile-rate", type=float, default=SAMPLE_RATE, help="Samples per second of --profile sample")
+        parser.add_argument("--profile-dir", default=PROFILE_DIR, help="Folder of the profiles, .prof (pstats) or .folded (flamegraph)")
+        parser.add_argument("--profile-match", default="*", help="Profile only the files matching this pattern, e.g. 'song_12*'")
         
         args = parser.parse_args()
         
         if args.url:
-            midi_paths = asyncio.run(process_youtube_to_midi(args.url, args.output))
+            midi_paths = asyncio.run(process_youtube_to_midi(args.url, args.output, args.download_concurrency))
             if midi_paths:
                 if isinstance(midi_paths, list):    
                     print(f"\nSuccessfully converted {len(midi_paths)} files")
@@ -237,7 +249,9 @@ if __name__ == "__main__":
             else:
                 print("YouTube conversion failed.")
         elif args.folder:
-            converted_files = process_folder_to_midi(args.folder, args.output)
+            converted_files = process_folder_to_midi(args.folder, args.output, args.workers, args.batch_size,
+                                                     args.profile, args.profile_rate, args.profile_dir,
+                                                     args.profile_match)
             if converted_files:
                 print(f"\nSuccessfully converted {len(converted_files)} files")
             else:
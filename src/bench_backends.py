@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from pathlib import Path
+import numpy as np
+from featureExtraction import DecodedAudio, spec_extraction
+from singing_transcription import SingingTranscription
+
+
+def rss_mb():
+    """ Current and peak resident memory of this process, in MB (tuple) """
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.split()
+    return int(status["VmRSS"][0]) / 1024, int(status["VmHWM"][0]) / 1024
+
+
+def load_reference(path):
+    """ Frame-level notes written by SingingTranscription.save_output_frame_level (array) """
+    return np.loadtxt(path, ndmin=2)[:, 1]
+
+
+def note_accuracy(notes, reference):
+    """ Share of frames with the same note, and of voiced reference frames with the same note """
+    length = min(len(notes), len(reference))
+    notes, reference = notes[:length], reference[:length]
+    voiced = reference > 0
+    return {
+        "frame_accuracy": float(np.mean(notes == reference)) if length else 0.0,
+        "voiced_accuracy": float(np.mean(notes[voiced] == reference[voiced])) if voiced.any() else 0.0,
+    }
+
+
+def run_backend(backend, path_model, windows, batch_size, repeat):
+    """ Load one backend in this (fresh) process, transcribe every file and time it
+    ----------
+    Parameters:
+        backend: "keras" or "tflite" (str)
+        path_model: weights or .tflite file (str)
+        windows: spectrogram windows of each validation file (list)
+        batch_size: windows per model call (int)
+        repeat: timed passes over the whole set, the best is kept (int)
+
+    ----------
+    Returns:
+        result: notes per file, frames per second and resident memory (dict)
+    """
+    rss_start, _ = rss_mb()
+    ST = SingingTranscription(backend)
+    start = time.perf_counter()
+    model = ST.load_inference_model(path_model)
+    load_seconds = time.perf_counter() - start
+    rss_loaded, _ = rss_mb()
+
+    notes = [ST.decode_melody(model.predict(x, batch_size=batch_size, verbose=0)) for x in windows]
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for x in windows:
+            model.predict(x, batch_size=batch_size, verbose=0)
+        best = min(best, time.perf_counter() - start)
+
+    rss_end, rss_peak = rss_mb()
+    num_frames = sum(len(x) for x in windows) * ST.window_size
+    return {
+        "notes": notes,
+        "frames_per_second": num_frames / best,
+        "load_seconds": load_seconds,
+        "rss_start_mb": rss_start,
+        "rss_loaded_mb": rss_loaded,
+        "rss_end_mb": rss_end,
+        "rss_peak_mb": rss_peak,
+    }
+
+
+def run_isolated(backend, path_model, windows, batch_size, repeat):
+    """ run_backend in a spawned process, so each backend's memory is measured on its own """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_backend, (backend, path_model, windows, batch_size, repeat))
+
+
+if __name__ == "__main__":
+    ST = SingingTranscription()
+    parser = argparse.ArgumentParser(description="Compare note accuracy, speed and memory of the inference backends")
+    parser.add_argument("--audio", required=True, help="Folder of validation .mp3/.wav files")
+    parser.add_argument("--reference", help="Folder of frame-level <name>.txt notes to score against, "
+                                            "default: the Keras transcription")
+    parser.add_argument("--weights", default=f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", help="Keras weights")
+    parser.add_argument("--tflite", default=f"{ST.PATH_PROJECT}/data/weight_ST.tflite",
+                        help="Comma-separated .tflite files written by export_model.py")
+    parser.add_argument("--batch-size", type=int, default=ST.batch_size)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes per backend, the best is kept")
+    parser.add_argument("--output", default="bench_backends.json", help="JSON file for the results")
+    args = parser.parse_args()
+
+    files = sorted(p for p in Path(args.audio).iterdir() if p.suffix.lower() in (".mp3", ".wav"))
+    windows = [spec_extraction(DecodedAudio.from_file(str(path)), ST.window_size)[0].astype(np.float32) for path in files]
+    print(f"{len(files)} files, {sum(len(x) for x in windows) * ST.window_size} frames")
+
+    backends = [("keras", args.weights)] + [("tflite", path) for path in args.tflite.split(",") if path]
+    runs = [(backend, path, run_isolated(backend, path, windows, args.batch_size, args.repeat)) for backend, path in backends]
+
+    if args.reference:
+        references = [load_reference(Path(args.reference) / f"{path.stem}.txt") for path in files]
+    else:
+        references = runs[0][2]["notes"]
+    keras_scores = None
+    results = []
+    for backend, path, run in runs:
+        scores = [note_accuracy(notes, reference) for notes, reference in zip(run["notes"], references)]
+        accuracy = {key: float(np.mean([score[key] for score in scores])) for key in scores[0]}
+        keras_scores = keras_scores or accuracy
+        row = {"backend": backend, "model": str(path), "model_mb": Path(path).stat().st_size / 2 ** 20}
+        row.update(accuracy)
+        row["voiced_accuracy_diff"] = accuracy["voiced_accuracy"] - keras_scores["voiced_accuracy"]
+        row.update({key: value for key, value in run.items() if key != "notes"})
+        results.append(row)
+        print(f"{backend:7s} {Path(path).name:28s} {row['frames_per_second']:10.0f} frames/s  "
+              f"rss={row['rss_end_mb']:7.1f}MB peak={row['rss_peak_mb']:7.1f}MB  "
+              f"voiced acc={row['voiced_accuracy']:.4f} ({row['voiced_accuracy_diff']:+.4f} vs keras)")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": vars(args),
+        "reference": "annotations" if args.reference else "keras",
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
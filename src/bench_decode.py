@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import time
+import argparse
+import numpy as np
+from singing_transcription import SingingTranscription
+
+
+def decode_melody_loop(ST, y_predict):
+    """ Per-frame decoding loop predict_melody used before decode_melody was vectorized """
+    pitch_range = np.arange(40, 95 + 1.0 / ST.note_res, 1.0 / ST.note_res)
+    pitch_range = np.concatenate([np.zeros(1), pitch_range])
+
+    y_predict = y_predict[0]
+    y_shape = y_predict.shape
+    num_total = y_shape[0] * y_shape[1]
+    y_predict = np.reshape(y_predict, (num_total, y_shape[2]))
+
+    est_MIDI = np.zeros(num_total)
+    for i in range(num_total):
+        index_predict = np.argmax(y_predict[i])
+        pitch_MIDI = pitch_range[np.int32(index_predict)]
+        if pitch_MIDI >= 40 and pitch_MIDI <= 95:
+            est_MIDI[i] = pitch_MIDI
+    return est_MIDI
+
+
+def random_outputs(num_windows, window_size, num_output, seed=0):
+    """ Softmax-like note and voicing outputs shaped like melody_ResNet_JDC's """
+    rng = np.random.default_rng(seed)
+    y_note = rng.random((num_windows, window_size, num_output)).astype(np.float32)
+    y_note /= y_note.sum(axis=2, keepdims=True)
+    y_voicing = rng.random((num_windows, window_size, 2)).astype(np.float32)
+    y_voicing /= y_voicing.sum(axis=2, keepdims=True)
+    return [y_note, y_voicing]
+
+
+def time_it(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark frame decoding of the model outputs")
+    parser.add_argument("--seconds", type=float, default=240, help="Audio length to simulate")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per implementation, best time is kept")
+    args = parser.parse_args()
+
+    ST = SingingTranscription()
+    num_output = int(55 * 2 ** (np.log2(ST.note_res)) + 2)
+    num_windows = int(np.ceil(args.seconds * 100 / ST.window_size))
+    y_predict = random_outputs(num_windows, ST.window_size, num_output)
+
+    assert np.array_equal(decode_melody_loop(ST, y_predict), ST.decode_melody(y_predict))
+
+    time_loop = time_it(lambda: decode_melody_loop(ST, y_predict), args.repeat)
+    time_vec = time_it(lambda: ST.decode_melody(y_predict), args.repeat)
+    time_voicing = time_it(lambda: ST.decode_melody(y_predict, return_voicing=True), args.repeat)
+    num_frames = num_windows * ST.window_size
+    print(f"{num_frames} frames ({args.seconds:.0f}s of audio)")
+    print(f"loop:       {time_loop * 1000:8.2f} ms")
+    print(f"vectorized: {time_vec * 1000:8.2f} ms  ({time_loop / time_vec:.1f}x)")
+    print(f"+ voicing:  {time_voicing * 1000:8.2f} ms")
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import time
+import argparse
+import numpy as np
+from model import melody_ResNet_JDC, InferenceModel
+from singing_transcription import SingingTranscription
+
+
+def time_it(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    ST = SingingTranscription()
+    parser = argparse.ArgumentParser(description="Check and time the inference-only graph against the training graph")
+    parser.add_argument("--weights", default=ST.default_weight_path(), help="Keras weights")
+    parser.add_argument("--windows", type=int, default=256, help="Spectrogram windows per timed pass")
+    parser.add_argument("--batch-sizes", default="1,7,64,100", help="Comma-separated batch sizes checked for equality")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per model, best time is kept")
+    args = parser.parse_args()
+
+    model = melody_ResNet_JDC(ST.num_spec, ST.window_size, ST.note_res)
+    model.load_weights(args.weights)
+    inference = InferenceModel(model)
+
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((args.windows, ST.window_size, ST.num_spec, 1)).astype(np.float32)
+
+    # the note head must not change, whatever the number of windows per call
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        expected = model.predict(x[:batch_size], batch_size=batch_size)[0]
+        actual = inference.predict_on_batch(x[:batch_size])[0]
+        assert np.array_equal(expected, actual), f"note head differs for {batch_size} windows"
+        assert np.array_equal(ST.decode_melody([expected]), ST.decode_melody([actual]))
+    assert inference.tracing_count() == 1, f"traced {inference.tracing_count()} times"
+
+    time_full = time_it(lambda: model.predict(x, batch_size=ST.batch_size), args.repeat)
+    time_inference = time_it(lambda: inference.predict(x, batch_size=ST.batch_size), args.repeat)
+    print(f"{args.windows * ST.window_size} frames, identical note head, traced once")
+    print(f"training graph:  {time_full * 1000:8.2f} ms")
+    print(f"inference graph: {time_inference * 1000:8.2f} ms  ({time_full / time_inference:.2f}x)")
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import time
+import argparse
+import pathlib
+import numpy as np
+from quantization import *
+
+
+def refine_note_frames(est_note, tempo):
+    """ refine_note as it was before the run-length rewrite, frame by frame """
+    one_beat_size = one_beat_frame_size(tempo)
+    est_note_mf1 = median_filter_pitch(est_note, one_beat_size, 1 / 8)
+    est_note_mf2 = median_filter_pitch(est_note_mf1, one_beat_size, 1 / 4)
+    est_note_mf3 = median_filter_pitch(est_note_mf2, one_beat_size, 1 / 3)
+
+    vocing = est_note_mf1 > 0
+    est_pitch_mf3_v = vocing * est_note_mf3
+    est_pitch_mf3_v = clean_note_frames(est_pitch_mf3_v, int(one_beat_size * 1 / 8))
+    est_pitch_mf3_v = clean_segment(est_pitch_mf3_v, int(one_beat_size * 1 / 4))
+    return est_pitch_mf3_v
+
+
+def synthetic_pitch_track(seconds, seed):
+    """ Frame-level pitch track (10ms) with rests, blips and octave errors
+    ----------
+    Parameters:
+        seconds: track length (float)
+        seed: random seed (int)
+
+    ----------
+    Returns:
+        note: MIDI note per frame, 0 when unvoiced (array)
+    """
+    rng = np.random.default_rng(seed)
+    num_frames = int(seconds * 100)
+    note = np.zeros(num_frames)
+    i = 0
+    pitch = 60
+    while i < num_frames:
+        length = int(rng.integers(1, 60))
+        if rng.random() < 0.2:
+            note[i : i + length] = 0
+        else:
+            pitch = int(np.clip(pitch + rng.integers(-5, 6), 40, 95))
+            note[i : i + length] = pitch
+            # octave errors and one-frame blips inside the note
+            if rng.random() < 0.2:
+                k = i + int(rng.integers(0, length))
+                note[k : k + int(rng.integers(1, 8))] = np.clip(pitch + rng.choice([-12, 12]), 40, 95)
+        i += length
+    return note
+
+
+def load_corpus(corpus_folder):
+    """ Frame-level pitch tracks saved by save_output_frame_level ("time pitch" per line) or as .npy """
+    tracks = []
+    for path in sorted(pathlib.Path(corpus_folder).iterdir()):
+        if path.suffix == ".npy":
+            tracks.append((path.name, np.load(path)))
+        elif path.suffix == ".txt":
+            tracks.append((path.name, np.loadtxt(path)[:, 1]))
+    return tracks
+
+
+def time_it(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the run-length refine_note")
+    parser.add_argument("--corpus", help="Folder of frame-level pitch tracks (.txt or .npy)")
+    parser.add_argument("--songs", type=int, default=20, help="Synthetic tracks when no corpus is given")
+    parser.add_argument("--seconds", type=float, default=240, help="Length of the synthetic tracks")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per implementation, best time is kept")
+    args = parser.parse_args()
+
+    if args.corpus:
+        tracks = load_corpus(args.corpus)
+    else:
+        tracks = [(f"synthetic_{k}", synthetic_pitch_track(args.seconds, k)) for k in range(args.songs)]
+
+    tempos = [60.0, 90.0, 120.0, 150.0]
+    total_frames = 0
+    time_frames = 0.0
+    time_runs = 0.0
+    for k, (name, note) in enumerate(tracks):
+        tempo = tempos[k % len(tempos)]
+        expected = refine_note_frames(note, tempo)
+        refined = refine_note(note, tempo)
+        assert np.array_equal(expected, refined), f"refine_note differs from the frame-level version on {name}"
+
+        # the median filters are shared, only the cleaning steps changed
+        vocing = median_filter_pitch(note, one_beat_frame_size(tempo), 1 / 8) > 0
+        est = vocing * note
+        one_beat_size = one_beat_frame_size(tempo)
+        time_frames += time_it(
+            lambda: clean_segment(clean_note_frames(est, one_beat_size // 8), one_beat_size // 4), args.repeat
+        )
+        time_runs += time_it(
+            lambda: clean_segment_runs(clean_note_runs(est, one_beat_size // 8), one_beat_size // 4), args.repeat
+        )
+        total_frames += len(note)
+
+    print(f"{len(tracks)} tracks, {total_frames} frames: outputs identical")
+    print(f"frame loops: {time_frames * 1000:8.2f} ms")
+    print(f"runs:        {time_runs * 1000:8.2f} ms  ({time_frames / time_runs:.1f}x)")
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from catalog import MelodyCatalog
+from matching import ENGINES, notes_from_pitches, get_distance
+from ngram_index import NgramIndex
+from search import search_catalog, shortlist_search
+
+
+def synthetic_song(rng, num_notes):
+    """ Pitch sequence made of repeated and varied motifs, like a verse/chorus melody """
+    motifs = [np.cumsum(rng.choice([-4, -3, -2, -1, 0, 1, 2, 3, 4, 5, 7], size=int(rng.integers(4, 9)))) for _ in range(4)]
+    pitch = int(rng.integers(55, 70))
+    pitches = []
+    while len(pitches) < num_notes:
+        motif = motifs[int(rng.integers(len(motifs)))]
+        if rng.random() < 0.3:
+            motif = motif + rng.integers(-2, 3, size=len(motif))
+        pitches.extend(np.clip(pitch + motif, 40, 95).tolist())
+        pitch = int(np.clip(pitch + rng.integers(-3, 4), 48, 80))
+    return np.array(pitches[:num_notes], dtype=np.int16)
+
+
+def synthetic_catalog(num_songs, mean_notes=250, seed=0):
+    """ In-memory catalog of random melodies
+    ----------
+    Parameters:
+        num_songs: number of songs (int)
+        mean_notes: average notes per song (int)
+        seed: random seed (int)
+
+    ----------
+    Returns:
+        catalog: MelodyCatalog
+    """
+    rng = np.random.default_rng(seed)
+    pitches = []
+    onsets = []
+    songs = []
+    for k in range(num_songs):
+        num_notes = max(2, int(rng.normal(mean_notes, mean_notes / 4)))
+        tempo = int(rng.integers(350000, 750000))
+        pitches.append(synthetic_song(rng, num_notes))
+        onsets.append((np.arange(num_notes) * tempo / 2e6).astype(np.float32))
+        songs.append({"file": f"synthetic_{k:06d}.mid", "tempo": tempo, "size": 0, "mtime_ns": 0})
+    return MelodyCatalog.from_songs(pitches, onsets, songs)
+
+
+def hum_query(catalog, rng, num_notes, transpose=True, tempo_warp=0.2, jitter=0.1):
+    """ Query derived from an excerpt of a catalog song, the way a hum differs from the recording
+    ----------
+    Parameters:
+        catalog: MelodyCatalog
+        rng: numpy random Generator
+        num_notes: notes in the excerpt (int)
+        transpose: shift the excerpt by a random number of semitones (bool)
+        tempo_warp: largest relative change of the tempo (float)
+        jitter: probability of each note being off by a semitone, dropped or repeated (float)
+
+    ----------
+    Returns:
+        query: [time, pitch] rows (array)
+        idx: catalog index of the source song (int)
+    """
+    lengths = np.diff(catalog.offsets)
+    idx = int(rng.choice(np.flatnonzero(lengths >= num_notes)))
+    start = int(rng.integers(0, lengths[idx] - num_notes + 1))
+    pitches = np.asarray(catalog.pitch_sequence(idx)[start : start + num_notes], dtype=np.int64)
+
+    if transpose:
+        pitches = pitches + int(rng.integers(-6, 7))
+    noisy = []
+    for pitch in pitches:
+        roll = rng.random()
+        if roll < jitter / 3:
+            noisy.append(pitch + int(rng.choice([-1, 1])))
+        elif roll < 2 * jitter / 3:
+            continue
+        elif roll < jitter:
+            noisy.extend([pitch, pitch])
+        else:
+            noisy.append(pitch)
+    tempo = catalog.songs[idx]["tempo"] * (1 + rng.uniform(-tempo_warp, tempo_warp))
+    return notes_from_pitches(np.array(noisy), tempo), idx
+
+
+def run_queries(search, queries, memory_queries=3):
+    """ Latency of each query, top-1 accuracy and peak traced memory
+
+    tracemalloc slows every allocation down, so memory is measured in a second
+    pass over the first memory_queries queries only.
+    """
+    latencies = []
+    correct = 0
+    for query, idx in queries:
+        start = time.perf_counter()
+        hits = search(query)
+        latencies.append(time.perf_counter() - start)
+        correct += int(len(hits) > 0 and hits[0][1] == idx)
+
+    tracemalloc.start()
+    for query, _ in queries[:memory_queries]:
+        search(query)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return np.array(latencies), correct / len(queries), peak
+
+
+def summarize(latencies, accuracy, peak):
+    return {
+        "queries": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "mean_ms": float(latencies.mean() * 1000),
+        "throughput_qps": float(len(latencies) / latencies.sum()),
+        "peak_memory_mb": peak / 2 ** 20,
+        "top1_accuracy": accuracy,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark search latency against synthetic catalogs and hums")
+    parser.add_argument("--sizes", default="100,1000", help="Comma-separated catalog sizes")
+    parser.add_argument("--lengths", default="10,20,40", help="Comma-separated query lengths in notes")
+    parser.add_argument("--queries", type=int, default=20, help="Queries per catalog size and query length")
+    parser.add_argument("--engines", default=",".join(ENGINES + ("shortlist",)),
+                        help="Comma-separated engines: subsequence, fastdtw, shortlist (n-gram + subsequence)")
+    parser.add_argument("--memory-queries", type=int, default=3, help="Queries run again under tracemalloc for peak memory")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--mean-notes", type=int, default=250, help="Average notes per synthetic song")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_search.json", help="JSON file for the results")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare the p50/p95 latencies against")
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    lengths = [int(x) for x in args.lengths.split(",")]
+    engines = args.engines.split(",")
+    results = []
+    for num_songs in sizes:
+        catalog = synthetic_catalog(num_songs, args.mean_notes, args.seed)
+        catalog.interval_bounds()
+        index = NgramIndex.build(catalog)
+        for num_notes in lengths:
+            rng = np.random.default_rng([args.seed, num_songs, num_notes])
+            queries = [hum_query(catalog, rng, num_notes) for _ in range(args.queries)]
+
+            # one query against one song, as get_distance is called per song
+            pairs = [(query, catalog.notes(idx)) for query, idx in queries]
+            start = time.perf_counter()
+            for query, notes in pairs:
+                get_distance(query, notes)
+            pair_ms = (time.perf_counter() - start) / len(pairs) * 1000
+
+            for engine in engines:
+                if engine == "shortlist":
+                    search = lambda q: shortlist_search(q, catalog, index, top_k=args.top_k)[0]
+                else:
+                    search = lambda q, engine=engine: search_catalog(q, catalog, top_k=args.top_k, engine=engine)[0]
+                row = {"engine": engine, "songs": num_songs, "query_notes": num_notes, "get_distance_ms": pair_ms}
+                row.update(summarize(*run_queries(search, queries, args.memory_queries)))
+                results.append(row)
+                print(f"{engine:12s} songs={num_songs:7d} notes={num_notes:3d}  p50={row['p50_ms']:9.2f}ms  "
+                      f"p95={row['p95_ms']:9.2f}ms  p99={row['p99_ms']:9.2f}ms  {row['throughput_qps']:8.1f} q/s  "
+                      f"peak={row['peak_memory_mb']:7.1f}MB  top1={row['top1_accuracy']:.2f}")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r["engine"], r["songs"], r["query_notes"]): r for r in json.load(f)["results"]}
+        for row in results:
+            old = baseline.get((row["engine"], row["songs"], row["query_notes"]))
+            if old is not None:
+                print(f"{row['engine']:12s} songs={row['songs']:7d} notes={row['query_notes']:3d}  "
+                      f"p50 x{row['p50_ms'] / old['p50_ms']:.2f}  p95 x{row['p95_ms'] / old['p95_ms']:.2f}")
@@ -0,0 +1,248 @@
+import os
+import json
+import argparse
+import numpy as np
+from matching import parse_midi_notes, notes_from_pitches
+from profiling import PROFILE_DIR, PROFILE_MODES, SAMPLE_RATE, profiled
+
+CATALOG_VERSION = 1
+
+
+def list_midi_files(midi_folder):
+    """ List the .mid files of a folder with the stats used to detect changes
+    ----------
+    Parameters:
+        midi_folder: folder of .mid files (str)
+
+    ----------
+    Returns:
+        files: {file name: [size, mtime_ns]} (dict)
+    """
+    files = {}
+    for entry in sorted(os.scandir(midi_folder), key=lambda e: e.name):
+        if entry.is_file() and entry.name.endswith(".mid"):
+            stat = entry.stat()
+            files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+class MelodyCatalog:
+    """ Melodies of the whole database stored in contiguous arrays
+    ----------
+    Parameters:
+        pitches: MIDI note numbers of every song, concatenated (array)
+        onsets: note-on times in seconds, aligned with pitches (array)
+        offsets: song i owns pitches[offsets[i]:offsets[i + 1]] (array)
+        songs: per-song metadata {"file", "tempo", "size", "mtime_ns"} (list)
+    """
+
+    def __init__(self, pitches, onsets, offsets, songs):
+        self.pitches = pitches
+        self.onsets = onsets
+        self.offsets = offsets
+        self.songs = songs
+        self._bounds = None
+
+    @classmethod
+    def load(cls, index_folder, mmap=True):
+        """ Open a catalog written by build_catalog
+        ----------
+        Parameters:
+            index_folder: folder of the binary index (str)
+            mmap: memory-map the arrays instead of reading them (bool)
+
+        ----------
+        Returns:
+            catalog: MelodyCatalog
+        """
+        with open(os.path.join(index_folder, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != CATALOG_VERSION:
+            raise ValueError(f"Unsupported catalog version {meta['version']} in {index_folder}")
+
+        mmap_mode = "r" if mmap else None
+        pitches = np.load(os.path.join(index_folder, "pitches.npy"), mmap_mode=mmap_mode)
+        onsets = np.load(os.path.join(index_folder, "onsets.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(index_folder, "offsets.npy"))
+        return cls(pitches, onsets, offsets, meta["songs"])
+
+    @classmethod
+    def from_songs(cls, pitches, onsets, songs):
+        """ In-memory catalog from the notes of each song
+        ----------
+        Parameters:
+            pitches: MIDI note numbers of each song (list of arrays)
+            onsets: note-on times of each song (list of arrays)
+            songs: per-song metadata (list)
+
+        ----------
+        Returns:
+            catalog: MelodyCatalog
+        """
+        offsets = np.zeros(len(songs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(song_pitches) for song_pitches in pitches])
+        return cls(
+            np.concatenate(pitches).astype(np.int16) if pitches else np.zeros(0, dtype=np.int16),
+            np.concatenate(onsets).astype(np.float32) if onsets else np.zeros(0, dtype=np.float32),
+            offsets,
+            songs,
+        )
+
+    def __len__(self):
+        return len(self.songs)
+
+    def name(self, idx):
+        return self.songs[idx]["file"]
+
+    def pitch_sequence(self, idx):
+        return self.pitches[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def onset_sequence(self, idx):
+        return self.onsets[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def notes(self, idx):
+        """ [time, pitch] rows of one song, as parse_midi_file returns them """
+        return notes_from_pitches(self.pitch_sequence(idx), self.songs[idx]["tempo"])
+
+    def interval_bounds(self):
+        """ Per-song envelope of the [time, pitch] intervals, computed once for all songs
+        ----------
+        Returns:
+            lower: smallest interval of each song per dimension (array, shape (num_songs, 2))
+            upper: largest interval of each song per dimension (array, shape (num_songs, 2))
+            num_intervals: number of intervals of each song (array)
+
+        Songs with fewer than two notes have no intervals; their envelope is empty
+        (lower = inf, upper = -inf).
+        """
+        if self._bounds is not None:
+            return self._bounds
+
+        num_songs = len(self.songs)
+        counts = np.diff(self.offsets)
+        num_intervals = np.maximum(counts - 1, 0)
+        lower = np.full((num_songs, 2), np.inf)
+        upper = np.full((num_songs, 2), -np.inf)
+        if len(self.pitches) > 1:
+            # same arithmetic as notes_from_pitches so the envelope holds the exact intervals
+            song_of_note = np.repeat(np.arange(num_songs), counts)
+            tempos = np.array([song["tempo"] for song in self.songs], dtype=np.float64)
+            local_index = (np.arange(len(self.pitches)) - self.offsets[song_of_note]).astype(np.float64)
+            times = local_index * 1000000 / tempos[song_of_note]
+            intervals = np.stack([np.diff(times), np.diff(self.pitches.astype(np.float64))], axis=1)
+
+            # intervals crossing from one song into the next are not part of either song
+            inside = song_of_note[1:] == song_of_note[:-1]
+            starts = self.offsets[:-1][num_intervals > 0]
+            low = np.where(inside[:, np.newaxis], intervals, np.inf)
+            high = np.where(inside[:, np.newaxis], intervals, -np.inf)
+            lower[num_intervals > 0] = np.minimum.reduceat(low, starts, axis=0)
+            upper[num_intervals > 0] = np.maximum.reduceat(high, starts, axis=0)
+
+        self._bounds = (lower, upper, num_intervals)
+        return self._bounds
+
+    def is_stale(self, midi_folder):
+        files = list_midi_files(midi_folder)
+        indexed = {song["file"]: [song["size"], song["mtime_ns"]] for song in self.songs}
+        return files != indexed
+
+
+def parse_midi_folder(midi_folder, files, previous=None):
+    """ Notes of the given .mid files, reusing the songs of a previous catalog that did not change
+    ----------
+    Parameters:
+        midi_folder: folder of database .mid files (str)
+        files: {file name: [size, mtime_ns]} to read, as list_midi_files returns (dict)
+        previous: catalog whose unchanged songs are copied instead of parsed (MelodyCatalog)
+
+    ----------
+    Returns:
+        pitches: MIDI note numbers of each song (list of arrays)
+        onsets: note-on times of each song (list of arrays)
+        songs: per-song metadata (list)
+        num_parsed: number of files actually parsed (int)
+    """
+    known = {}
+    if previous is not None:
+        known = {song["file"]: idx for idx, song in enumerate(previous.songs)}
+
+    pitches = []
+    onsets = []
+    songs = []
+    num_parsed = 0
+    for midi_file, (size, mtime_ns) in files.items():
+        idx = known.get(midi_file)
+        if idx is not None and [previous.songs[idx]["size"], previous.songs[idx]["mtime_ns"]] == [size, mtime_ns]:
+            pitches.append(np.asarray(previous.pitch_sequence(idx)))
+            onsets.append(np.asarray(previous.onset_sequence(idx)))
+            songs.append(dict(previous.songs[idx]))
+            continue
+        try:
+            song_pitches, song_onsets, tempo = parse_midi_notes(os.path.join(midi_folder, midi_file))
+        except Exception as e:
+            print(f"Error parsing {midi_file}: {e}")
+            continue
+        num_parsed += 1
+        pitches.append(song_pitches)
+        onsets.append(song_onsets)
+        songs.append({"file": midi_file, "tempo": tempo, "size": size, "mtime_ns": mtime_ns})
+    return pitches, onsets, songs, num_parsed
+
+
+def build_catalog(midi_folder="data1", index_folder="data1_index", previous=None):
+    """ Parse the .mid files of a folder and write the binary index
+    ----------
+    Parameters:
+        midi_folder: folder of database .mid files (str)
+        index_folder: output folder of the index (str)
+        previous: out-of-date catalog, only its new or changed files are parsed (MelodyCatalog)
+
+    ----------
+    Returns:
+        catalog: MelodyCatalog (memory-mapped from the written files)
+    """
+    os.makedirs(index_folder, exist_ok=True)
+
+    pitches, onsets, songs, num_parsed = parse_midi_folder(midi_folder, list_midi_files(midi_folder), previous)
+    catalog = MelodyCatalog.from_songs(pitches, onsets, songs)
+    arrays = {"pitches": catalog.pitches, "onsets": catalog.onsets, "offsets": catalog.offsets}
+    # write next to the live files and swap them in, meta.json last
+    for name, array in arrays.items():
+        tmp_path = os.path.join(index_folder, f"{name}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(index_folder, f"{name}.npy"))
+    tmp_path = os.path.join(index_folder, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"version": CATALOG_VERSION, "songs": songs}, f)
+    os.replace(tmp_path, os.path.join(index_folder, "meta.json"))
+
+    print(f"Indexed {len(songs)} songs ({len(arrays['pitches'])} notes, {num_parsed} parsed) into {index_folder}")
+    return MelodyCatalog.load(index_folder)
+
+
+def load_or_build_catalog(midi_folder="data1", index_folder="data1_index"):
+    """ Memory-map the index, updating it first if it is missing or out of date
+
+    An out-of-date index keeps the songs whose files did not change, only new
+    and modified files are parsed.
+    """
+    previous = None
+    if os.path.exists(os.path.join(index_folder, "meta.json")):
+        previous = MelodyCatalog.load(index_folder)
+        if not previous.is_stale(midi_folder):
+            return previous
+    return build_catalog(midi_folder, index_folder, previous)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the binary melody catalog from database MIDI files")
+    parser.add_argument("-i", "--input", default="data1", help="Folder containing database .mid files")
+    parser.add_argument("-o", "--output", default="data1_index", help="Output folder for the catalog index")
+    parser.add_argument("--profile", choices=PROFILE_MODES, help="Profile the build (MIDI parsing) with this profiler")
+    parser.add_argument("--profile-rate", type=float, default=SAMPLE_RATE, help="Samples per second of --profile sample")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="Folder of the profile")
+    args = parser.parse_args()
+
+    with profiled("build_catalog", args.profile, args.profile_rate, args.profile_dir):
+        build_catalog(args.input, args.output)
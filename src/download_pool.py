@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import yt_dlp
+
+
+def youtube_dl_options(output_folder):
+    """ yt-dlp options downloading the best audio stream and converting it to MP3 """
+    return {
+        'format': 'bestaudio/best',
+        'outtmpl': f'{output_folder}/%(title)s.%(ext)s',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }],
+        'quiet': False,
+        'noprogress': False
+    }
+
+
+class DownloadItem:
+    """ Download state of one video
+    ----------
+    Parameters:
+        entry: yt-dlp info dict of the video (dict)
+
+    status goes from "pending" to "done" or "failed"; attempts and error keep
+    what happened to the entry across retries.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.status = "pending"
+        self.attempts = 0
+        self.error = None
+        self.file_path = None
+        self.seconds = 0.0
+
+    @property
+    def video_id(self):
+        return self.entry.get('id')
+
+    def __repr__(self):
+        return f"DownloadItem({self.video_id!r}, {self.status}, attempts={self.attempts})"
+
+
+class DownloadPool:
+    """ Download the videos of a URL with a bounded number of downloads in flight
+    ----------
+    Parameters:
+        output_folder: folder of the downloaded MP3 files (str)
+        concurrency: downloads running at the same time (int)
+        max_attempts: tries per video before it is reported as failed (int)
+        retry_delay: seconds before the first retry, doubled at each attempt (float)
+        ydl_factory: builds the downloader from yt-dlp options, yt_dlp.YoutubeDL by default
+
+    Items are yielded as soon as they are done or failed, so the caller can start
+    transcribing while the rest of the playlist downloads. A failed video goes back
+    to the end of the queue after its delay instead of holding a download slot.
+    """
+
+    def __init__(self, output_folder="downloads", concurrency=4, max_attempts=3, retry_delay=2.0, ydl_factory=None):
+        self.output_folder = output_folder
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.ydl_factory = ydl_factory or yt_dlp.YoutubeDL
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _download(self, ydl, item):
+        file_path = ydl.prepare_filename(item.entry).replace('.webm', '.mp3').replace('.m4a', '.mp3')
+        if not os.path.exists(file_path):
+            ydl.process_ie_result(item.entry, download=True)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"{file_path} was not created")
+        return file_path
+
+    async def iter_downloads(self, url):
+        """ Download every video of a URL
+        ----------
+        Parameters:
+            url: YouTube URL of a video or a playlist (str)
+
+        ----------
+        Returns:
+            items: DownloadItem of each video, in the order they finish (async generator)
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        loop = asyncio.get_event_loop()
+        with self.ydl_factory(youtube_dl_options(self.output_folder)) as ydl:
+            try:
+                info = await loop.run_in_executor(self.executor, lambda: ydl.extract_info(url, download=False))
+            except Exception as e:
+                print(f"Error extracting info for URL {url}: {e}")
+                return
+
+            entries = info['entries'] if 'entries' in info else [info]
+            items = [DownloadItem(entry) for entry in entries if entry]
+            if not items:
+                return
+
+            pending = asyncio.Queue()
+            finished = asyncio.Queue()
+            for item in items:
+                pending.put_nowait(item)
+
+            async def worker():
+                while True:
+                    item = await pending.get()
+                    item.attempts += 1
+                    start = time.perf_counter()
+                    try:
+                        item.file_path = await loop.run_in_executor(self.executor, self._download, ydl, item)
+                        item.status = "done"
+                    except Exception as e:
+                        item.error = str(e)
+                        # an unavailable video will not come back, do not retry it
+                        retry = "Video unavailable" not in item.error and item.attempts < self.max_attempts
+                        if retry:
+                            delay = self.retry_delay * 2 ** (item.attempts - 1)
+                            print(f"Retrying video {item.video_id} in {delay:.1f}s ({item.attempts}/{self.max_attempts}): {e}")
+                            loop.call_later(delay, pending.put_nowait, item)
+                            continue
+                        item.status = "failed"
+                        print(f"Skipping video {item.video_id} - {e}")
+                    finally:
+                        item.seconds += time.perf_counter() - start
+                    finished.put_nowait(item)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(min(self.concurrency, len(items)))]
+            try:
+                for _ in range(len(items)):
+                    yield await finished.get()
+            finally:
+                for task in workers:
+                    task.cancel()
+
+    async def download(self, url):
+        """ Download every video of a URL and return their DownloadItem once all are finished (list) """
+        return [item async for item in self.iter_downloads(url)]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
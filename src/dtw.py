@@ -0,0 +1,87 @@
+import numpy as np
+
+# relative slack of a lower bound test: a bound summed in another order than the DTW cost
+# may round above it, and must not drop a match costing exactly the limit
+BOUND_TOLERANCE = 1e-9
+
+
+def exceeds(bound, limit):
+    """ Whether a lower bound proves the cost is above limit (bool, or bool array for an array of bounds) """
+    return bound > limit + BOUND_TOLERANCE * abs(limit)
+
+
+def cost_matrix(query, database):
+    """ Euclidean distance of each query row to each database row (array, shape (m, n)) """
+    query = np.asarray(query, dtype=np.float64)
+    database = np.asarray(database, dtype=np.float64)
+    return np.sqrt(((database[np.newaxis, :, :] - query[:, np.newaxis, :]) ** 2).sum(axis=2))
+
+
+def subsequence_dtw(query, database, max_distance=np.inf, lb_suffix=None, costs=None):
+    """ DTW of the whole query against the best-matching part of the database
+    ----------
+    Parameters:
+        query: query sequence (array, shape (m, d))
+        database: database sequence (array, shape (n, d))
+        max_distance: abandon the match once it cannot end below this cost (float)
+        lb_suffix: lb_suffix[i] is a lower bound on the cost of query rows i..m-1 (array, shape (m + 1,))
+        costs: cost_matrix(query, database) when the caller already has it (array)
+
+    ----------
+    Returns:
+        distance: cost of the best alignment, inf if abandoned (float)
+        start: first database index of the match (int)
+        end: last database index of the match (int)
+
+    The start and end of the match in the database are free, so one pass over the
+    m x n cost matrix replaces a DTW run per database offset. Rows are filled with
+    array operations: the horizontal step D[i, j - 1] is resolved with a cumulative
+    sum and a running minimum instead of a loop over j.
+
+    The smallest cost of a row never decreases on the next rows, so once it plus
+    the bound of the remaining rows exceeds max_distance the match is abandoned.
+    """
+    query = np.asarray(query, dtype=np.float64)
+    database = np.asarray(database, dtype=np.float64)
+    len_query = len(query)
+    len_database = len(database)
+    if len_query == 0 or len_database == 0:
+        return float("inf"), None, None
+    if lb_suffix is None:
+        lb_suffix = np.zeros(len_query + 1)
+
+    positions = np.arange(len_database)
+    cost = costs[0] if costs is not None else np.sqrt(((database - query[0]) ** 2).sum(axis=1))
+    # open start: the match may begin at any database index
+    acc = cost
+    start = positions
+    if exceeds(acc.min() + lb_suffix[1], max_distance):
+        return float("inf"), None, None
+
+    for i in range(1, len_query):
+        cost = costs[i] if costs is not None else np.sqrt(((database - query[i]) ** 2).sum(axis=1))
+
+        # best predecessor from the previous row: vertical or diagonal step
+        prev = acc
+        prev_start = start
+        diag = np.empty(len_database)
+        diag[0] = np.inf
+        diag[1:] = prev[:-1]
+        take_diag = diag < prev
+        best_prev = np.where(take_diag, diag, prev)
+        best_start = np.where(take_diag, np.roll(prev_start, 1), prev_start)
+
+        # D[j] = min_k (best_prev[k] + cost[k..j]) for k <= j
+        cum_cost = np.cumsum(cost)
+        entry = best_prev - (cum_cost - cost)
+        run_min = np.minimum.accumulate(entry)
+        acc = cum_cost + run_min
+        entry_idx = np.maximum.accumulate(np.where(entry == run_min, positions, 0))
+        start = best_start[entry_idx]
+
+        if exceeds(acc.min() + lb_suffix[i + 1], max_distance):
+            return float("inf"), None, None
+
+    # open end: the match may stop at any database index
+    end = int(np.argmin(acc))
+    return float(acc[end]), int(start[end]), end
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import argparse
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+from featureExtraction import DecodedAudio, spec_extraction
+from singing_transcription import SingingTranscription
+
+QUANTIZATIONS = ("none", "dynamic", "float16", "int8")
+
+
+def calibration_windows(audio_folder, win_size, num_windows=200, seed=0):
+    """ Spectrogram windows of real audio for int8 calibration
+    ----------
+    Parameters:
+        audio_folder: folder of .mp3/.wav files like the ones that will be transcribed (str)
+        win_size: frames per window (int)
+        num_windows: windows to keep, sampled across the files (int)
+        seed: random seed of the sampling (int)
+
+    ----------
+    Returns:
+        x: (array, shape (num_windows, win_size, num_spec, 1), float32)
+    """
+    files = sorted(p for p in Path(audio_folder).iterdir() if p.suffix.lower() in (".mp3", ".wav"))
+    if not files:
+        raise ValueError(f"No .mp3 or .wav files in {audio_folder}")
+    x = np.concatenate([spec_extraction(DecodedAudio.from_file(str(path)), win_size)[0] for path in files])
+    rng = np.random.default_rng(seed)
+    keep = rng.choice(len(x), size=min(num_windows, len(x)), replace=False)
+    return x[np.sort(keep)].astype(np.float32)
+
+
+def export_tflite(model, output_path, quantization="none", calibration=None):
+    """ Convert the Keras model to a TFLite flatbuffer
+    ----------
+    Parameters:
+        model: melody_ResNet_JDC with its weights loaded (keras.Model)
+        output_path: .tflite file to write (str)
+        quantization: "none" (float32), "dynamic" (int8 weights), "float16" (float16 weights)
+                      or "int8" (int8 weights and activations, needs calibration) (str)
+        calibration: spectrogram windows for the int8 activation ranges (array)
+
+    ----------
+    Returns:
+        size: bytes written (int)
+
+    Inputs and outputs stay float32 in every mode, so TFLiteModel feeds the same
+    spectrogram windows as the Keras model. The LSTM layers convert to TFLite
+    builtins; when the converter cannot lower an op it falls back to TF select
+    ops, which need the full TensorFlow interpreter instead of tflite_runtime.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+
+    def converter():
+        conv = tf.lite.TFLiteConverter.from_keras_model(model)
+        if quantization != "none":
+            conv.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "float16":
+            conv.target_spec.supported_types = [tf.float16]
+        if quantization == "int8":
+            if calibration is None:
+                raise ValueError("int8 quantization needs calibration windows")
+            conv.representative_dataset = lambda: ([calibration[k : k + 1]] for k in range(len(calibration)))
+        return conv
+
+    try:
+        flatbuffer = converter().convert()
+    except Exception as e:
+        print(f"Conversion with TFLite builtins failed ({e}), retrying with TF select ops")
+        conv = converter()
+        conv.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        flatbuffer = conv.convert()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "wb") as f:
+        f.write(flatbuffer)
+    return len(flatbuffer)
+
+
+if __name__ == "__main__":
+    ST = SingingTranscription()
+    parser = argparse.ArgumentParser(description="Export the melody_ResNet_JDC weights to a TFLite model")
+    parser.add_argument("--weights", default=f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", help="Keras weights")
+    parser.add_argument("--output", default=f"{ST.PATH_PROJECT}/data/weight_ST.tflite", help=".tflite file to write")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="none")
+    parser.add_argument("--calibration", help="Folder of audio files for --quantization int8")
+    parser.add_argument("--calibration-windows", type=int, default=200, help="Windows sampled for int8 calibration")
+    args = parser.parse_args()
+
+    model = ST.load_model(args.weights)
+    calibration = None
+    if args.quantization == "int8":
+        if not args.calibration:
+            parser.error("--quantization int8 needs --calibration")
+        calibration = calibration_windows(args.calibration, ST.window_size, args.calibration_windows)
+    size = export_tflite(model, args.output, args.quantization, calibration)
+    print(f"Wrote {args.output} ({size / 2 ** 20:.1f} MB, {args.quantization})")
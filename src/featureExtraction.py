@@ -2,14 +2,25 @@
 import librosa
 from pydub import AudioSegment
 import pathlib
+from functools import lru_cache
 
 # from pydub.playback import play
 import numpy as np
 import os
+import io
+import math
+from scipy.signal import resample_poly
 
 PATH_PROJECT = os.path.dirname(os.path.realpath(__file__))
 
 
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+# padding of the centered STFT frames, the librosa 0.8 default the model was trained with
+PAD_MODE = "reflect"
+# tracks longer than this are transcribed a block of windows at a time (seconds)
+STREAM_MIN_SECONDS = 600.0
+
+
 def read_audio(filepath, sr=None):
     path = pathlib.Path(filepath)
     extenstion = path.suffix.replace(".", "")
@@ -22,17 +33,84 @@ def read_audio(filepath, sr=None):
     if sr == None:
         sr = sound.frame_rate
     sound = sound.set_frame_rate(sr)
-    samples = sound.get_array_of_samples()
-    y = np.array(samples).T.astype(np.float32)
+    samples = np.frombuffer(sound.raw_data, dtype=SAMPLE_DTYPES[sound.sample_width])
+    y = samples.astype(np.float32)
 
     return y, sr
 
 
+class DecodedAudio:
+    """ Audio decoded once, resampled in process for each consumer
+    ----------
+    Parameters:
+        samples: mono samples at the native rate, in integer sample units (float32 array)
+        sr: native sampling rate (int)
+
+    spec_extraction (8kHz) and calc_tempo (22.05kHz) both accept this object
+    instead of a path, so the file goes through ffmpeg once. Each rate is derived
+    with a polyphase resampler and kept for later calls.
+    """
+
+    def __init__(self, samples, sr):
+        self.samples = samples
+        self.sr = sr
+        self._resampled = {sr: samples}
+
+    @classmethod
+    def from_segment(cls, sound):
+        samples = np.frombuffer(sound.raw_data, dtype=SAMPLE_DTYPES[sound.sample_width])
+        if sound.channels > 1:
+            samples = samples.reshape(-1, sound.channels).mean(axis=1)
+        return cls(samples.astype(np.float32), sound.frame_rate)
+
+    @classmethod
+    def from_file(cls, filepath):
+        path = pathlib.Path(filepath)
+        if path.suffix.lower() == ".mp3":
+            sound = AudioSegment.from_mp3(filepath)
+        else:
+            sound = AudioSegment.from_file(filepath)
+        return cls.from_segment(sound)
+
+    @classmethod
+    def from_bytes(cls, data, format=None):
+        """ Decode an in-memory file, e.g. an upload, without writing it to disk """
+        return cls.from_segment(AudioSegment.from_file(io.BytesIO(data), format=format))
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sr
+
+    def resample(self, sr):
+        """ Samples at the sampling rate sr (float32 array) """
+        if sr not in self._resampled:
+            g = math.gcd(int(sr), int(self.sr))
+            y = resample_poly(self.samples, int(sr) // g, int(self.sr) // g)
+            self._resampled[sr] = y.astype(np.float32)
+        return self._resampled[sr]
+
+
+def load_samples(audio, sr):
+    """ Samples of a path or a DecodedAudio at the sampling rate sr """
+    if isinstance(audio, DecodedAudio):
+        return audio.resample(sr), sr
+    return read_audio(audio, sr=sr)
+
+
+@lru_cache(maxsize=1)
+def load_normalization():
+    """ Mean and std of the training spectrograms, read from disk once """
+    path_project = pathlib.Path(__file__).parent.parent
+    x_train_mean = np.load(f"{path_project}/data/x_train_mean.npy")
+    x_train_std = np.load(f"{path_project}/data/x_train_std.npy")
+    return x_train_mean, x_train_std
+
+
 def spec_extraction(file_name, win_size):
 
-    y, _ = read_audio(file_name, sr=8000)
+    y, _ = load_samples(file_name, sr=8000)
 
-    S = librosa.core.stft(y, n_fft=1024, hop_length=80, win_length=1024)
+    S = librosa.core.stft(y, n_fft=1024, hop_length=80, win_length=1024, pad_mode=PAD_MODE)
     x_spec = np.abs(S)
     x_spec = librosa.core.power_to_db(x_spec, ref=np.max)
     x_spec = x_spec.astype(np.float32)
@@ -42,20 +120,87 @@ def spec_extraction(file_name, win_size):
     padNum = num_frames % win_size
     if padNum != 0:
         len_pad = win_size - padNum
-        padding_feature = np.zeros(shape=(513, len_pad))
+        padding_feature = np.zeros(shape=(513, len_pad), dtype=np.float32)
         x_spec = np.concatenate((x_spec, padding_feature), axis=1)
         num_frames = num_frames + len_pad
 
-    x_test = []
-    for j in range(0, num_frames, win_size):
-        x_test_tmp = x_spec[:, range(j, j + win_size)].T
-        x_test.append(x_test_tmp)
-    x_test = np.array(x_test)
+    # consecutive frames of x_spec.T are the windows, no per-window copies
+    x_test = np.ascontiguousarray(x_spec.T, dtype=np.float64).reshape(num_frames // win_size, win_size, 513)
 
     # for standardization
-    path_project = pathlib.Path(__file__).parent.parent
-    x_train_mean = np.load(f"{path_project}/data/x_train_mean.npy")
-    x_train_std = np.load(f"{path_project}/data/x_train_std.npy")
-    x_test = (x_test - x_train_mean) / (x_train_std + 0.0001)
+    x_train_mean, x_train_std = load_normalization()
+    x_test -= x_train_mean
+    x_test /= x_train_std + 0.0001
     x_test = x_test[:, :, :, np.newaxis]
     return x_test, x_spec
+
+
+def iter_spec_extraction(file_name, win_size, batch_windows=64, n_fft=1024, hop_length=80, top_db=80.0):
+    """ Spectrogram windows of spec_extraction, a block at a time
+    ----------
+    Parameters:
+        file_name: audio file (str), DecodedAudio or 8kHz samples (array)
+        win_size: frames per window (int)
+        batch_windows: windows per yielded block (int)
+
+    ----------
+    Returns:
+        x_test: normalized windows (generator of float32 arrays, shape (<= batch_windows, win_size, 513, 1))
+
+    The STFT is computed block by block on the padded signal, so memory depends on
+    batch_windows instead of the track length. power_to_db(ref=np.max) needs the
+    loudest bin of the whole track: a first pass over the blocks finds it, the
+    second pass converts and yields them. The windows are the same as those of
+    spec_extraction once cast to float32, which is what the model receives.
+    """
+    if isinstance(file_name, np.ndarray):
+        y = file_name
+    else:
+        y, _ = load_samples(file_name, sr=8000)
+    # centered frames as librosa.stft(center=True) computes them in spec_extraction
+    y_pad = np.pad(y, int(n_fft // 2), mode=PAD_MODE)
+    num_frames = 1 + (len(y_pad) - n_fft) // hop_length
+    block_frames = win_size * batch_windows
+
+    def stft_block(start):
+        stop = min(start + block_frames, num_frames)
+        segment = y_pad[start * hop_length : (stop - 1) * hop_length + n_fft]
+        S = librosa.core.stft(segment, n_fft=n_fft, hop_length=hop_length, win_length=n_fft, center=False)
+        return np.abs(S)
+
+    ref = max(stft_block(start).max() for start in range(0, num_frames, block_frames))
+    for start in range(0, num_frames, block_frames):
+        yield spec_windows(stft_block(start), ref, win_size, top_db)
+
+
+def spec_windows(x_mag, ref, win_size, top_db=80.0):
+    """ Normalized model windows of STFT magnitude frames, as spec_extraction computes them
+    ----------
+    Parameters:
+        x_mag: STFT magnitudes (array, shape (513, num_frames)), num_frames a multiple of win_size
+               except for the last frames of a track
+        ref: loudest magnitude of the track, the 0 dB reference (float)
+        win_size: frames per window (int)
+        top_db: dynamic range kept below ref (float)
+
+    ----------
+    Returns:
+        x_test: (float32 array, shape (ceil(num_frames / win_size), win_size, 513, 1))
+    """
+    # the loudest bin after conversion is the clipping reference of top_db
+    floor = librosa.core.power_to_db(np.array([ref]), ref=ref, top_db=None).max() - top_db
+    x_spec = librosa.core.power_to_db(x_mag, ref=ref, top_db=None)
+    x_spec = np.maximum(x_spec, floor).astype(np.float32)
+
+    # zero padding of the last window, as in spec_extraction
+    num_block = x_spec.shape[1]
+    padNum = num_block % win_size
+    if padNum != 0:
+        x_spec = np.concatenate((x_spec, np.zeros((513, win_size - padNum), dtype=np.float32)), axis=1)
+        num_block += win_size - padNum
+
+    x_train_mean, x_train_std = load_normalization()
+    x_test = np.ascontiguousarray(x_spec.T, dtype=np.float64).reshape(num_block // win_size, win_size, 513)
+    x_test -= x_train_mean
+    x_test /= x_train_std + 0.0001
+    return x_test.astype(np.float32)[:, :, :, np.newaxis]
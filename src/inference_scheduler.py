@@ -0,0 +1,134 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import metrics
+
+
+class InferenceScheduler:
+    """ Run the spectrogram windows of concurrent requests through the model in shared batches
+    ----------
+    Parameters:
+        model: model with predict_on_batch, returning one array per output (keras.Model)
+        max_batch_size: most windows per model call (int)
+        max_wait: longest time the first queued window waits for company, in seconds (float)
+
+    Requests queue their windows in chunks of at most max_batch_size. A batch is
+    closed when it is full or when max_wait has passed since its first chunk, then
+    runs on a dedicated thread while the next batch fills up, and each request gets
+    back the slice of every output that belongs to its windows. The windows
+    waiting for a batch and the mean batch fill rate are exported as gauges on
+    /metrics.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.num_batches = 0
+        # windows queued and not yet in a running batch
+        self.queued_windows = 0
+        self.num_chunks = 0
+        self.num_windows = 0
+        self.total_wait = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run())
+        metrics.gauge("inference_queue_windows", lambda: self.queued_windows,
+                      "Spectrogram windows waiting for a model batch.")
+        metrics.gauge("inference_batch_fill_rate", self.fill_rate,
+                      "Mean share of max_batch_size filled by the model batches so far.")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.executor.shutdown(wait=False)
+
+    async def predict(self, x):
+        """ Model outputs for the windows of one request
+        ----------
+        Parameters:
+            x: spectrogram windows (array, shape (num_windows, window_size, num_spec, 1))
+
+        ----------
+        Returns:
+            y_predict: one array per model output, in the order of x (list)
+        """
+        loop = asyncio.get_event_loop()
+        futures = []
+        for start in range(0, len(x), self.max_batch_size):
+            future = loop.create_future()
+            self.queued_windows += len(x[start : start + self.max_batch_size])
+            await self.queue.put((x[start : start + self.max_batch_size], future, time.perf_counter()))
+            futures.append(future)
+        chunks = await asyncio.gather(*futures)
+        return [np.concatenate([chunk[k] for chunk in chunks]) for k in range(len(chunks[0]))]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        carry = None
+        while True:
+            batch = [carry if carry is not None else await self.queue.get()]
+            carry = None
+            num_rows = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while num_rows < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if num_rows + len(item[0]) > self.max_batch_size:
+                    carry = item
+                    break
+                batch.append(item)
+                num_rows += len(item[0])
+
+            started = time.perf_counter()
+            self.queued_windows -= num_rows
+            x = np.concatenate([item[0] for item in batch])
+            try:
+                y_predict = await loop.run_in_executor(self.executor, self.model.predict_on_batch, x)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if not isinstance(y_predict, (list, tuple)):
+                y_predict = [y_predict]
+            y_predict = [np.asarray(output) for output in y_predict]
+
+            self.num_batches += 1
+            self.num_chunks += len(batch)
+            self.num_windows += num_rows
+            self.total_wait += sum(started - queued for _, _, queued in batch)
+
+            start = 0
+            for chunk, future, _ in batch:
+                stop = start + len(chunk)
+                if not future.done():
+                    future.set_result([output[start:stop] for output in y_predict])
+                start = stop
+
+    def fill_rate(self):
+        """ Mean share of max_batch_size the batches so far filled (float) """
+        return self.num_windows / (max(self.num_batches, 1) * self.max_batch_size)
+
+    def stats(self):
+        return {
+            "queue_windows": self.queued_windows,
+            "queue_chunks": self.queue.qsize() if self.queue is not None else 0,
+            "batches": self.num_batches,
+            "windows": self.num_windows,
+            "max_batch_size": self.max_batch_size,
+            "batch_fill_rate": self.fill_rate(),
+            "mean_queue_wait": self.total_wait / max(self.num_chunks, 1),
+        }
@@ -0,0 +1,329 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from featureExtraction import STREAM_MIN_SECONDS, DecodedAudio, spec_extraction, iter_spec_extraction
+from quantization import calc_tempo, refine_note
+from MIDI import note_to_segment_array, write_midi_if_changed
+from transcription_cache import TranscriptionCache
+from metrics import metrics, stage, start_breakdown
+
+# transcription cache of the current worker process, opened once by the initializer
+_worker_cache = None
+# bounded queue carrying the spectrogram windows of the decode workers to the model, inherited from the parent
+_worker_windows = None
+
+
+def _init_worker(cache_folder, path_weight, max_bytes, windows=None):
+    global _worker_cache, _worker_windows
+    if cache_folder is not None:
+        _worker_cache = TranscriptionCache(cache_folder, path_weight, max_bytes)
+    _worker_windows = windows
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _spec_blocks(audio, win_size, block_windows):
+    """ Model windows of a track, block_windows at a time
+
+    Long tracks stream them with iter_spec_extraction; a short track is cheaper
+    with the single STFT pass of spec_extraction, split into the same blocks.
+    """
+    if audio.duration > STREAM_MIN_SECONDS:
+        yield from iter_spec_extraction(audio, win_size, batch_windows=block_windows)
+        return
+    x_test = spec_extraction(audio, win_size)[0].astype(np.float32)
+    for start in range(0, len(x_test), block_windows):
+        yield x_test[start : start + block_windows]
+
+
+def _prepare_file(job_id, path, win_size, block_windows):
+    """ Decode stage: tempo and spectrogram windows of one file, or its cached transcription
+
+    The windows go to the parent through the shared queue, block_windows at a
+    time: the put waits while the model is behind, so the parent never holds the
+    windows of a whole file, and a worker only does for files shorter than
+    STREAM_MIN_SECONDS.
+    """
+    start = time.perf_counter()
+    waited = 0.0
+    # stage durations go back to the parent process with the result
+    stages = start_breakdown()
+    with stage("decode"):
+        audio = DecodedAudio.from_file(str(path))
+    key = cached = None
+    if _worker_cache is not None:
+        with stage("cache_lookup"):
+            key = _worker_cache.key(audio)
+            cached = _worker_cache.get(key)
+    if cached is not None:
+        _, tempo, segment = cached
+        return {"key": key, "tempo": tempo, "segment": segment, "stages": stages, "busy": time.perf_counter() - start}
+
+    with stage("calc_tempo"):
+        tempo = calc_tempo(audio)
+    num_windows = 0
+    blocks = _spec_blocks(audio, win_size, block_windows)
+    while True:
+        with stage("spec_extraction"):
+            x_block = next(blocks, None)
+        if x_block is None:
+            break
+        put_start = time.perf_counter()
+        _worker_windows.put((job_id, x_block))
+        waited += time.perf_counter() - put_start
+        num_windows += len(x_block)
+    return {"key": key, "tempo": tempo, "num_windows": num_windows, "stages": stages,
+            "busy": time.perf_counter() - start - waited}
+
+
+def _finish_file(fl_note, tempo, segment, key, midi_path):
+    """ Post-processing stage: refine the notes, cache them and write the MIDI file """
+    start = time.perf_counter()
+    stages = start_breakdown()
+    if segment is None:
+        with stage("refine_note"):
+            note = refine_note(fl_note, tempo)
+        with stage("note_to_segment"):
+            segment = note_to_segment_array(note)
+        if _worker_cache is not None and key is not None:
+            with stage("cache_write"):
+                _worker_cache.put(key, note, tempo, segment)
+    with stage("midi_write"):
+        written = write_midi_if_changed(segment, midi_path, tempo)
+    return {"written": written, "stages": stages, "busy": time.perf_counter() - start}
+
+
+class IngestPipeline:
+    """ Transcribe many audio files with the decode, inference and post-processing stages overlapped
+    ----------
+    Parameters:
+        ST: SingingTranscription, for the window size and the output decoding
+        decode_workers: processes decoding audio and computing spectrograms (int)
+        finish_workers: processes running refine_note and writing MIDI files (int)
+        batch_size: spectrogram windows per model call, taken across files (int)
+        max_wait: longest wait for more windows when a batch is not full, in seconds (float)
+        max_pending: files being decoded or transcribed, and finished ones waiting to be written (int)
+        block_windows: spectrogram windows per message from a decode worker (int)
+        max_pending_windows: windows waiting for the model across all files (int)
+        cache: TranscriptionCache shared with the workers, or None
+
+    The pools are forked when the pipeline is created, so create it before the
+    model is loaded: workers only need NumPy, librosa and the cache. The calling
+    thread holds the only model and fills every batch with windows of as many
+    files as needed, while the pools work on the files before and after it.
+    Windows travel in blocks through a queue of at most max_pending_windows, and
+    the model outputs are reduced to frame notes batch by batch, so the memory
+    held by spectrograms does not grow with the length of the files.
+    """
+
+    def __init__(self, ST, decode_workers=None, finish_workers=None, batch_size=256, max_wait=0.05, max_pending=None,
+                 block_windows=64, max_pending_windows=None, cache=None):
+        self.ST = ST
+        self.decode_workers = decode_workers or max(1, os.cpu_count() // 2)
+        self.finish_workers = finish_workers or max(1, os.cpu_count() // 4)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending or 2 * self.decode_workers
+        self.block_windows = block_windows
+        self.max_pending_windows = max_pending_windows or 2 * batch_size
+        self.cache = cache
+
+        if cache is not None:
+            initargs = (cache.cache_folder, cache.path_weight, cache.max_bytes)
+        else:
+            initargs = (None, None, None)
+        context = multiprocessing.get_context("fork")
+        self.windows = context.Queue(maxsize=max(1, self.max_pending_windows // block_windows))
+        self.decode_pool = ProcessPoolExecutor(
+            max_workers=self.decode_workers, mp_context=context, initializer=_init_worker,
+            initargs=initargs + (self.windows,)
+        )
+        self.finish_pool = ProcessPoolExecutor(
+            max_workers=self.finish_workers, mp_context=context, initializer=_init_worker, initargs=initargs
+        )
+        for pool, workers in ((self.decode_pool, self.decode_workers), (self.finish_pool, self.finish_workers)):
+            for future in [pool.submit(_worker_ready) for _ in range(workers)]:
+                future.result()
+
+    def run(self, model_ST, jobs):
+        """ Transcribe every job
+        ----------
+        Parameters:
+            model_ST: loaded transcription model (keras.Model)
+            jobs: (audio path, MIDI path) pairs (list)
+
+        ----------
+        Returns:
+            midi_paths: MIDI paths of the jobs that succeeded, in job order (list)
+            report: files per minute and utilization of each stage (dict)
+        """
+        start_time = time.perf_counter()
+        decode_slots = threading.BoundedSemaphore(self.max_pending)
+        finish_slots = threading.BoundedSemaphore(self.max_pending)
+        decoded = queue.Queue()
+        finish_futures = []
+        report = {"files": len(jobs), "cached": 0, "failed": 0, "written": 0}
+        busy = {"decode": 0.0, "inference": 0.0, "finish": 0.0}
+
+        def feed():
+            for job_id, (path, _) in enumerate(jobs):
+                decode_slots.acquire()
+                future = self.decode_pool.submit(_prepare_file, job_id, path, self.ST.window_size, self.block_windows)
+                future.add_done_callback(lambda f, job_id=job_id: decoded.put((job_id, f)))
+
+        def finish(job_id, fl_note, tempo, segment, key):
+            finish_slots.acquire()
+            future = self.finish_pool.submit(_finish_file, fl_note, tempo, segment, key, jobs[job_id][1])
+            future.add_done_callback(lambda f: finish_slots.release())
+            finish_futures.append((job_id, future))
+
+        def fail(job_id, error):
+            decode_slots.release()
+            report["failed"] += 1
+            metrics.record_error("ingest_prepare")
+            print(f"Error processing {os.path.basename(str(jobs[job_id][0]))}: {error}")
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        # files with windows on their way: job id -> [decode result once known, windows transcribed, note chunks]
+        active = {}
+        # failed files whose blocks may still be in the queue
+        dropped = set()
+        # (job id, windows) waiting for the model, in arrival order
+        pending = deque()
+        num_pending = 0
+        completed = 0
+
+        def complete(job_id):
+            nonlocal completed
+            result, num_done, chunks = active[job_id]
+            if result is None or num_done < result["num_windows"]:
+                return
+            del active[job_id]
+            completed += 1
+            if not chunks:
+                fail(job_id, "no audio frames")
+                return
+            decode_slots.release()
+            finish(job_id, np.concatenate(chunks), result["tempo"], None, result["key"])
+
+        def receive():
+            nonlocal completed
+            job_id, future = decoded.get_nowait()
+            try:
+                result = future.result()
+            except Exception as e:
+                active.pop(job_id, None)
+                dropped.add(job_id)
+                completed += 1
+                fail(job_id, e)
+                return
+            busy["decode"] += result["busy"]
+            metrics.record("ingest_prepare", result["busy"])
+            metrics.record_all(result["stages"])
+            if "segment" in result:
+                decode_slots.release()
+                completed += 1
+                report["cached"] += 1
+                finish(job_id, None, result["tempo"], result["segment"], result["key"])
+                return
+            active.setdefault(job_id, [None, 0, []])[0] = result
+            complete(job_id)
+
+        def take_windows(timeout):
+            nonlocal num_pending
+            job_id, x_block = self.windows.get(timeout=timeout)
+            if job_id in dropped:
+                return
+            active.setdefault(job_id, [None, 0, []])
+            pending.append((job_id, x_block))
+            num_pending += len(x_block)
+
+        while completed < len(jobs):
+            while True:
+                try:
+                    receive()
+                except queue.Empty:
+                    break
+            if completed == len(jobs):
+                break
+
+            # top the batch up with the windows the workers are about to send
+            deadline = time.perf_counter() + self.max_wait
+            while num_pending < self.batch_size:
+                timeout = deadline - time.perf_counter() if num_pending else self.max_wait
+                try:
+                    take_windows(max(timeout, 0.001))
+                except queue.Empty:
+                    break
+            if not num_pending:
+                continue
+
+            batch, owners, num_rows = [], [], 0
+            while pending and num_rows < self.batch_size:
+                job_id, x_block = pending.popleft()
+                take = min(self.batch_size - num_rows, len(x_block))
+                if take < len(x_block):
+                    pending.appendleft((job_id, x_block[take:]))
+                batch.append(x_block[:take])
+                owners.append((job_id, take))
+                num_rows += take
+            num_pending -= num_rows
+
+            started = time.perf_counter()
+            with stage("model_predict"):
+                y_predict = model_ST.predict_on_batch(np.concatenate(batch))
+            busy["inference"] += time.perf_counter() - started
+            if not isinstance(y_predict, (list, tuple)):
+                y_predict = [y_predict]
+            y_predict = [np.asarray(output) for output in y_predict]
+
+            # frame notes per file right away, the outputs of a batch are not kept
+            row = 0
+            for job_id, take in owners:
+                if job_id in active:
+                    notes = self.ST.decode_melody([output[row : row + take] for output in y_predict])
+                    active[job_id][1] += take
+                    active[job_id][2].append(notes)
+                    complete(job_id)
+                row += take
+
+        feeder.join()
+        midi_paths = []
+        for job_id, future in sorted(finish_futures, key=lambda x: x[0]):
+            try:
+                result = future.result()
+            except Exception as e:
+                report["failed"] += 1
+                metrics.record_error("ingest_finish")
+                print(f"Error processing {os.path.basename(str(jobs[job_id][0]))}: {e}")
+                continue
+            busy["finish"] += result["busy"]
+            metrics.record("ingest_finish", result["busy"])
+            metrics.record_all(result["stages"])
+            report["written"] += int(result["written"])
+            midi_paths.append(jobs[job_id][1])
+
+        elapsed = time.perf_counter() - start_time
+        report["seconds"] = elapsed
+        report["files_per_minute"] = 60 * len(jobs) / elapsed if elapsed > 0 else 0.0
+        report["utilization"] = {
+            "decode": busy["decode"] / (elapsed * self.decode_workers),
+            "inference": busy["inference"] / elapsed,
+            "finish": busy["finish"] / (elapsed * self.finish_workers),
+        }
+        return midi_paths, report
+
+    def close(self):
+        self.decode_pool.shutdown(wait=True)
+        self.finish_pool.shutdown(wait=True)
+        self.windows.close()
+        self.windows.join_thread()
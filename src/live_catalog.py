@@ -0,0 +1,248 @@
+import time
+import threading
+import numpy as np
+from matching import DEFAULT_ENGINE
+from catalog import MelodyCatalog, list_midi_files, parse_midi_folder
+from ngram_index import NgramIndex, recall_at_k
+from search import search_catalog, shortlist_search
+from search_pool import merge_results
+from metrics import stage
+
+
+class LayeredIndex:
+    """ N-gram candidates of a base index and of the songs added after it, without removed songs
+    ----------
+    Parameters:
+        base: NgramIndex of the base catalog
+        delta: NgramIndex of the added songs, numbered after the base songs
+        offset: number of songs of the base catalog (int)
+        removed: base song indices that must not be returned (array)
+    """
+
+    def __init__(self, base, delta, offset, removed):
+        self.base = base
+        self.delta = delta
+        self.offset = offset
+        self.removed = set(np.asarray(removed).tolist())
+
+    def candidates(self, pitch_intervals, shortlist=20, bucket=4):
+        """ As NgramIndex.candidates, over both layers (list) """
+        # ask for the removed songs on top, they are filtered out below
+        base = self.base.candidates(pitch_intervals, shortlist + len(self.removed), bucket)
+        base = [candidate for candidate in base if candidate[0] not in self.removed]
+        delta = [
+            (idx + self.offset, position, votes)
+            for idx, position, votes in self.delta.candidates(pitch_intervals, shortlist, bucket)
+        ]
+        return sorted(base + delta, key=lambda x: -x[2])[:shortlist]
+
+
+class CatalogSnapshot:
+    """ Immutable view of the searchable songs: a base catalog, the songs added since and the ones removed
+    ----------
+    Parameters:
+        base: memory-mapped catalog the search workers also map (MelodyCatalog)
+        base_index: NgramIndex of the base catalog
+        delta: songs added since the base was written (MelodyCatalog)
+        removed: base song indices whose file was deleted or replaced (array)
+
+    Song i < len(base) is base song i and song len(base) + j is delta song j, so
+    the snapshot can be passed wherever search_catalog and describe_hit take a
+    MelodyCatalog. A query keeps the snapshot it started with while newer ones
+    are swapped in.
+    """
+
+    def __init__(self, base, base_index, delta, removed):
+        self.base = base
+        self.base_index = base_index
+        self.delta = delta
+        self.removed = np.asarray(removed, dtype=np.int64)
+        self.delta_index = NgramIndex.build(delta, base_index.n, base_index.max_interval)
+        self.index = LayeredIndex(base_index, self.delta_index, len(base), self.removed)
+
+        live = np.ones(len(base), dtype=bool)
+        live[self.removed] = False
+        self.base_ids = np.flatnonzero(live)
+        self.delta_ids = np.arange(len(base), len(base) + len(delta))
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    @property
+    def num_songs(self):
+        """ Number of searchable songs (int) """
+        return len(self.base_ids) + len(self.delta_ids)
+
+    def live_ids(self):
+        return np.concatenate([self.base_ids, self.delta_ids])
+
+    def _locate(self, idx):
+        if idx < len(self.base):
+            return self.base, idx
+        return self.delta, idx - len(self.base)
+
+    @property
+    def songs(self):
+        return self.base.songs + self.delta.songs
+
+    def name(self, idx):
+        catalog, idx = self._locate(idx)
+        return catalog.name(idx)
+
+    def pitch_sequence(self, idx):
+        catalog, idx = self._locate(idx)
+        return catalog.pitch_sequence(idx)
+
+    def onset_sequence(self, idx):
+        catalog, idx = self._locate(idx)
+        return catalog.onset_sequence(idx)
+
+    def notes(self, idx):
+        catalog, idx = self._locate(idx)
+        return catalog.notes(idx)
+
+    def interval_bounds(self):
+        if self._bounds is None:
+            base, delta = self.base.interval_bounds(), self.delta.interval_bounds()
+            self._bounds = tuple(np.concatenate([b, d]) for b, d in zip(base, delta))
+        return self._bounds
+
+    def live_files(self):
+        """ {file name: [size, mtime_ns]} of the searchable songs (dict) """
+        songs = [self.base.songs[idx] for idx in self.base_ids] + self.delta.songs
+        return {song["file"]: [song["size"], song["mtime_ns"]] for song in songs}
+
+    def apply(self, midi_folder, files):
+        """ New snapshot matching a listing of the MIDI folder
+        ----------
+        Parameters:
+            midi_folder: folder of database .mid files (str)
+            files: {file name: [size, mtime_ns]}, as list_midi_files returns (dict)
+
+        ----------
+        Returns:
+            snapshot: CatalogSnapshot, self when nothing changed
+            changes: {"added": [...], "removed": [...]} file names (dict)
+
+        Only new and modified files are parsed. A modified base song is removed
+        and comes back as a delta song; delta songs are kept when unchanged.
+        """
+        live = self.live_files()
+        added = {name: stat for name, stat in files.items() if live.get(name) != stat}
+        removed = [name for name, stat in live.items() if files.get(name) != stat]
+        changes = {"added": sorted(added), "removed": sorted(set(removed) - set(added))}
+        if not added and not removed:
+            return self, changes
+
+        gone = set(removed)
+        base_removed = [idx for idx in self.base_ids if self.base.songs[idx]["file"] in gone]
+        removed_ids = np.union1d(self.removed, np.array(base_removed, dtype=np.int64))
+
+        keep = {song["file"]: [song["size"], song["mtime_ns"]] for song in self.delta.songs if song["file"] not in gone}
+        pitches, onsets, songs, _ = parse_midi_folder(midi_folder, keep, self.delta)
+        new_pitches, new_onsets, new_songs, _ = parse_midi_folder(midi_folder, added)
+        delta = MelodyCatalog.from_songs(pitches + new_pitches, onsets + new_onsets, songs + new_songs)
+        return CatalogSnapshot(self.base, self.base_index, delta, removed_ids), changes
+
+
+class LiveCatalog:
+    """ Keep the searchable snapshot in step with the MIDI folder
+    ----------
+    Parameters:
+        midi_folder: folder of database .mid files (str)
+        base: memory-mapped catalog loaded at startup (MelodyCatalog)
+        poll_interval: seconds between two scans of the folder, 0 to scan only on refresh() (float)
+
+    A background thread lists the folder every poll_interval seconds; when a file
+    was added, changed or deleted it parses only those files and swaps in a new
+    CatalogSnapshot. Readers take self.snapshot once per query and never lock.
+    """
+
+    def __init__(self, midi_folder, base, poll_interval=2.0):
+        self.midi_folder = midi_folder
+        self.poll_interval = poll_interval
+        empty = MelodyCatalog.from_songs([], [], [])
+        self.snapshot = CatalogSnapshot(base, NgramIndex.build(base), empty, [])
+        self.updates = 0
+        self.last_refresh = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """ Scan the folder and swap in a snapshot with the changes
+        ----------
+        Returns:
+            changes: {"added": [...], "removed": [...]} file names (dict)
+        """
+        with self._lock, stage("catalog_refresh"):
+            snapshot, changes = self.snapshot.apply(self.midi_folder, list_midi_files(self.midi_folder))
+            if snapshot is not self.snapshot:
+                self.snapshot = snapshot
+                self.updates += 1
+                print(f"Catalog updated: +{len(changes['added'])} -{len(changes['removed'])} songs")
+            self.last_refresh = time.time()
+        return changes
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing the catalog: {e}")
+
+    def start(self):
+        if self.poll_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "songs": snapshot.num_songs,
+            "base_songs": len(snapshot.base),
+            "added_songs": len(snapshot.delta),
+            "removed_songs": len(snapshot.removed),
+            "updates": self.updates,
+            "last_refresh": self.last_refresh,
+        }
+
+
+def search_snapshot(query, snapshot, top_k=None, engine=DEFAULT_ENGINE, max_distance=np.inf, shortlist=0,
+                    report_recall=False, pool=None):
+    """ Search the live songs of a snapshot with the n-gram shortlist, the worker pool or a full scan
+    ----------
+    Parameters:
+        query: [time, pitch] rows of the query (list or array)
+        snapshot: CatalogSnapshot
+        top_k/engine/max_distance: as in search_catalog
+        shortlist: re-score only this many n-gram candidates, 0 to scan every song (int)
+        report_recall: with shortlist, also run the full scan and report the recall of the shortlist (bool)
+        pool: SearchPool mapping snapshot.base, or None
+
+    ----------
+    Returns:
+        hits: (distance, song index, start, end) sorted by distance (list)
+        stats: as in search_catalog (dict)
+    """
+    options = {"top_k": top_k, "engine": engine, "max_distance": max_distance}
+    if shortlist:
+        hits, stats = shortlist_search(query, snapshot, snapshot.index, shortlist=shortlist, **options)
+        if report_recall:
+            exhaustive_hits, _ = search_catalog(query, snapshot, song_ids=snapshot.live_ids(), **options)
+            stats["recall"] = recall_at_k(hits, exhaustive_hits, top_k)
+        return hits, stats
+    if pool is not None:
+        # the workers map the base catalog, songs added since are scanned here
+        return merge_results([
+            pool.search(query, exclude=snapshot.removed, **options),
+            search_catalog(query, snapshot, song_ids=snapshot.delta_ids, **options),
+        ], top_k)
+    return search_catalog(query, snapshot, song_ids=snapshot.live_ids(), **options)
@@ -1,130 +1,154 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse
 import os
-import shutil
-import py_midicsv as pm
+import argparse
+import asyncio
+import contextvars
 import numpy as np
-from scipy.spatial.distance import euclidean
-from fastdtw import fastdtw
+from functools import partial
 import time
 import uvicorn
-from singing_transcription import SingingTranscription
+from typing import Optional
+from singing_transcription import SingingTranscription, BACKENDS
+from model_registry import ModelRegistry
+from transcription_cache import TranscriptionCache
 from pathlib import Path
-from model import *
 from featureExtraction import *
 from quantization import *
 from utils import *
 from MIDI import *
+from matching import *
+from catalog import load_or_build_catalog
+from search import describe_hit
+from search_pool import SearchPool
+from live_catalog import LiveCatalog, search_snapshot
+from shard_client import search_shards, broadcast
+from inference_scheduler import InferenceScheduler
+from metrics import metrics, stage, start_breakdown
+from profiling import PROFILE_MODES, SAMPLE_RATE, ThreadProfile, profiled
+from streaming import PCM_ENCODINGS, StreamingTranscriber
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
 
-UPLOAD_DIR = "src/input_voice"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-def midi_to_seconds(midi_file):
-    csv_data = pm.midi_to_csv(midi_file)
-    tempo = 500000
-    ticks_per_quarter_note = 480 
-
-    for line in csv_data:
-        if "Header" in line:
-            ticks_per_quarter_note = int(line.split(", ")[5])
-        if "Tempo" in line:
-            tempo = int(line.split(", ")[3])
-            break
-
-    seconds_per_tick = tempo / 1000 / ticks_per_quarter_note
-    return csv_data, seconds_per_tick, tempo
-
-def parse_midi_file(midi_file_path):
-    index = 0.0
-    csv_data, seconds_per_tick, tempo = midi_to_seconds(midi_file_path)
-    parsed_list = []
-    print('Output if come here')
-    for line in csv_data:
-        new_line = line.strip()
-        line_list = new_line.split(", ")
-        if line_list[2] == "Note_on_c" and line_list[5] != "0":
-            time_in_seconds = float(line_list[1]) * 1000000 / tempo
-            data = [index * 1000000 / tempo, int(line_list[4])]
-            index += 1
-            parsed_list.append(data)
-    return parsed_list
-
-def get_intervals(lst):
-    return [[lst[i+1][0] - lst[i][0], lst[i+1][1] - lst[i][1]] for i in range(len(lst) - 1)]
-
-def get_distance(query, database, window_size=5):
-    if not query or not database:
-        return float("inf")
-
-    min_q = min(sublist[1] for sublist in query)
-    min_d = min(sublist[1] for sublist in database)
-    new_query = [[x[0], x[1] - min_q] for x in query]
-    new_database = [[x[0], x[1] - min_d] for x in database]
-    int_query = get_intervals(new_query)
-    int_database = get_intervals(new_database)
-    len_query = len(int_query)
-    len_database = len(int_database)
-    
-    if len_query > len_database:
-        return float("inf")
-    
-    x = np.array(int_database)
-    y = np.array(int_query)
-    min_distance = float("inf")
-    
-    for i in range(len_database - len_query - window_size + 1):
-        new_x = x[i:i+len_query + window_size]
-        distance, path = fastdtw(y, new_x, dist=euclidean)
-        if distance < min_distance:
-            min_distance = distance
-    
-    return min_distance
-
-def compare_midi(query_file_path):
-    print('!!!!!!!!!!!!!')
-    print(query_file_path)
-    query_list = parse_midi_file(query_file_path)
-    print('parse query')
-    midi_files = [f for f in os.listdir("data1") if f.endswith(".mid")]
-    print(f'midi files {len(midi_files)}')
-    results = []
-
-    for midi_file in midi_files:
-        database_list = parse_midi_file(f"./data1/{midi_file}")
-        distance = get_distance(query_list, database_list)
-        if distance == float("inf"):
-            distance = 1e9
-        results.append({"file": midi_file, "distance": distance})
-    
-    results.sort(key=lambda x: x["distance"])
+MIDI_DIR = "data1"
+# "keras" or "tflite" (a model written by export_model.py), None takes the backend's file under data/
+MODEL_BACKEND = "keras"
+MODEL_PATH = None
+CATALOG_DIR = "data1_index"
+# seconds between two scans of MIDI_DIR for added, changed or deleted songs
+CATALOG_POLL_INTERVAL = 2.0
+# coordinator mode: shard servers holding the catalog (shard_server.py), none searches the local catalog
+SHARD_URLS = []
+SHARD_TIMEOUT = 2.0
+# worker processes scanning the catalog, 0 scans it inside the request handler
+SEARCH_WORKERS = 0
+# cross-request inference batching: windows per model call and longest wait for a batch to fill
+INFERENCE_BATCH_SIZE = 64
+INFERENCE_MAX_WAIT = 0.01
+# transcriptions shared with the ingestion service (app.py)
+TRANSCRIPTION_CACHE_DIR = "transcription_cache"
+TRANSCRIPTION_CACHE_MAX_BYTES = 512 * 2 ** 20
+# streaming search (/ws/compare): seconds between two searches of the growing query, and notes before the first
+STREAM_SEARCH_INTERVAL = 1.0
+STREAM_MIN_NOTES = 3
+# longest recording a stream transcribes, the answer for it is sent once it is reached
+STREAM_MAX_SECONDS = 60.0
+# requests sent with an X-Profile header are profiled into this folder, when the server allows it
+ALLOW_PROFILING = False
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_RATE = SAMPLE_RATE
+
+registry = ModelRegistry(MODEL_PATH, MODEL_BACKEND)
+live_catalog = None
+search_pool = None
+scheduler = None
+transcription_cache = None
+
+def compare_midi(query_list, snapshot, engine=DEFAULT_ENGINE, top_k=10, max_distance=None, shortlist=0,
+                 report_recall=False):
+    print(f'query notes {len(query_list)}')
+    with stage("match"):
+        if SHARD_URLS:
+            results, stats = search_shards(query_list, SHARD_URLS, top_k, engine, max_distance, shortlist,
+                                           SHARD_TIMEOUT, report_recall)
+        else:
+            print(f'midi files {snapshot.num_songs}')
+            if max_distance is None:
+                max_distance = float("inf")
+            hits, stats = search_snapshot(query_list, snapshot, top_k, engine, max_distance, shortlist,
+                                          report_recall, search_pool)
+
+            # songs that could not be matched never make it into the top-k
+            results = [describe_hit(snapshot, hit) for hit in hits if hit[0] != float("inf")]
+
+    metrics.increment("songs_matched", stats.get("dtw", 0))
 
     print('results:', results)
+    print('pruning:', stats)
+
+    return results, stats
 
-    return results
+async def transcribe_query(data, filename, debug_midi=False, output_folder="src/output", profile=None):
+    """ Transcribe an uploaded hum into the [time, pitch] rows the matcher takes
+    ----------
+    Parameters:
+        data: content of the uploaded audio file (bytes)
+        filename: name of the upload, used for the debug MIDI file (str)
+        debug_midi: also write the transcription to output_folder as MIDI (bool)
+        profile: ThreadProfile enabled around the steps run on executor threads, or None
 
-async def process_mp3_to_midi(mp3_path, output_folder="src/output"):
+    ----------
+    Returns:
+        query_list: [time, pitch] rows, as parse_midi_file would read them back (array)
+    """
     try:
-        ST = SingingTranscription()
-        model_ST = ST.load_model(f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", TF_summary=False)
+        ST = registry.ST
+        loop = asyncio.get_event_loop()
 
-        # Transcribing audio
-        fl_note = ST.predict_melody(model_ST, mp3_path)
+        async def blocking(function, *args):
+            if profile is not None:
+                return await loop.run_in_executor(None, profile.runcall, function, *args)
+            return await loop.run_in_executor(None, function, *args)
 
-        tempo = calc_tempo(mp3_path)
-        refined_fl_note = refine_note(fl_note, tempo)
-        segment = note_to_segment(refined_fl_note)
+        # Transcribing audio, windows of concurrent requests share model batches
+        # decode once, spectrogram and tempo take their own sampling rates from it
+        with stage("decode"):
+            audio = await blocking(DecodedAudio.from_bytes, data, "mp3")
+        with stage("cache_lookup"):
+            key = await blocking(transcription_cache.key, audio)
+            cached = await blocking(transcription_cache.get, key)
+        if cached is not None:
+            _, tempo, segment = cached
+        else:
+            with stage("spec_extraction"):
+                X_test = await blocking(ST.extract_features, audio)
+            # includes the wait for a shared batch
+            with stage("model_predict"):
+                y_predict = await scheduler.predict(X_test)
+            with stage("decode_melody"):
+                fl_note = await blocking(ST.decode_melody, y_predict)
 
-        filename = Path(mp3_path).stem
-        midi_path = os.path.join(output_folder, f"{filename}.mid")
-        segment_to_midi(segment, path_output=midi_path, tempo=tempo)
+            with stage("calc_tempo"):
+                tempo = await blocking(calc_tempo, audio)
+            with stage("refine_note"):
+                refined_fl_note = await blocking(refine_note, fl_note, tempo)
+            with stage("note_to_segment"):
+                segment = await blocking(note_to_segment_array, refined_fl_note)
+            with stage("cache_write"):
+                await blocking(transcription_cache.put, key, refined_fl_note, tempo, segment)
 
-        return midi_path
+        if debug_midi:
+            os.makedirs(output_folder, exist_ok=True)
+            midi_path = os.path.join(output_folder, f"{Path(filename).stem}.mid")
+            with stage("midi_write"):
+                segment_to_midi(segment, path_output=midi_path, tempo=tempo)
+            print(f"Saved {midi_path}")
+
+        return segments_to_query(segment, tempo)
 
     except Exception as e:
-        print(f"Error processing {mp3_path}: {e}")
+        print(f"Error processing {filename}: {e}")
         return None
 
 app.add_middleware(
@@ -135,38 +159,236 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def load_model():
+    global live_catalog, search_pool, scheduler, transcription_cache
+    if not SHARD_URLS:
+        with stage("catalog_load"):
+            catalog = load_or_build_catalog(MIDI_DIR, CATALOG_DIR)
+        # fork the search workers before the polling thread runs, a fork copies the locks other threads hold
+        if SEARCH_WORKERS > 0:
+            search_pool = SearchPool(CATALOG_DIR, SEARCH_WORKERS)
+        live_catalog = LiveCatalog(MIDI_DIR, catalog, CATALOG_POLL_INTERVAL)
+        live_catalog.start()
+    registry.load()
+    transcription_cache = TranscriptionCache(TRANSCRIPTION_CACHE_DIR, registry.path_weight, TRANSCRIPTION_CACHE_MAX_BYTES)
+    scheduler = InferenceScheduler(registry.get(), max_batch_size=INFERENCE_BATCH_SIZE, max_wait=INFERENCE_MAX_WAIT)
+    await scheduler.start()
+
+@app.on_event("shutdown")
+async def close_search_pool():
+    if live_catalog is not None:
+        live_catalog.stop()
+    if search_pool is not None:
+        search_pool.close()
+    if scheduler is not None:
+        await scheduler.stop()
+
+@app.get("/status/")
+def status():
+    return {
+        "model": registry.stats(),
+        "catalog_size": live_catalog.snapshot.num_songs if live_catalog is not None else None,
+        "catalog": live_catalog.stats() if live_catalog is not None else None,
+        "shards": SHARD_URLS,
+        "inference": scheduler.stats() if scheduler is not None else None,
+        "transcription_cache": transcription_cache.stats() if transcription_cache is not None else None,
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """ Duration, count and errors of each query stage, in the Prometheus text format """
+    return metrics.render()
+
+@app.post("/reload/")
+async def reload_catalog():
+    """ Pick up the songs added to or removed from MIDI_DIR without waiting for the next scan """
+    loop = asyncio.get_event_loop()
+    if SHARD_URLS:
+        responses, errors = await loop.run_in_executor(None, broadcast, SHARD_URLS, "/reload/", {}, SHARD_TIMEOUT)
+        return {"shards": responses, "failed": errors}
+    changes = await loop.run_in_executor(None, live_catalog.refresh)
+    return {"changes": changes, "catalog": live_catalog.stats()}
+
 @app.post("/compare/")
-async def upload_and_compare(file: UploadFile = File(...)):
+async def upload_and_compare(file: UploadFile = File(...), engine: str = DEFAULT_ENGINE, top_k: int = 10,
+                             max_distance: Optional[float] = None, shortlist: int = 0,
+                             report_recall: bool = False, debug_midi: bool = False, stages: bool = False,
+                             x_profile: Optional[str] = Header(None), x_profile_rate: Optional[float] = Header(None)):
     if not file.filename.endswith(".mp3"):
         raise HTTPException(status_code=400, detail="Only MP3 files are supported")
+    if engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown engine '{engine}', expected one of {ENGINES}")
+    if top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1")
+    if shortlist < 0:
+        raise HTTPException(status_code=400, detail="shortlist must not be negative")
+    if x_profile and not ALLOW_PROFILING:
+        raise HTTPException(status_code=403, detail="Profiling is disabled, start the server with --allow-profiling")
+    if x_profile and x_profile not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown X-Profile '{x_profile}', expected one of {PROFILE_MODES}")
+    if x_profile_rate is not None and x_profile_rate <= 0:
+        raise HTTPException(status_code=400, detail="X-Profile-Rate must be positive")
     
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
+    breakdown = start_breakdown()
+    with stage("upload"):
+        data = await file.read()
+
     try:
+        loop = asyncio.get_event_loop()
         start_time = time.time()
-        midi_file_path = await process_mp3_to_midi(file_path)
-        if not midi_file_path:
-            raise HTTPException(status_code=500, detail="Failed to convert MP3 to MIDI")
-        
-        results = compare_midi(midi_file_path)
+        label = f"compare-{Path(file.filename).stem}"
+        # cProfile runs in the worker threads around this request's steps, the sampler watches every thread
+        profile = ThreadProfile(label, PROFILE_DIR) if x_profile == "cprofile" else None
+        match = compare_midi if profile is None else partial(profile.runcall, compare_midi)
+        try:
+            with profiled(label, "sample" if x_profile == "sample" else None,
+                          x_profile_rate or PROFILE_SAMPLE_RATE, PROFILE_DIR) as profile_path:
+                query_list = await transcribe_query(data, file.filename, debug_midi=debug_midi, profile=profile)
+                if query_list is None:
+                    raise HTTPException(status_code=500, detail="Failed to transcribe the MP3 file")
+
+                # one snapshot for the whole query, catalog updates swap in a new one
+                snapshot = live_catalog.snapshot if live_catalog is not None else None
+                # the scan or the shard fan-out blocks, keep the event loop serving the other requests;
+                # the copied context keeps the match stage in this request's breakdown
+                results, pruning = await loop.run_in_executor(
+                    None, contextvars.copy_context().run, match, query_list, snapshot, engine, top_k,
+                    max_distance, shortlist, report_recall
+                )
+        finally:
+            if profile is not None:
+                profile_path = profile.dump()
         end_time = time.time()
         
-        return {
+        response = {
             "query_file": file.filename,
+            "engine": engine,
             "results": results,
+            "pruning": pruning,
             "execution_time": end_time - start_time
         }
+        if stages:
+            # seconds spent in each stage by this request
+            response["stages"] = breakdown
+        if profile_path is not None:
+            response["profile"] = profile_path
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        shutil.rmtree(UPLOAD_DIR)
-        os.makedirs(UPLOAD_DIR)
-        output_dir = "src/output"
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        os.makedirs(output_dir)
+
+@app.websocket("/ws/compare")
+async def stream_compare(websocket: WebSocket, sample_rate: int = 16000, encoding: str = "pcm_s16le",
+                         engine: str = DEFAULT_ENGINE, top_k: int = 10, max_distance: Optional[float] = None,
+                         shortlist: int = 0):
+    """ Search while the hum is being recorded
+
+    The client sends mono PCM chunks as binary messages and the text message
+    "end" when the recording stops. Each complete 31-frame window goes through
+    the model as soon as it arrives; at most every STREAM_SEARCH_INTERVAL seconds
+    the query transcribed so far is searched and the top-k is pushed back as
+    {"type": "partial", ...}. After "end" the last frames are transcribed and the
+    answer of the whole recording comes as {"type": "final", ...}; a recording
+    reaching STREAM_MAX_SECONDS ends there, with "truncated": true.
+    """
+    await websocket.accept()
+    error = None
+    if encoding not in PCM_ENCODINGS:
+        error = f"Unknown encoding '{encoding}', expected one of {tuple(PCM_ENCODINGS)}"
+    elif engine not in ENGINES:
+        error = f"Unknown engine '{engine}', expected one of {ENGINES}"
+    elif top_k < 1 or shortlist < 0 or sample_rate <= 0:
+        error = "top_k and sample_rate must be positive, shortlist must not be negative"
+    if error is not None:
+        await websocket.send_json({"type": "error", "detail": error})
+        await websocket.close(code=1003)
+        return
+
+    loop = asyncio.get_event_loop()
+    stream = StreamingTranscriber(registry.ST, sample_rate, encoding, max_seconds=STREAM_MAX_SECONDS)
+    start_time = time.time()
+    last_search = 0.0
+    last_query = None
+
+    async def infer(ids, x):
+        if ids:
+            with stage("model_predict"):
+                y_predict = await scheduler.predict(x)
+            stream.update(ids, y_predict)
+
+    async def search(final):
+        nonlocal last_query
+        with stage("stream_transcription"):
+            query_list = await loop.run_in_executor(None, stream.query)
+        if not final and (len(query_list) < STREAM_MIN_NOTES or
+                          (last_query is not None and np.array_equal(query_list, last_query))):
+            return
+        last_query = query_list
+        results, pruning = [], {}
+        if len(query_list) > 0:
+            snapshot = live_catalog.snapshot if live_catalog is not None else None
+            results, pruning = await loop.run_in_executor(
+                None, compare_midi, query_list, snapshot, engine, top_k, max_distance, shortlist
+            )
+        await websocket.send_json({
+            "type": "final" if final else "partial",
+            "audio_seconds": stream.duration,
+            "truncated": stream.full,
+            "query_notes": len(query_list),
+            "results": results,
+            "pruning": pruning,
+            "execution_time": time.time() - start_time,
+        })
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                with stage("stream_framing"):
+                    ids, x = await loop.run_in_executor(None, stream.push, message["bytes"])
+                await infer(ids, x)
+                if stream.full:
+                    break
+                if time.time() - last_search >= STREAM_SEARCH_INTERVAL:
+                    last_search = time.time()
+                    await search(final=False)
+            elif message.get("text") == "end":
+                break
+
+        ids, x = await loop.run_in_executor(None, stream.finish)
+        await infer(ids, x)
+        await search(final=True)
+        await websocket.close()
+    except WebSocketDisconnect:
+        print(f"Stream closed by the client after {stream.duration:.1f}s of audio")
+    except Exception as e:
+        print(f"Error streaming: {e}")
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close(code=1011)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes for the catalog scan (0: scan in the request handler)")
+    parser.add_argument("--shards", default="", help="Comma-separated URLs of shard servers, search them instead of the local catalog")
+    parser.add_argument("--shard-timeout", type=float, default=SHARD_TIMEOUT, help="Seconds to wait for each shard before answering without it")
+    parser.add_argument("--backend", choices=BACKENDS, default=MODEL_BACKEND, help="Inference backend of the transcription model")
+    parser.add_argument("--model", default=MODEL_PATH, help="Weights (keras) or .tflite file (tflite) to load")
+    parser.add_argument("--allow-profiling", action="store_true", help="Honour the X-Profile header of /compare/ requests")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="Folder of the profiles of requests sent with an X-Profile header")
+    parser.add_argument("--profile-rate", type=float, default=PROFILE_SAMPLE_RATE, help="Samples per second of X-Profile: sample")
+    args = parser.parse_args()
+    SEARCH_WORKERS = args.workers
+    SHARD_URLS = [url for url in args.shards.split(",") if url]
+    SHARD_TIMEOUT = args.shard_timeout
+    ALLOW_PROFILING = args.allow_profiling
+    PROFILE_DIR = args.profile_dir
+    MODEL_BACKEND = args.backend
+    MODEL_PATH = args.model
+    registry = ModelRegistry(MODEL_PATH, MODEL_BACKEND)
+    PROFILE_SAMPLE_RATE = args.profile_rate
+
     uvicorn.run(app, host="127.0.0.1", port=8001)
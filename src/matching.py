@@ -0,0 +1,168 @@
+import numpy as np
+import py_midicsv as pm
+from scipy.spatial.distance import euclidean
+from fastdtw import fastdtw
+from dtw import subsequence_dtw
+
+ENGINES = ("subsequence", "fastdtw")
+DEFAULT_ENGINE = "subsequence"
+
+
+def midi_to_seconds(midi_file):
+    csv_data = pm.midi_to_csv(midi_file)
+    tempo = 500000
+    ticks_per_quarter_note = 480 
+
+    for line in csv_data:
+        if "Header" in line:
+            ticks_per_quarter_note = int(line.split(", ")[5])
+        if "Tempo" in line:
+            tempo = int(line.split(", ")[3])
+            break
+
+    seconds_per_tick = tempo / 1000 / ticks_per_quarter_note
+    return csv_data, seconds_per_tick, tempo
+
+def parse_midi_file(midi_file_path):
+    index = 0.0
+    csv_data, seconds_per_tick, tempo = midi_to_seconds(midi_file_path)
+    parsed_list = []
+    print('Output if come here')
+    for line in csv_data:
+        new_line = line.strip()
+        line_list = new_line.split(", ")
+        if line_list[2] == "Note_on_c" and line_list[5] != "0":
+            time_in_seconds = float(line_list[1]) * 1000000 / tempo
+            data = [index * 1000000 / tempo, int(line_list[4])]
+            index += 1
+            parsed_list.append(data)
+    return parsed_list
+
+def parse_midi_notes(midi_file_path):
+    """ Read the note-on events of a .mid without building the [time, pitch] list
+    ----------
+    Parameters:
+        midi_file_path: '.mid' (str)
+
+    ----------
+    Returns:
+        pitches: MIDI note numbers (array)
+        onsets: note-on times in seconds (array)
+        tempo: microseconds per quarter note (int)
+    """
+    csv_data, _, tempo = midi_to_seconds(midi_file_path)
+    ticks_per_quarter_note = 480
+    pitches = []
+    onsets = []
+    for line in csv_data:
+        line_list = line.strip().split(", ")
+        if line_list[2] == "Header":
+            ticks_per_quarter_note = int(line_list[5])
+        elif line_list[2] == "Note_on_c" and line_list[5] != "0":
+            onsets.append(int(line_list[1]) * tempo / 1000000 / ticks_per_quarter_note)
+            pitches.append(int(line_list[4]))
+    return np.array(pitches, dtype=np.int16), np.array(onsets, dtype=np.float32), tempo
+
+
+def notes_from_pitches(pitches, tempo):
+    """ Build the same [time, pitch] rows parse_midi_file returns
+    ----------
+    Parameters:
+        pitches: MIDI note numbers (array)
+        tempo: microseconds per quarter note (int)
+
+    ----------
+    Returns:
+        notes: [index * 1e6 / tempo, pitch] (array, shape (n, 2))
+    """
+    notes = np.empty((len(pitches), 2))
+    notes[:, 0] = np.arange(len(pitches), dtype=np.float64) * 1000000 / tempo
+    notes[:, 1] = pitches
+    return notes
+
+
+def midi_tempo(bpm, resolution=220):
+    """ Microseconds per quarter note that segment_to_midi writes for a tempo
+    ----------
+    Parameters:
+        bpm: tempo as returned by calc_tempo (float or array)
+        resolution: ticks per quarter note of pretty_midi (int)
+
+    ----------
+    Returns:
+        tempo: microseconds per quarter note (int)
+    """
+    tick_scale = 60.0 / (int(np.squeeze(bpm)) * resolution)
+    return int(6e7 / (60.0 / (tick_scale * resolution)))
+
+
+def segments_to_query(segments, bpm):
+    """ [time, pitch] rows parse_midi_file would read back from segment_to_midi's file
+    ----------
+    Parameters:
+        segments: [start(s),end(s),pitch] rows (array or list)
+        bpm: tempo passed to segment_to_midi (float or array)
+
+    ----------
+    Returns:
+        notes: [index * 1e6 / tempo, pitch] (array, shape (n, 2))
+    """
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 3)
+    return notes_from_pitches(segments[:, 2], midi_tempo(bpm))
+
+
+def get_intervals(lst):
+    return [[lst[i+1][0] - lst[i][0], lst[i+1][1] - lst[i][1]] for i in range(len(lst) - 1)]
+
+def sliding_fastdtw(int_query, int_database, window_size=5):
+    x = np.array(int_database)
+    y = np.array(int_query)
+    len_query = len(y)
+    min_distance = float("inf")
+    best_start = None
+
+    for i in range(len(x) - len_query - window_size + 1):
+        new_x = x[i:i+len_query + window_size]
+        distance, path = fastdtw(y, new_x, dist=euclidean)
+        if distance < min_distance:
+            min_distance = distance
+            best_start = i
+
+    if best_start is None:
+        return min_distance, None, None
+    return min_distance, best_start, best_start + len_query + window_size - 1
+
+def match_melody(query, database, window_size=5, engine=DEFAULT_ENGINE):
+    """ Match the query intervals against a database song
+    ----------
+    Parameters:
+        query: [time, pitch] rows of the query (list or array)
+        database: [time, pitch] rows of the database song (list or array)
+        window_size: extra intervals per fastdtw window (int)
+        engine: "subsequence" or "fastdtw" (str)
+
+    ----------
+    Returns:
+        distance: DTW distance, inf if the song cannot be matched (float)
+        start/end: first/last matched interval index in the song (int or None)
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown DTW engine '{engine}', expected one of {ENGINES}")
+    if len(query) == 0 or len(database) == 0:
+        return float("inf"), None, None
+
+    # pitch intervals do not depend on the pitch offset, no need to shift by the minimum
+    int_query = np.diff(np.asarray(query, dtype=np.float64), axis=0)
+    int_database = np.diff(np.asarray(database, dtype=np.float64), axis=0)
+    len_query = len(int_query)
+    len_database = len(int_database)
+
+    if len_query == 0 or len_query > len_database:
+        return float("inf"), None, None
+
+    if engine == "fastdtw":
+        return sliding_fastdtw(int_query, int_database, window_size)
+    return subsequence_dtw(int_query, int_database)
+
+def get_distance(query, database, window_size=5, engine=DEFAULT_ENGINE):
+    return match_melody(query, database, window_size, engine)[0]
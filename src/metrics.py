@@ -0,0 +1,185 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stage durations of the request being handled, when it asked for a breakdown
+_breakdown = contextvars.ContextVar("stage_breakdown", default=None)
+
+
+class StageMetrics:
+    """ Durations, counts and errors of each pipeline stage, shared by all requests of a process
+    ----------
+    Parameters:
+        prefix: prefix of the exported metric names (str)
+        buckets: upper bounds of the duration histogram, in seconds (tuple)
+    """
+
+    def __init__(self, prefix="hum2song", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0, "errors": 0}
+        return stage
+
+    def record(self, name, seconds, error=False):
+        """ Add one run of a stage """
+        with self._lock:
+            stage = self._stage(name)
+            for k, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stage["buckets"][k] += 1
+            stage["count"] += 1
+            stage["sum"] += seconds
+            stage["errors"] += int(error)
+            breakdown = _breakdown.get()
+            if breakdown is not None:
+                breakdown[name] = breakdown.get(name, 0.0) + seconds
+
+    def record_error(self, name):
+        """ Count an error of a stage that was timed elsewhere, e.g. in a worker process that raised """
+        with self._lock:
+            stage = self._stage(name)
+            stage["errors"] += 1
+
+    def record_all(self, durations):
+        """ Add one run of each stage of a {stage: seconds} breakdown, e.g. returned by a worker process """
+        for name, seconds in durations.items():
+            self.record(name, seconds)
+
+    def drain(self):
+        """ Take the metrics recorded so far and start again from zero, e.g. in a worker process
+            that sends them to the parent with its result (dict) """
+        with self._lock:
+            drained = {"stages": self.stages, "counters": self.counters}
+            self.stages = {}
+            self.counters = {}
+        return drained
+
+    def merge(self, drained):
+        """ Add metrics another process drained """
+        with self._lock:
+            breakdown = _breakdown.get()
+            for name, other in drained["stages"].items():
+                stage = self._stage(name)
+                stage["buckets"] = [a + b for a, b in zip(stage["buckets"], other["buckets"])]
+                stage["count"] += other["count"]
+                stage["sum"] += other["sum"]
+                stage["errors"] += other["errors"]
+                if breakdown is not None:
+                    breakdown[name] = breakdown.get(name, 0.0) + other["sum"]
+            for name, value in drained["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def totals(self, *names):
+        """ StageTotals adding up the pieces of stages that run interleaved, e.g. block by block """
+        return StageTotals(self, names)
+
+    def gauge(self, name, read, help=""):
+        """ Export the value read() returns when the metrics are rendered, e.g. a queue length;
+            registering a name again replaces its function """
+        with self._lock:
+            self.gauges[name] = (read, help)
+
+    def increment(self, name, value=1):
+        """ Add to a counter, e.g. the number of songs matched """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the body as one run of a stage; an exception is counted as an error and raised again """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format (str) """
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self.stages.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} Duration of each pipeline stage.", f"# TYPE {name} histogram"]
+        for stage_name, stage in sorted(stages.items()):
+            for bound, count in zip(self.buckets, stage["buckets"]):
+                lines.append(f'{name}_bucket{{stage="{stage_name}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage_name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage_name}"}} {stage["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage_name}"}} {stage["count"]}')
+
+        name = f"{self.prefix}_stage_errors_total"
+        lines += [f"# HELP {name} Runs of each pipeline stage that raised.", f"# TYPE {name} counter"]
+        for stage_name, stage in sorted(stages.items()):
+            lines.append(f'{name}{{stage="{stage_name}"}} {stage["errors"]}')
+
+        for counter_name, value in sorted(counters.items()):
+            name = f"{self.prefix}_{counter_name}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+
+        for gauge_name, (read, help) in sorted(gauges.items()):
+            name = f"{self.prefix}_{gauge_name}"
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines += [f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+
+class StageTotals:
+    """ Stages timed in several pieces and recorded as one run each
+    ----------
+    Parameters:
+        metrics: StageMetrics the totals are recorded to
+        names: stages to add up (tuple)
+    """
+
+    def __init__(self, metrics, names):
+        self.metrics = metrics
+        self.seconds = dict.fromkeys(names, 0.0)
+
+    @contextmanager
+    def stage(self, name):
+        """ Time one piece of a stage; an exception records the stage as failed and is raised again """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.metrics.record(name, self.seconds.pop(name) + time.perf_counter() - start, error=True)
+            raise
+        self.seconds[name] += time.perf_counter() - start
+
+    def record(self):
+        self.metrics.record_all(self.seconds)
+
+
+# metrics of this process
+metrics = StageMetrics()
+
+
+def stage(name):
+    """ metrics.stage(name), see StageMetrics.stage """
+    return metrics.stage(name)
+
+
+def start_breakdown():
+    """ Collect the stage durations of the current request (or task) into a new dict, returned """
+    breakdown = {}
+    _breakdown.set(breakdown)
+    return breakdown
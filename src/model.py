@@ -1,5 +1,7 @@
 # import keras.backend as KK
 import math
+import numpy as np
+import tensorflow as tf
 from tensorflow.keras import backend as K
 from tensorflow.keras.regularizers import l2
 from tensorflow.keras.models import Model
@@ -137,3 +139,48 @@ def melody_ResNet_JDC(num_spec, window_size, note_res):
     model = Model(inputs=input, outputs=[output, output_V_F])
 
     return model
+
+
+# --------------------------------------------------------------------------------
+class InferenceModel:
+    """ Forward pass of a loaded melody_ResNet_JDC restricted to the requested heads
+    ----------
+    Parameters:
+        model: melody_ResNet_JDC with its weights loaded (keras.Model)
+        outputs: names of the output layers to compute, "output" (notes), "output_V" (voicing)
+                 or "output_AUX_V" (auxiliary voicing) (tuple)
+
+    The sub-model shares the layers (and weights) of model but only keeps what the
+    requested heads depend on: with ("output",) the fused voicing head and its
+    auxiliary softmax are not computed. It runs in inference mode, so Dropout is a
+    no-op, through one tf.function traced for a (None, window_size, num_spec, 1)
+    float32 input: any number of windows reuses the same graph. predict and
+    predict_on_batch return one array per requested head, like keras.Model.
+    """
+
+    def __init__(self, model, outputs=("output",)):
+        self.outputs = tuple(outputs)
+        self.model = Model(inputs=model.input, outputs=[model.get_layer(name).output for name in self.outputs])
+        signature = [tf.TensorSpec(shape=(None,) + tuple(model.input.shape[1:]), dtype=tf.float32)]
+        self._forward = tf.function(lambda x: self.model(x, training=False), input_signature=signature)
+
+    def predict_on_batch(self, x):
+        y_predict = self._forward(tf.convert_to_tensor(np.asarray(x, dtype=np.float32)))
+        if not isinstance(y_predict, (list, tuple)):
+            y_predict = [y_predict]
+        return [output.numpy() for output in y_predict]
+
+    def predict(self, x, batch_size=64, verbose=0):
+        blocks = [self.predict_on_batch(x[start : start + batch_size]) for start in range(0, len(x), batch_size)]
+        return [np.concatenate([block[k] for block in blocks]) for k in range(len(blocks[0]))]
+
+    def tracing_count(self):
+        """ Number of times the forward function was traced, 1 once warmed up (int) """
+        return self._forward.experimental_get_tracing_count()
+
+
+def melody_ResNet_JDC_inference(num_spec, window_size, note_res, path_weight, outputs=("output",)):
+    """ InferenceModel over the weights of a trained melody_ResNet_JDC """
+    model = melody_ResNet_JDC(num_spec, window_size, note_res)
+    model.load_weights(path_weight)
+    return InferenceModel(model, outputs)
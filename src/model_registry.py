@@ -0,0 +1,60 @@
+import time
+import threading
+import numpy as np
+from singing_transcription import SingingTranscription
+
+
+class ModelRegistry:
+    """ Load the transcription model once and share it across requests
+    ----------
+    Parameters:
+        path_weight: path of the model weights (str), defaults to the file of the backend under data/
+        backend: "keras" or "tflite" (str)
+    """
+
+    def __init__(self, path_weight=None, backend="keras"):
+        self.ST = SingingTranscription(backend)
+        if path_weight is None:
+            path_weight = self.ST.default_weight_path()
+        self.path_weight = path_weight
+        self.model = None
+        self.load_time = None
+        self.warmup_time = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Build the graph, load the weights and run one warm-up predict
+        ----------
+        Returns:
+            model: ready-to-use melody_ResNet_JDC (InferenceModel or TFLiteModel)
+        """
+        with self._lock:
+            if self.model is not None:
+                return self.model
+
+            start = time.perf_counter()
+            # only the note head, decode_melody does not read the voicing outputs
+            model = self.ST.load_inference_model(self.path_weight)
+            self.load_time = time.perf_counter() - start
+
+            # the first predict traces the forward function, keep it out of the request path
+            start = time.perf_counter()
+            x_warmup = np.zeros((1, self.ST.window_size, self.ST.num_spec, 1), dtype=np.float32)
+            model.predict(x_warmup, batch_size=self.ST.batch_size)
+            self.warmup_time = time.perf_counter() - start
+
+            self.model = model
+            print(f"Model loaded in {self.load_time:.3f}s, warm-up took {self.warmup_time:.3f}s")
+        return self.model
+
+    def get(self):
+        return self.load()
+
+    def stats(self):
+        return {
+            "loaded": self.model is not None,
+            "backend": self.ST.backend,
+            "path_weight": str(self.path_weight),
+            "load_time": self.load_time,
+            "warmup_time": self.warmup_time,
+        }
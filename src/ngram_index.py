@@ -0,0 +1,123 @@
+import numpy as np
+
+
+def quantize_intervals(pitch_intervals, max_interval):
+    """ Round pitch intervals and clip them to [-max_interval, max_interval] """
+    return np.clip(np.rint(pitch_intervals), -max_interval, max_interval).astype(np.int64) + max_interval
+
+
+def ngram_codes(symbols, n, base):
+    """ Encode every run of n consecutive symbols as one integer """
+    num_ngrams = len(symbols) - n + 1
+    if num_ngrams <= 0:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(num_ngrams, dtype=np.int64)
+    for k in range(n):
+        codes = codes * base + symbols[k : k + num_ngrams]
+    return codes
+
+
+class NgramIndex:
+    """ Inverted index from quantized pitch-interval n-grams to (song, position)
+    ----------
+    Parameters:
+        codes: sorted n-gram codes, one per posting (array)
+        songs: catalog index of each posting (array)
+        positions: interval index of the n-gram inside its song (array)
+        n: n-gram length in intervals (int)
+        max_interval: intervals are clipped to +/- this many semitones (int)
+    """
+
+    def __init__(self, codes, songs, positions, n=3, max_interval=5):
+        self.codes = codes
+        self.songs = songs
+        self.positions = positions
+        self.n = n
+        self.max_interval = max_interval
+        self.base = 2 * max_interval + 1
+
+    @classmethod
+    def build(cls, catalog, n=3, max_interval=5):
+        """ Index every n-gram of the catalog
+        ----------
+        Parameters:
+            catalog: MelodyCatalog
+            n: n-gram length in intervals (int)
+            max_interval: intervals are clipped to +/- this many semitones (int)
+
+        ----------
+        Returns:
+            index: NgramIndex
+        """
+        base = 2 * max_interval + 1
+        pitches = np.asarray(catalog.pitches, dtype=np.float64)
+        counts = np.diff(catalog.offsets)
+        song_of_note = np.repeat(np.arange(len(catalog)), counts)
+
+        codes = ngram_codes(quantize_intervals(np.diff(pitches), max_interval), n, base)
+        # an n-gram starting at interval k spans notes k..k+n, all of the same song
+        first = np.arange(len(codes))
+        valid = song_of_note[first] == song_of_note[first + n] if len(codes) else np.zeros(0, dtype=bool)
+        first = first[valid]
+        songs = song_of_note[first]
+        positions = first - catalog.offsets[songs]
+
+        order = np.argsort(codes[valid], kind="stable")
+        return cls(codes[valid][order], songs[order], positions[order], n, max_interval)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def candidates(self, pitch_intervals, shortlist=20, bucket=4):
+        """ Rank songs and offsets by the number of n-grams shared with the query
+        ----------
+        Parameters:
+            pitch_intervals: pitch intervals of the query (array)
+            shortlist: number of songs to return (int)
+            bucket: hits whose offsets differ by less than this vote together (int)
+
+        ----------
+        Returns:
+            candidates: (song index, offset, votes) best first (list)
+
+        A hit of query n-gram q at song position p votes for the alignment
+        offset p - q; hits on the same diagonal (within a bucket) pile up when
+        a whole passage matches, while scattered hits stay weak.
+        """
+        query_codes = ngram_codes(quantize_intervals(pitch_intervals, self.max_interval), self.n, self.base)
+        if len(query_codes) == 0 or len(self.codes) == 0:
+            return []
+
+        lo = np.searchsorted(self.codes, query_codes, side="left")
+        hi = np.searchsorted(self.codes, query_codes, side="right")
+        num_hits = hi - lo
+        if num_hits.sum() == 0:
+            return []
+
+        # posting indices of every hit, without a loop over the query n-grams
+        query_pos = np.repeat(np.arange(len(query_codes)), num_hits)
+        hit_start = np.repeat(lo - np.cumsum(num_hits) + num_hits, num_hits)
+        postings = hit_start + np.arange(num_hits.sum())
+        songs = self.songs[postings]
+        offsets = self.positions[postings] - query_pos
+
+        keys = np.stack([songs, offsets // bucket], axis=1)
+        cells, votes = np.unique(keys, axis=0, return_counts=True)
+
+        # keep the best diagonal of each song, then the best songs
+        order = np.lexsort((-votes, cells[:, 0]))
+        cells, votes = cells[order], votes[order]
+        first_of_song = np.ones(len(cells), dtype=bool)
+        first_of_song[1:] = cells[1:, 0] != cells[:-1, 0]
+        cells, votes = cells[first_of_song], votes[first_of_song]
+        best = np.argsort(-votes, kind="stable")[:shortlist]
+        return [(int(cells[i, 0]), int(cells[i, 1] * bucket), int(votes[i])) for i in best]
+
+
+def recall_at_k(hits, reference_hits, k):
+    """ Fraction of the reference top-k songs that are also in the top-k hits """
+    reference = {idx for _, idx, _, _ in reference_hits[:k]}
+    if not reference:
+        return 1.0
+    found = {idx for _, idx, _, _ in hits[:k]}
+    return len(reference & found) / len(reference)
@@ -0,0 +1,161 @@
+import os
+import re
+import sys
+import time
+import cProfile
+import threading
+import itertools
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+PROFILE_MODES = ("cprofile", "sample")
+PROFILE_DIR = "profiles"
+# samples per second of the sampling profiler
+SAMPLE_RATE = 200
+
+_dump_ids = itertools.count()
+
+
+def dump_path(output_dir, label, extension):
+    """ New file of the dump directory for one profiled unit of work (str) """
+    os.makedirs(output_dir, exist_ok=True)
+    label = re.sub(r"[^A-Za-z0-9_.-]+", "_", label)[:80] or "profile"
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(output_dir, f"{label}-{stamp}-{os.getpid()}-{next(_dump_ids)}.{extension}")
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # ';' separates frames and the last space separates the count in the collapsed format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class StackSampler:
+    """ Sampling profiler counting the call stacks of every thread of the process
+    ----------
+    Parameters:
+        rate: samples per second (float)
+
+    A background thread reads sys._current_frames() rate times per second, so
+    work handed to executor and scheduler threads is seen too; the cost does not
+    depend on how many calls the profiled code makes. Stacks are rooted at the
+    name of their thread. Every thread is sampled, so in a server the stacks of
+    the requests running at the same time are part of the profile.
+    """
+
+    def __init__(self, rate=SAMPLE_RATE):
+        if not rate > 0:
+            raise ValueError(f"Sampling rate must be positive, got {rate}")
+        self.interval = 1.0 / rate
+        self.stacks = Counter()
+        self.num_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.num_samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        """ Write the stacks in the collapsed format flamegraph.pl and speedscope read """
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ThreadProfile:
+    """ Deterministic profile of the steps one request runs on worker threads
+    ----------
+    Parameters:
+        label: name of the request, used in the file name (str)
+        output_dir: dump directory (str)
+
+    cProfile only sees the thread it is enabled on, and an async handler hands
+    its blocking steps to executor threads. runcall enables the profile around
+    one step on the thread that runs it, so the event loop is never held and
+    the other requests are not profiled. Work batched with other requests, like
+    the inference scheduler's model calls, is left out.
+    """
+
+    def __init__(self, label, output_dir=PROFILE_DIR):
+        self.label = label
+        self.path = dump_path(output_dir, label, "prof")
+        self.profile = cProfile.Profile()
+        # one Profile cannot be enabled on two threads at once
+        self._lock = threading.Lock()
+
+    def runcall(self, function, *args):
+        with self._lock:
+            return self.profile.runcall(function, *args)
+
+    def dump(self):
+        """ Write the pstats file, returns its path (str) """
+        self.profile.dump_stats(self.path)
+        print(f"Profile of {self.label} written to {self.path}")
+        return self.path
+
+
+@contextmanager
+def _profile(label, mode, rate, output_dir):
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        path = dump_path(output_dir, label, "prof")
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            print(f"Profile of {label} written to {path}")
+    else:
+        sampler = StackSampler(rate)
+        path = dump_path(output_dir, label, "folded")
+        sampler.start()
+        try:
+            yield path
+        finally:
+            sampler.stop()
+            sampler.dump(path)
+            print(f"Profile of {label} written to {path} ({sampler.num_samples} samples)")
+
+
+def profiled(label, mode=None, rate=SAMPLE_RATE, output_dir=PROFILE_DIR):
+    """ Run the body under a profiler and write the profile to output_dir
+    ----------
+    Parameters:
+        label: name of the unit of work, used in the file name (str)
+        mode: "cprofile" (deterministic, calling thread only, pstats .prof file),
+              "sample" (all threads of the process, collapsed-stack .folded file) or None to not profile
+        rate: samples per second in "sample" mode (float)
+        output_dir: dump directory (str)
+
+    ----------
+    Returns:
+        context manager yielding the path of the profile, or None when mode is None
+
+    With mode None nothing is set up, so the hook can stay in hot paths.
+    """
+    if not mode:
+        return nullcontext()
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode '{mode}', expected one of {PROFILE_MODES}")
+    return _profile(label, mode, rate, output_dir)
@@ -5,16 +5,24 @@ import librosa.display
 
 from scipy.signal import medfilt
 from matplotlib import pyplot as plt
-from featureExtraction import read_audio
+from featureExtraction import load_samples
 from utils import *
 
 
+# fractions of a beat used by refine_note, part of the transcription cache key
+REFINE_PARAMS = {
+    "median_filters": [1 / 8, 1 / 4, 1 / 3],
+    "min_note": 1 / 8,
+    "min_segment": 1 / 4,
+}
+
+
 # %%
 def calc_tempo(path_audio):
     """ Calculate audio tempo
     ----------
     Parameters:
-        path_audio: str
+        path_audio: path (str) or DecodedAudio
     
     ----------
     Returns: 
@@ -22,7 +30,7 @@ def calc_tempo(path_audio):
     
     """
     target_sr = 22050
-    y, _ = read_audio(path_audio, sr=target_sr)
+    y, _ = load_samples(path_audio, sr=target_sr)
     onset_strength = librosa.onset.onset_strength(y, sr=target_sr)
     tempo = librosa.beat.tempo(onset_envelope=onset_strength, sr=target_sr)
     return tempo
@@ -192,6 +200,101 @@ def clean_segment(note, minLength):
     return note_cleaned
 
 
+def run_length_encode(note):
+    """ Run-length encode a frame-level note sequence
+    ----------
+    Parameters:
+        note: (array)
+
+    ----------
+    Returns:
+        starts: first frame of each run (array)
+        lengths: number of frames of each run (array)
+        pitches: value of each run (array)
+
+    """
+    note = np.asarray(note)
+    if len(note) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), note[:0]
+    starts = np.concatenate([[0], np.flatnonzero(note[1:] != note[:-1]) + 1])
+    lengths = np.diff(np.append(starts, len(note)))
+    return starts, lengths, note[starts]
+
+
+def clean_note_runs(note, min_note_len=5):
+    """ Remove short pitch frames, same output as clean_note_frames
+    ----------
+    Parameters:
+        note: array
+        min_note_len: int
+
+    ----------
+    Returns:
+        output: array
+
+    """
+    starts, lengths, pitches = run_length_encode(note)
+    pitches = pitches.copy()
+    # every run but the last one is checked
+    short = lengths < min_note_len
+    short[-1:] = False
+    pitches[short] = 0
+    return np.repeat(pitches, lengths)
+
+
+def clean_segment_runs(note, minLength):
+    """ clean note segments, same output as clean_segment
+    ----------
+    Parameters:
+        note: (array)
+        minLength: (int)
+
+    ----------
+    Returns:
+        note_cleaned: (array)
+
+    """
+    note_cleaned = np.copy(note)
+    starts, lengths, pitches = run_length_encode(note)
+    voiced = pitches > 0
+    start = starts[voiced]
+    end = start + lengths[voiced] - 1
+    pitch = pitches[voiced]
+    if len(start) < 3:
+        return note_cleaned
+
+    # segments 1..n-2 are cleaned, each against its neighbours
+    cur, prev_seg, next_seg = pitch[1:-1], pitch[:-2], pitch[2:]
+    len_seg = end[1:-1] - start[1:-1]
+    short = (
+        (len_seg < minLength)
+        & (start[2:] - end[1:-1] > minLength)
+        & (start[1:-1] - end[:-2] > minLength)
+    )
+    removed = np.where(short, 0, cur)
+
+    # the previous segment is read after its own cleaning: removed, or fixed to the current pitch
+    prev_removed = np.concatenate([prev_seg[:1], removed[:-1]])
+    octave = (removed != next_seg) & (np.abs(removed - next_seg) % 12 == 0)
+    match_removed = prev_removed == next_seg
+    match_fixed = cur == next_seg
+    fixed = octave & match_removed
+    while True:
+        prev_fixed = np.concatenate([[False], fixed[:-1]])
+        updated = octave & np.where(prev_fixed, match_fixed, match_removed)
+        if np.array_equal(updated, fixed):
+            break
+        fixed = updated
+
+    # rewrite the runs of the cleaned segments, then the frame before each fixed segment
+    run_pitch = pitches.copy()
+    segment_runs = np.flatnonzero(voiced)[1:-1]
+    run_pitch[segment_runs] = np.where(fixed, next_seg, removed)
+    note_cleaned[:] = np.repeat(run_pitch, lengths)
+    note_cleaned[start[1:-1][fixed] - 1] = next_seg[fixed]
+    return note_cleaned
+
+
 def refine_note(est_note, tempo):
     """ main: refine note segments
     ----------
@@ -205,13 +308,13 @@ def refine_note(est_note, tempo):
             
     """
     one_beat_size = one_beat_frame_size(tempo)
-    est_note_mf1 = median_filter_pitch(est_note, one_beat_size, 1 / 8)
-    est_note_mf2 = median_filter_pitch(est_note_mf1, one_beat_size, 1 / 4)
-    est_note_mf3 = median_filter_pitch(est_note_mf2, one_beat_size, 1 / 3)
+    weight_mf1, weight_mf2, weight_mf3 = REFINE_PARAMS["median_filters"]
+    est_note_mf1 = median_filter_pitch(est_note, one_beat_size, weight_mf1)
+    est_note_mf2 = median_filter_pitch(est_note_mf1, one_beat_size, weight_mf2)
+    est_note_mf3 = median_filter_pitch(est_note_mf2, one_beat_size, weight_mf3)
 
     vocing = est_note_mf1 > 0
     est_pitch_mf3_v = vocing * est_note_mf3
-    est_pitch_mf3_v = clean_note_frames(est_pitch_mf3_v, int(one_beat_size * 1 / 8))
-    est_pitch_mf3_v = clean_segment(est_pitch_mf3_v, int(one_beat_size * 1 / 4))
+    est_pitch_mf3_v = clean_note_runs(est_pitch_mf3_v, int(one_beat_size * REFINE_PARAMS["min_note"]))
+    est_pitch_mf3_v = clean_segment_runs(est_pitch_mf3_v, int(one_beat_size * REFINE_PARAMS["min_segment"]))
     return est_pitch_mf3_v
-
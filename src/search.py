@@ -0,0 +1,256 @@
+import time
+import heapq
+import numpy as np
+from dtw import cost_matrix, subsequence_dtw, exceeds
+from matching import ENGINES, DEFAULT_ENGINE, sliding_fastdtw
+from metrics import metrics
+
+
+def box_distance(points, lower, upper):
+    """ Euclidean distance from each point to each song envelope
+    ----------
+    Parameters:
+        points: query intervals (array, shape (m, 2))
+        lower/upper: song envelopes (array, shape (num_songs, 2))
+
+    ----------
+    Returns:
+        distance: (array, shape (num_songs, m))
+    """
+    below = lower[:, np.newaxis, :] - points[np.newaxis, :, :]
+    above = points[np.newaxis, :, :] - upper[:, np.newaxis, :]
+    gap = np.maximum(np.maximum(below, above), 0)
+    return np.sqrt((gap ** 2).sum(axis=2))
+
+
+def lb_kim(int_query, lower, upper):
+    """ Lower bound from the first and last query intervals only, two box distances per song """
+    ends = int_query[[0, -1]] if len(int_query) > 1 else int_query[:1]
+    return box_distance(ends, lower, upper).sum(axis=1)
+
+
+def lb_keogh(int_query, lower, upper):
+    """ Lower bound from every query interval against the song envelope
+
+    Every query interval is aligned with at least one interval of the song, which
+    lies inside the envelope, so the summed distances to the envelope bound the
+    DTW cost of any match inside the song.
+    """
+    return box_distance(int_query, lower, upper)
+
+
+def lb_pairs(costs):
+    """ Lower bound of query rows i..m-1 from consecutive query intervals against adjacent song intervals
+    ----------
+    Parameters:
+        costs: cost_matrix of the query against one song (array, shape (m, n))
+
+    ----------
+    Returns:
+        lb_suffix: lb_suffix[i] bounds the cost of rows i..m-1 (array, shape (m + 1,))
+
+    A warping path leaves row i from a cell (i, j) and enters row i + 1 at
+    (i + 1, j) or (i + 1, j + 1), so two consecutive rows cost at least the best
+    such placement in the song. Unlike the song envelope this keeps the order
+    of the intervals: a query whose consecutive intervals never follow each other
+    in the song gets a high bound even if every single interval occurs in it.
+    Rows are covered alone or in pairs, whichever bounds higher.
+    """
+    len_query = len(costs)
+    row_min = costs.min(axis=1)
+    # vertical step (same song interval) or diagonal step (next song interval)
+    vertical = (costs[:-1] + costs[1:]).min(axis=1)
+    diagonal = (costs[:-1, :-1] + costs[1:, 1:]).min(axis=1, initial=np.inf)
+    pair_min = np.minimum(vertical, diagonal)
+    lb_suffix = np.zeros(len_query + 1)
+    lb_suffix[len_query - 1] = row_min[-1]
+    for i in range(len_query - 2, -1, -1):
+        lb_suffix[i] = max(row_min[i] + lb_suffix[i + 1], pair_min[i] + lb_suffix[i + 2])
+    return lb_suffix
+
+
+class TopK:
+    """ Bounded max-heap keeping the k smallest distances seen so far """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+
+    def threshold(self):
+        if self.k is None or len(self.heap) < self.k:
+            return np.inf
+        return -self.heap[0][0]
+
+    def push(self, distance, idx, start, end):
+        item = (-distance, -idx, start, end)
+        if self.k is None or len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def sorted(self):
+        return sorted(((-d, -i, s, e) for d, i, s, e in self.heap), key=lambda x: (x[0], x[1]))
+
+
+def search_catalog(query, catalog, top_k=None, engine=DEFAULT_ENGINE, window_size=5, song_ids=None, regions=None,
+                   max_distance=np.inf):
+    """ Find the songs of the catalog closest to the query
+    ----------
+    Parameters:
+        query: [time, pitch] rows of the query (list or array)
+        catalog: MelodyCatalog
+        top_k: number of songs to keep, None to score every song (int)
+        engine: "subsequence" or "fastdtw" (str)
+        window_size: extra intervals per fastdtw window (int)
+        song_ids: restrict the search to these catalog indices (array)
+        regions: [first, last) interval range to match in each of song_ids (array, shape (len(song_ids), 2))
+        max_distance: drop songs farther than this distance (float)
+
+    ----------
+    Returns:
+        hits: (distance, song index, start, end) sorted by distance (list)
+        stats: number of songs pruned at each stage and seconds spent in DTW (dict)
+
+    Songs whose LB_Kim passes max_distance are dropped before anything else is
+    computed for them. The others are visited in increasing LB_Keogh order: once
+    LB_Keogh passes the current k-th best distance (or max_distance) so does that
+    of every song left, and the scan stops. For the subsequence engine each song
+    is then bounded by lb_pairs, and DTW abandons it once a row's cost plus the
+    lb_pairs bound of the remaining rows passes the threshold. Without top_k and
+    max_distance every song is scored, and songs that cannot be matched are
+    returned with an infinite distance. The time spent on each song from its cost
+    matrix on is recorded to the match_per_song stage metric.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown DTW engine '{engine}', expected one of {ENGINES}")
+    if song_ids is None:
+        song_ids = np.arange(len(catalog))
+    song_ids = np.asarray(song_ids, dtype=np.int64)
+    if regions is not None:
+        regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+
+    stats = {"songs": len(song_ids), "too_short": 0, "lb_kim": 0, "lb_keogh": 0, "lb_pairs": 0, "early_abandon": 0,
+             "dtw": 0, "dtw_seconds": 0.0}
+    top = TopK(top_k)
+
+    int_query = np.diff(np.asarray(query, dtype=np.float64), axis=0) if len(query) > 0 else np.zeros((0, 2))
+    len_query = len(int_query)
+    lower, upper, num_intervals = catalog.interval_bounds()
+    lower, upper, num_intervals = lower[song_ids], upper[song_ids], num_intervals[song_ids]
+
+    matchable = (num_intervals >= len_query) & (num_intervals > 0) & (len_query > 0)
+    stats["too_short"] = int((~matchable).sum())
+    keep_unmatched = top_k is None and max_distance == np.inf
+    if keep_unmatched:
+        for idx in song_ids[~matchable]:
+            top.push(np.inf, int(idx), None, None)
+    if len_query == 0:
+        return top.sorted(), stats
+
+    # LB_Kim costs two box distances per song: drop what is already too far before the full envelope bound
+    kept = matchable.copy()
+    kept[matchable] = ~exceeds(lb_kim(int_query, lower[matchable], upper[matchable]), max_distance)
+    stats["lb_kim"] = int(matchable.sum() - kept.sum())
+    song_ids, lower, upper = song_ids[kept], lower[kept], upper[kept]
+    if regions is not None:
+        regions = regions[kept]
+    keogh_rows = lb_keogh(int_query, lower, upper)
+    keogh = keogh_rows.sum(axis=1)
+
+    order = np.argsort(keogh, kind="stable")
+    for rank, pos in enumerate(order):
+        idx = int(song_ids[pos])
+        threshold = min(top.threshold(), max_distance)
+        if exceeds(keogh[pos], threshold):
+            # the threshold only decreases and the songs left have a larger LB_Keogh
+            stats["lb_keogh"] += len(order) - rank
+            break
+
+        int_database = np.diff(catalog.notes(idx), axis=0)
+        region_start = 0
+        if regions is not None:
+            region_start = max(int(regions[pos, 0]), 0)
+            int_database = int_database[region_start : int(regions[pos, 1])]
+        started = time.perf_counter()
+        if engine == "fastdtw":
+            distance, start, end = sliding_fastdtw(int_query, int_database, window_size)
+        elif len(int_database) == 0:
+            distance, start, end = float("inf"), None, None
+        else:
+            costs = cost_matrix(int_query, int_database)
+            lb_suffix = lb_pairs(costs)
+            if exceeds(lb_suffix[0], threshold):
+                stats["lb_pairs"] += 1
+                seconds = time.perf_counter() - started
+                stats["dtw_seconds"] += seconds
+                metrics.record("match_per_song", seconds)
+                continue
+            distance, start, end = subsequence_dtw(int_query, int_database, threshold, lb_suffix, costs)
+        seconds = time.perf_counter() - started
+        stats["dtw_seconds"] += seconds
+        metrics.record("match_per_song", seconds)
+        if engine != "fastdtw" and distance == float("inf"):
+            stats["early_abandon"] += 1
+            continue
+        stats["dtw"] += 1
+        if distance > max_distance or (distance == float("inf") and not keep_unmatched):
+            continue
+        if distance != float("inf"):
+            start, end = start + region_start, end + region_start
+        top.push(distance, idx, start, end)
+
+    return top.sorted(), stats
+
+
+def shortlist_search(query, catalog, index, shortlist=20, top_k=None, engine=DEFAULT_ENGINE, window_size=5,
+                     max_distance=np.inf):
+    """ Re-score only the song regions the n-gram index ranks highest
+    ----------
+    Parameters:
+        query: [time, pitch] rows of the query (list or array)
+        catalog: MelodyCatalog
+        index: NgramIndex built over the same catalog
+        shortlist: number of candidate songs to re-score with DTW (int)
+        top_k/engine/window_size/max_distance: as in search_catalog
+
+    ----------
+    Returns:
+        hits: (distance, song index, start, end) sorted by distance (list)
+        stats: as in search_catalog, plus the number of candidates (dict)
+    """
+    int_query = np.diff(np.asarray(query, dtype=np.float64), axis=0) if len(query) > 0 else np.zeros((0, 2))
+    candidates = index.candidates(int_query[:, 1], shortlist=shortlist)
+
+    # leave room around the voted offset for tempo differences between hum and song
+    margin = len(int_query) + window_size
+    song_ids = np.array([idx for idx, _, _ in candidates], dtype=np.int64)
+    regions = np.array([[offset - margin, offset + len(int_query) + margin] for _, offset, _ in candidates])
+
+    hits, stats = search_catalog(query, catalog, top_k, engine, window_size, song_ids, regions, max_distance)
+    stats["candidates"] = len(candidates)
+    return hits, stats
+
+
+def describe_hit(catalog, hit):
+    """ JSON-ready description of a hit with the matched part of the song
+    ----------
+    Parameters:
+        catalog: MelodyCatalog
+        hit: (distance, song index, start, end) as returned by search_catalog
+
+    ----------
+    Returns:
+        result: {"file", "distance", "offset", "num_notes", "start_time", "end_time"} (dict)
+
+    Interval j goes from note j to note j + 1, so intervals start..end cover
+    notes start..end + 1; the time span runs between the onsets of those notes.
+    """
+    distance, idx, start, end = hit
+    result = {"file": catalog.name(idx), "distance": float(distance)}
+    if start is not None:
+        onsets = catalog.onset_sequence(idx)
+        result["offset"] = int(start)
+        result["num_notes"] = int(end - start + 2)
+        result["start_time"] = round(float(onsets[start]), 3)
+        result["end_time"] = round(float(onsets[end + 1]), 3)
+    return result
@@ -0,0 +1,111 @@
+import os
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from catalog import MelodyCatalog
+from matching import DEFAULT_ENGINE
+from search import search_catalog
+from metrics import metrics
+
+# catalog of the current worker process, memory-mapped once by the initializer
+_worker_catalog = None
+
+
+def _init_worker(index_folder):
+    global _worker_catalog
+    _worker_catalog = MelodyCatalog.load(index_folder)
+    _worker_catalog.interval_bounds()
+    # the metrics copied from the parent by the fork are not this worker's to report
+    metrics.drain()
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _search_shard(query, shard, num_shards, top_k, engine, window_size, max_distance, exclude=None):
+    song_ids = np.arange(shard, len(_worker_catalog), num_shards)
+    if exclude is not None and len(exclude):
+        song_ids = song_ids[~np.isin(song_ids, exclude)]
+    hits, stats = search_catalog(query, _worker_catalog, top_k, engine, window_size, song_ids,
+                                 max_distance=max_distance)
+    # the per-song timings recorded here go to the metrics of the parent process
+    return hits, stats, metrics.drain()
+
+
+def merge_results(shard_results, top_k=None):
+    """ Merge the local top-k of each shard into the global top-k
+    ----------
+    Parameters:
+        shard_results: (hits, stats) of each shard (list)
+        top_k: number of songs to keep, None to keep all (int)
+
+    ----------
+    Returns:
+        hits: (distance, song index, start, end) sorted by distance (list)
+        stats: stats of all shards summed (dict)
+    """
+    hits = heapq.merge(*[shard_hits for shard_hits, _ in shard_results], key=lambda x: (x[0], x[1]))
+    hits = list(hits) if top_k is None else [hit for _, hit in zip(range(top_k), hits)]
+    stats = {}
+    for _, shard_stats in shard_results:
+        for key, value in shard_stats.items():
+            stats[key] = stats.get(key, 0) + value
+    return hits, stats
+
+
+class SearchPool:
+    """ Persistent worker processes scanning the catalog in parallel
+    ----------
+    Parameters:
+        index_folder: folder of the binary catalog index (str)
+        workers: number of worker processes, defaults to the CPU count (int)
+
+    Each worker memory-maps the same index once, so the songs are shared through
+    the page cache instead of being copied per process. A query is split into one
+    shard per worker (every workers-th song); each shard returns its local top-k
+    and the coordinator merges them.
+    """
+
+    def __init__(self, index_folder, workers=None):
+        self.index_folder = index_folder
+        self.workers = workers or os.cpu_count()
+        self.executor = None
+        self.start()
+
+    def start(self):
+        # fork before the model is loaded and before the service starts its threads:
+        # workers only need NumPy and the catalog, and a fork copies the locks other threads hold
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.index_folder,),
+        )
+        for future in [self.executor.submit(_worker_ready) for _ in range(self.workers)]:
+            future.result()
+        print(f"Search pool started with {self.workers} workers")
+
+    def reload(self):
+        """ Restart the workers so they map a rebuilt index """
+        self.close()
+        self.start()
+
+    def search(self, query, top_k=None, engine=DEFAULT_ENGINE, window_size=5, max_distance=np.inf, exclude=None):
+        """ Search every shard, skipping the song indices in exclude (array) """
+        futures = [
+            self.executor.submit(
+                _search_shard, query, shard, self.workers, top_k, engine, window_size, max_distance, exclude
+            )
+            for shard in range(self.workers)
+        ]
+        shard_results = [future.result() for future in futures]
+        for _, _, drained in shard_results:
+            metrics.merge(drained)
+        return merge_results([(hits, stats) for hits, stats, _ in shard_results], top_k)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import zlib
+import time
+import socket
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from catalog import list_midi_files
+from matching import DEFAULT_ENGINE
+
+# queries a coordinator sends to the shards at the same time before they queue for a thread
+MAX_CONCURRENT_QUERIES = 16
+
+# requests to the shard servers, shared by all queries of the coordinator
+_executor = None
+_executor_size = 0
+_executor_lock = threading.Lock()
+
+
+def shard_of(file_name, num_shards):
+    """ Shard owning a song, stable across processes and machines (int) """
+    return zlib.crc32(file_name.encode("utf-8")) % num_shards
+
+
+def partition_folder(midi_folder, output_folder, num_shards):
+    """ Split the .mid files of a folder into one folder per shard
+    ----------
+    Parameters:
+        midi_folder: folder of database .mid files (str)
+        output_folder: shard k gets output_folder/shard_k (str)
+        num_shards: number of shards (int)
+
+    ----------
+    Returns:
+        shard_folders: folder of each shard (list)
+
+    Files are hard-linked when the file system allows it, copied otherwise.
+    """
+    shard_folders = [os.path.join(output_folder, f"shard_{k}") for k in range(num_shards)]
+    for folder in shard_folders:
+        os.makedirs(folder, exist_ok=True)
+    for midi_file in list_midi_files(midi_folder):
+        source = os.path.join(midi_folder, midi_file)
+        target = os.path.join(shard_folders[shard_of(midi_file, num_shards)], midi_file)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+    return shard_folders
+
+
+def post_json(url, payload, timeout):
+    """ POST a JSON body and decode the JSON answer, within timeout seconds in total
+    ----------
+    Parameters:
+        url: full URL of the endpoint (str)
+        payload: JSON body (dict)
+        timeout: seconds from sending the request to reading the whole answer (float)
+
+    ----------
+    Returns:
+        response: decoded answer (dict)
+
+    The socket timeout of urllib applies to each read, so a shard trickling its
+    answer could hold the caller far longer; here every socket operation only
+    gets what is left of the deadline.
+    """
+    deadline = time.monotonic() + timeout
+
+    def remaining():
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError(f"timed out after {timeout}s")
+        return left
+
+    parts = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(parts.hostname, parts.port, timeout=remaining())
+    try:
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        connection.request("POST", target, body=json.dumps(payload).encode("utf-8"),
+                           headers={"Content-Type": "application/json"})
+        # the response takes the socket over when the shard closes the connection after it
+        sock = connection.sock
+        sock.settimeout(remaining())
+        response = connection.getresponse()
+        chunks = []
+        while True:
+            sock.settimeout(remaining())
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if response.status >= 400:
+            raise RuntimeError(f"HTTP {response.status} from {url}")
+        return json.loads(b"".join(chunks).decode("utf-8"))
+    except socket.timeout:
+        raise TimeoutError(f"timed out after {timeout}s")
+    finally:
+        connection.close()
+
+
+def broadcast(shard_urls, path, payload=None, timeout=2.0):
+    """ POST the same request to every shard
+    ----------
+    Parameters:
+        shard_urls: base URL of each shard server (list)
+        path: endpoint, e.g. "/search" (str)
+        payload: JSON body (dict)
+        timeout: seconds each shard gets from the moment its request is sent (float)
+
+    ----------
+    Returns:
+        responses: {url: decoded response} of the shards that answered in time (dict)
+        errors: {url: error message} of the others (dict)
+
+    The requests of concurrent queries share one thread pool of MAX_CONCURRENT_QUERIES
+    requests per shard; a request waiting for a free thread is not charged for it.
+    """
+    global _executor, _executor_size
+    size = MAX_CONCURRENT_QUERIES * len(shard_urls)
+    with _executor_lock:
+        if _executor is None or _executor_size < size:
+            # threads are only started when needed, growing the pool costs nothing up front
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="shard")
+            _executor_size = size
+        executor = _executor
+    futures = {url: executor.submit(post_json, url.rstrip("/") + path, payload or {}, timeout) for url in shard_urls}
+    # post_json ends within timeout of sending its request, whatever the shard does
+    wait(futures.values())
+
+    responses = {}
+    errors = {}
+    for url, future in futures.items():
+        if future.exception() is not None:
+            errors[url] = str(future.exception())
+        else:
+            responses[url] = future.result()
+    return responses, errors
+
+
+def search_shards(query, shard_urls, top_k=10, engine=DEFAULT_ENGINE, max_distance=None, shortlist=0, timeout=2.0,
+                  report_recall=False):
+    """ Fan a query out to the shard servers and merge their top-k
+    ----------
+    Parameters:
+        query: [time, pitch] rows of the query (list or array)
+        shard_urls: base URL of each shard server (list)
+        top_k/engine/max_distance/shortlist: as in compare_midi
+        timeout: seconds to wait for each shard (float)
+        report_recall: with shortlist, also have the shards run the full scan and report the
+                       recall of the merged shortlist top-k (bool)
+
+    ----------
+    Returns:
+        results: described hits of all shards, best first (list)
+        stats: stats of the shards that answered, summed, plus "shards" (dict)
+
+    A shard that fails or misses the timeout is left out and the answer is
+    flagged as partial instead of failing the whole query.
+    """
+    payload = {
+        "query": np.asarray(query, dtype=np.float64).tolist(),
+        "top_k": top_k,
+        "engine": engine,
+        "max_distance": max_distance,
+        "shortlist": shortlist,
+        "report_recall": report_recall,
+    }
+    responses, errors = broadcast(shard_urls, "/search", payload, timeout)
+    for url, error in errors.items():
+        print(f"Shard {url} left out: {error}")
+
+    results = []
+    stats = {}
+    for response in responses.values():
+        results.extend(response["results"])
+        for key, value in response["stats"].items():
+            stats[key] = stats.get(key, 0) + value
+    results.sort(key=lambda x: (x["distance"], x["file"]))
+    if report_recall and shortlist:
+        # a recall per shard says nothing of the merged top-k, compare it with the merged full scans
+        reference = [hit for response in responses.values() for hit in response.get("reference", [])]
+        reference = {hit["file"] for hit in sorted(reference, key=lambda x: (x["distance"], x["file"]))[:top_k]}
+        found = {hit["file"] for hit in results[:top_k]}
+        stats["recall"] = len(reference & found) / len(reference) if reference else 1.0
+    stats["shards"] = {"queried": len(shard_urls), "answered": len(responses), "failed": errors}
+    stats["partial"] = len(errors) > 0
+    return results[:top_k], stats
@@ -0,0 +1,125 @@
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import argparse
+import asyncio
+import uvicorn
+from catalog import load_or_build_catalog
+from matching import ENGINES, DEFAULT_ENGINE
+from search import describe_hit
+from search_pool import SearchPool
+from live_catalog import LiveCatalog, search_snapshot
+from shard_client import partition_folder
+from metrics import metrics, stage
+
+app = FastAPI()
+
+SHARD_NAME = "shard_0"
+MIDI_DIR = "shards/shard_0"
+CATALOG_DIR = "shards/shard_0_index"
+SEARCH_WORKERS = 0
+CATALOG_POLL_INTERVAL = 2.0
+
+live_catalog = None
+search_pool = None
+
+
+class SearchRequest(BaseModel):
+    query: List[List[float]]
+    top_k: int = 10
+    engine: str = DEFAULT_ENGINE
+    max_distance: Optional[float] = None
+    shortlist: int = 0
+    report_recall: bool = False
+
+
+def search_shard(request):
+    max_distance = float("inf") if request.max_distance is None else request.max_distance
+    snapshot = live_catalog.snapshot
+    with stage("match"):
+        hits, stats = search_snapshot(request.query, snapshot, request.top_k, request.engine, max_distance,
+                                      request.shortlist, pool=search_pool)
+    metrics.increment("songs_matched", stats["dtw"])
+    results = [describe_hit(snapshot, hit) for hit in hits if hit[0] != float("inf")]
+    response = {"shard": SHARD_NAME, "results": results, "stats": stats}
+    if request.report_recall and request.shortlist:
+        # the coordinator scores the merged shortlist top-k against the merged full scans
+        exhaustive_hits, _ = search_snapshot(request.query, snapshot, request.top_k, request.engine, max_distance,
+                                            pool=search_pool)
+        response["reference"] = [
+            {"file": snapshot.name(idx), "distance": float(distance)}
+            for distance, idx, _, _ in exhaustive_hits if distance != float("inf")
+        ]
+    return response
+
+
+@app.on_event("startup")
+async def load_catalog():
+    global live_catalog, search_pool
+    with stage("catalog_load"):
+        catalog = load_or_build_catalog(MIDI_DIR, CATALOG_DIR)
+    # fork the search workers before the polling thread runs, a fork copies the locks other threads hold
+    if SEARCH_WORKERS > 0:
+        search_pool = SearchPool(CATALOG_DIR, SEARCH_WORKERS)
+    live_catalog = LiveCatalog(MIDI_DIR, catalog, CATALOG_POLL_INTERVAL)
+    live_catalog.start()
+
+
+@app.on_event("shutdown")
+async def close_catalog():
+    if live_catalog is not None:
+        live_catalog.stop()
+    if search_pool is not None:
+        search_pool.close()
+
+
+@app.get("/status/")
+def status():
+    return {"shard": SHARD_NAME, "catalog": live_catalog.stats() if live_catalog is not None else None}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
+
+@app.post("/reload/")
+async def reload_catalog():
+    changes = await asyncio.get_event_loop().run_in_executor(None, live_catalog.refresh)
+    return {"shard": SHARD_NAME, "changes": changes, "catalog": live_catalog.stats()}
+
+
+@app.post("/search")
+async def search(request: SearchRequest):
+    if request.engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown engine '{request.engine}', expected one of {ENGINES}")
+    if request.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1")
+    return await asyncio.get_event_loop().run_in_executor(None, search_shard, request)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve one shard of the melody catalog to a /compare/ coordinator")
+    parser.add_argument("--midi", default=MIDI_DIR, help="Folder of the .mid files of this shard")
+    parser.add_argument("--index", default=None, help="Catalog index of this shard (default: <midi>_index)")
+    parser.add_argument("--name", default=None, help="Name reported to the coordinator (default: the folder name)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Interface to listen on, 0.0.0.0 to serve a coordinator on another machine")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes for the catalog scan")
+    parser.add_argument("--partition", type=int, default=0,
+                        help="Split --input into this many shard folders under --output, then exit")
+    parser.add_argument("--input", default="data1", help="Folder of database .mid files to partition")
+    parser.add_argument("--output", default="shards", help="Output folder of the partitions")
+    args = parser.parse_args()
+
+    if args.partition:
+        for folder in partition_folder(args.input, args.output, args.partition):
+            print(folder)
+    else:
+        MIDI_DIR = args.midi.rstrip("/")
+        CATALOG_DIR = args.index or f"{MIDI_DIR}_index"
+        SHARD_NAME = args.name or MIDI_DIR.split("/")[-1]
+        SEARCH_WORKERS = args.workers
+        uvicorn.run(app, host=args.host, port=args.port)
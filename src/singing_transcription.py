@@ -3,23 +3,40 @@
 import argparse
 import numpy as np
 from pathlib import Path
-from model import *
 from featureExtraction import *
 from quantization import *
 from utils import *
 from MIDI import *
+from metrics import metrics, stage
+from tflite_model import TFLiteModel
+
+# model files of each inference backend, under data/
+BACKENDS = {"keras": "weight_ST.hdf5", "tflite": "weight_ST.tflite"}
 
 # %%
 class SingingTranscription:
-    def __init__(self):
+    def __init__(self, backend="keras"):
 
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {tuple(BACKENDS)}")
+        self.backend = backend
         self.PATH_PROJECT = pathlib.Path(__file__).absolute().parent.parent
         self.num_spec = 513
         self.window_size = 31
         self.note_res = 1
         self.batch_size = 64
 
+    def default_weight_path(self):
+        """  model file of the backend shipped under data/"""
+        return f"{self.PATH_PROJECT}/data/{BACKENDS[self.backend]}"
+
     def load_model(self, path_weight, TF_summary=False):
+        """  Keras model with its weights, or the TFLite model exported by export_model.py"""
+        if self.backend == "tflite":
+            return TFLiteModel(path_weight)
+
+        # only the Keras backend needs the graph, and TensorFlow with it
+        from model import melody_ResNet_JDC
 
         model = melody_ResNet_JDC(self.num_spec, self.window_size, self.note_res)
         model.load_weights(path_weight)
@@ -27,29 +44,77 @@ class SingingTranscription:
             print(model.summary())
         return model
 
-    def predict_melody(self, model_ST, filepath):
+    def load_inference_model(self, path_weight, outputs=("output",)):
+        """  Model computing only the requested heads, for serving: decode_melody needs "output" only,
+             return_voicing also needs "output_V" """
+        if self.backend == "tflite":
+            return TFLiteModel(path_weight)
+
+        from model import melody_ResNet_JDC_inference
+
+        return melody_ResNet_JDC_inference(self.num_spec, self.window_size, self.note_res, path_weight, outputs)
+
+    def extract_features(self, filepath):
+        """  Features extraction: normalized (num_windows, window_size, num_spec, 1) spectrogram windows"""
+        X_test, _ = spec_extraction(file_name=filepath, win_size=self.window_size)
+        return X_test
+
+    def decode_melody(self, y_predict, return_voicing=False):
+        """  frame-level MIDI notes from the model outputs
+        ----------
+        Parameters:
+            y_predict: model outputs [note, voicing] (list)
+            return_voicing: also return the voicing head and the note confidence (bool)
+
+        ----------
+        Returns:
+            est_MIDI: MIDI note per 10ms frame, 0 when unvoiced (array)
+            voicing: probability of the voiced class per frame (array, only with return_voicing)
+            confidence: probability of the chosen note class per frame (array, only with return_voicing)
+        """
         pitch_range = np.arange(40, 95 + 1.0 / self.note_res, 1.0 / self.note_res)
         pitch_range = np.concatenate([np.zeros(1), pitch_range])
 
+        y_note = y_predict[0]  # [0]:note,  [1]:vocing
+        y_shape = y_note.shape
+        num_total = y_shape[0] * y_shape[1]
+        y_note = np.reshape(y_note, (num_total, y_shape[2]))
+
+        index_predict = np.argmax(y_note, axis=1)
+        pitch_MIDI = pitch_range[index_predict]
+        est_MIDI = np.where((pitch_MIDI >= 40) & (pitch_MIDI <= 95), pitch_MIDI, 0.0)
+        if not return_voicing:
+            return est_MIDI
+
+        confidence = y_note[np.arange(num_total), index_predict]
+        voicing = np.reshape(y_predict[1], (num_total, -1))[:, 1]
+        return est_MIDI, voicing, confidence
+
+    def predict_melody(self, model_ST, filepath, return_voicing=False, stream=False):
+        if stream:
+            """  Features extraction and melody predict, a batch of windows at a time (long tracks)"""
+            totals = metrics.totals("spec_extraction", "model_predict")
+            windows = iter_spec_extraction(filepath, self.window_size, batch_windows=self.batch_size)
+            blocks = []
+            while True:
+                with totals.stage("spec_extraction"):
+                    X_block = next(windows, None)
+                if X_block is None:
+                    break
+                with totals.stage("model_predict"):
+                    blocks.append(model_ST.predict(X_block, batch_size=self.batch_size, verbose=0))
+            totals.record()
+            y_predict = [np.concatenate([block[k] for block in blocks]) for k in range(len(blocks[0]))]
+            return self.decode_melody(y_predict, return_voicing=return_voicing)
+
         """  Features extraction"""
-        X_test, _ = spec_extraction(file_name=filepath, win_size=self.window_size)
+        with stage("spec_extraction"):
+            X_test = self.extract_features(filepath)
 
         """  melody predict"""
-        y_predict = model_ST.predict(X_test, batch_size=self.batch_size, verbose=1)
-        y_predict = y_predict[0]  # [0]:note,  [1]:vocing
-        y_shape = y_predict.shape
-        num_total = y_shape[0] * y_shape[1]
-        y_predict = np.reshape(y_predict, (num_total, y_shape[2]))
-
-        est_MIDI = np.zeros(num_total)
-        est_freq = np.zeros(num_total)
-        for i in range(num_total):
-            index_predict = np.argmax(y_predict[i])
-            pitch_MIDI = pitch_range[np.int32(index_predict)]
-            if pitch_MIDI >= 40 and pitch_MIDI <= 95:
-                est_MIDI[i] = pitch_MIDI
-                # est_freq[i] = 2 ** ((pitch_MIDI - 69) / 12.0) * 440
-        return est_MIDI
+        with stage("model_predict"):
+            y_predict = model_ST.predict(X_test, batch_size=self.batch_size, verbose=1)
+        return self.decode_melody(y_predict, return_voicing=return_voicing)
 
     def save_output_frame_level(self, pitch_score, path_save, note_or_freq="note"):
         check_and_make_dir(Path(path_save))
@@ -78,10 +143,11 @@ def main(args):
 
     """ predict note (time-freq) """
     path_audio = args.path_audio
-    fl_note = ST.predict_melody(model_ST, path_audio)  # frame-level pitch score
+    audio = DecodedAudio.from_file(path_audio)  # decoded once for both spectrogram and tempo
+    fl_note = ST.predict_melody(model_ST, audio)  # frame-level pitch score
 
     """ post-processing """
-    tempo = calc_tempo(path_audio)
+    tempo = calc_tempo(audio)
     refined_fl_note = refine_note(fl_note, tempo)  # frame-level pitch score
 
     """ convert frame-level pitch score to note-level (time-axis) """
@@ -0,0 +1,314 @@
+import math
+import numpy as np
+import librosa
+from scipy.signal import resample_poly
+from featureExtraction import PAD_MODE, DecodedAudio, spec_windows
+from quantization import calc_tempo, refine_note, one_beat_frame_size
+from MIDI import note_to_segment_array
+from matching import segments_to_query
+
+# seconds of the latest audio the tempo of a partial transcription is estimated from
+STREAM_TEMPO_SECONDS = 8.0
+
+# sample formats of the PCM chunks, converted to integer sample units like DecodedAudio
+PCM_ENCODINGS = {"pcm_s16le": ("<i2", 1.0), "pcm_f32le": ("<f4", 32768.0)}
+
+
+class StreamingResampler:
+    """ resample_poly applied chunk by chunk, equal to resampling the whole signal at once
+    ----------
+    Parameters:
+        sr_in: sampling rate of the incoming samples (int)
+        sr_out: sampling rate of the output (int)
+
+    An output sample is released once the input covers the support of the
+    anti-aliasing filter around it; a few milliseconds of input are kept as
+    left context. flush() releases the tail, zero-padded like the full call.
+    """
+
+    def __init__(self, sr_in, sr_out=8000):
+        g = math.gcd(int(sr_in), int(sr_out))
+        self.up = int(sr_out) // g
+        self.down = int(sr_in) // g
+        # half-length of the default resample_poly filter, in input samples, rounded up to whole steps of down
+        half = math.ceil(10 * max(self.up, self.down) / self.up) + 1
+        self.margin = math.ceil(half / self.down) * self.down
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.offset = 0
+        self.num_in = 0
+        self.num_out = 0
+
+    def _release(self, stop):
+        if stop <= self.num_out:
+            return np.zeros(0, dtype=np.float32)
+        if self.up == self.down:
+            y = self.buffer[self.num_out - self.offset : stop - self.offset]
+        else:
+            # restart on a multiple of down so the output grid lines up with the full call
+            start = max(0, (self.num_out * self.down // self.up - self.margin) // self.down * self.down)
+            y = resample_poly(self.buffer[start - self.offset :], self.up, self.down)
+            first = start * self.up // self.down
+            y = y[self.num_out - first : stop - first]
+        self.num_out = stop
+        keep = max(0, (self.num_out * self.down // self.up - self.margin) // self.down * self.down)
+        self.buffer = self.buffer[keep - self.offset :]
+        self.offset = keep
+        return y.astype(np.float32)
+
+    def push(self, samples):
+        """ Resampled samples that no later input can change (float32 array) """
+        self.buffer = np.concatenate([self.buffer, samples])
+        self.num_in += len(samples)
+        return self._release(max(0, (self.num_in - self.margin) * self.up // self.down))
+
+    def flush(self):
+        """ The remaining resampled samples, once the input is complete (float32 array) """
+        return self._release(-(-self.num_in * self.up // self.down))
+
+
+class SampleBuffer:
+    """ float32 samples appended in place, the storage doubling when full, so a long stream is copied O(log n) times """
+
+    def __init__(self, capacity=4096):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.size = 0
+
+    def append(self, samples):
+        end = self.size + len(samples)
+        if end > len(self.data):
+            data = np.zeros(max(end, 2 * len(self.data)), dtype=np.float32)
+            data[: self.size] = self.data[: self.size]
+            self.data = data
+        self.data[self.size : end] = samples
+        self.size = end
+
+    def view(self):
+        """ The samples so far, without a copy (float32 array) """
+        return self.data[: self.size]
+
+
+class StreamingTranscriber:
+    """ Transcribe a hum while it is being recorded
+    ----------
+    Parameters:
+        ST: SingingTranscription, for the window size and the output decoding
+        sample_rate: sampling rate of the pushed PCM (int)
+        encoding: "pcm_s16le" or "pcm_f32le", mono (str)
+        ref_tolerance_db: re-run the windows whose dB reference fell this far below the loudest bin so far (float)
+        context_beats: beats of notes re-refined before the frames that can still change (int)
+        max_seconds: audio beyond this is dropped and full turns True, None for no limit (float)
+
+    push() frames the new audio the way spec_extraction does (8kHz, 1024-point
+    STFT, hop 80, 31-frame windows) and returns the windows that are complete,
+    for the caller to run through the model and hand back to update(). Each STFT
+    frame is computed once; only the frames of the window being filled are kept.
+    power_to_db takes the loudest bin of the whole track as 0 dB, so windows
+    use the loudest bin so far and are recomputed from the 8kHz samples when it
+    grew by more than ref_tolerance_db. transcription() refines the notes of the
+    inferred windows with the tempo of the last STREAM_TEMPO_SECONDS, re-refining
+    only the last notes when the tempo did not change. After finish(), and the
+    update() of the windows it returns, the tempo is that of the whole recording
+    and the transcription is the one /compare/ computes for the same audio.
+    """
+
+    def __init__(self, ST, sample_rate, encoding="pcm_s16le", ref_tolerance_db=3.0, context_beats=2,
+                 max_seconds=None, n_fft=1024, hop_length=80, sr=8000):
+        if encoding not in PCM_ENCODINGS:
+            raise ValueError(f"Unknown encoding '{encoding}', expected one of {tuple(PCM_ENCODINGS)}")
+        self.ST = ST
+        self.sample_rate = int(sample_rate)
+        self.dtype, self.scale = PCM_ENCODINGS[encoding]
+        self.ref_tolerance_db = ref_tolerance_db
+        self.context_beats = context_beats
+        self.max_samples = None if max_seconds is None else int(max_seconds * self.sample_rate)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.resampler = StreamingResampler(self.sample_rate, sr)
+
+        self.raw = SampleBuffer()
+        self.y = SampleBuffer()
+        self.num_frames = 0
+        # magnitude frames of the window being filled
+        self.pending = np.zeros((n_fft // 2 + 1, 0), dtype=np.float32)
+        self.ref = 0.0
+        self.window_refs = []
+        self.window_notes = []
+        self.finished = False
+
+        self._tempo = None
+        self._tempo_state = None
+        self._note = None
+        self._tempo_key = None
+        self._stable = 0
+
+    @property
+    def duration(self):
+        """ Seconds of audio pushed so far (float) """
+        return self.raw.size / self.sample_rate
+
+    @property
+    def full(self):
+        """ Whether max_seconds of audio were pushed (bool) """
+        return self.max_samples is not None and self.raw.size >= self.max_samples
+
+    def _padded(self, start, stop, final):
+        """ Samples start:stop of the 8kHz signal padded as librosa.stft(center=True) pads it """
+        half = self.n_fft // 2
+        y = self.y.view()
+        if len(y) <= 2 * self.n_fft:
+            return np.pad(y, half, mode=PAD_MODE)[start:stop]
+        # the padding only depends on the first and, once the recording ended, the last samples
+        parts = []
+        if start < half:
+            parts.append(np.pad(y[: half + 1], (half, 0), mode=PAD_MODE)[start : min(stop, half)])
+        parts.append(y[max(0, start - half) : max(0, stop - half)])
+        if final and stop > half + len(y):
+            right = np.pad(y[-(half + 1) :], (0, half), mode=PAD_MODE)[-half:]
+            parts.append(right[max(0, start - half - len(y)) : stop - half - len(y)])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def _stft(self, first, last, final):
+        """ Magnitudes of the STFT frames first:last (float32 array, shape (513, last - first)) """
+        segment = self._padded(first * self.hop_length, (last - 1) * self.hop_length + self.n_fft, final)
+        S = librosa.core.stft(segment, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.n_fft,
+                              center=False)
+        return np.abs(S)
+
+    def _frames(self, final):
+        """ Compute the frames that the samples so far fully cover """
+        half = self.n_fft // 2
+        if self.y.size == 0:
+            return
+        length = self.y.size + (2 * half if final else half)
+        num_frames = 1 + (length - self.n_fft) // self.hop_length if length >= self.n_fft else 0
+        if num_frames <= self.num_frames:
+            return
+        mag = self._stft(self.num_frames, num_frames, final)
+        self.pending = np.concatenate([self.pending, mag], axis=1)
+        self.num_frames = num_frames
+        self.ref = max(self.ref, float(mag.max()))
+
+    def _windows(self, final):
+        """ Ids and model windows of the new complete windows and of the ones with an outdated reference """
+        win_size = self.ST.window_size
+        mags = {}
+        while self.pending.shape[1] >= win_size or (final and self.pending.shape[1] > 0):
+            k = len(self.window_refs)
+            mags[k] = self.pending[:, :win_size]
+            self.pending = self.pending[:, win_size:]
+            # a window is stale until it is converted with a reference
+            self.window_refs.append(0.0)
+            self.window_notes.append(None)
+        if self.ref <= 0:
+            return [], np.zeros((0, win_size, self.n_fft // 2 + 1, 1), dtype=np.float32)
+        tolerance = 10 ** (-self.ref_tolerance_db / 10) if not final else 1.0
+        ids = [k for k, ref in enumerate(self.window_refs) if ref < self.ref * tolerance]
+        if not ids:
+            return [], np.zeros((0, win_size, self.n_fft // 2 + 1, 1), dtype=np.float32)
+        x = []
+        for k in ids:
+            mag = mags.get(k)
+            if mag is None:
+                mag = self._stft(k * win_size, min((k + 1) * win_size, self.num_frames), final)
+            x.append(spec_windows(mag, self.ref, win_size))
+            self.window_refs[k] = self.ref
+        return ids, np.concatenate(x)
+
+    def push(self, data):
+        """ Add a chunk of PCM
+        ----------
+        Parameters:
+            data: mono samples in the encoding of the stream (bytes)
+
+        ----------
+        Returns:
+            ids: window indices to run through the model (list)
+            x: their spectrogram windows (float32 array, shape (len(ids), win_size, 513, 1))
+        """
+        if self.finished:
+            raise ValueError("push after finish")
+        samples = np.frombuffer(data, dtype=self.dtype).astype(np.float32) * self.scale
+        if self.max_samples is not None:
+            samples = samples[: max(0, self.max_samples - self.raw.size)]
+        self.raw.append(samples)
+        self.y.append(self.resampler.push(samples))
+        self._frames(final=False)
+        return self._windows(final=False)
+
+    def finish(self):
+        """ End of the recording: the last frames, zero-padded like spec_extraction, and every window
+            whose reference is not the loudest bin of the whole track (ids, x as push returns) """
+        self.finished = True
+        self.y.append(self.resampler.flush())
+        self._frames(final=True)
+        return self._windows(final=True)
+
+    def update(self, ids, y_predict):
+        """ Store the model outputs of the windows push or finish returned """
+        notes = self.ST.decode_melody(y_predict).reshape(len(ids), self.ST.window_size)
+        for k, note in zip(ids, notes):
+            self.window_notes[k] = note
+
+    def audio(self):
+        """ Samples pushed so far (DecodedAudio) """
+        return DecodedAudio(self.raw.view(), self.sample_rate)
+
+    def tempo(self):
+        """ Tempo of the last STREAM_TEMPO_SECONDS while recording, of the whole recording after finish()
+
+        Beat tracking the whole recording on every partial search would grow with
+        its length; the estimate is kept until more audio arrives.
+        """
+        state = (self.raw.size, self.finished)
+        if state != self._tempo_state:
+            samples = self.raw.view()
+            if not self.finished:
+                samples = samples[-int(STREAM_TEMPO_SECONDS * self.sample_rate) :]
+            self._tempo = calc_tempo(DecodedAudio(samples, self.sample_rate))
+            self._tempo_state = state
+        return self._tempo
+
+    def frame_notes(self):
+        """ MIDI note per 10ms frame of the leading windows the model has seen (array) """
+        notes = []
+        for note in self.window_notes:
+            if note is None:
+                break
+            notes.append(note)
+        return np.concatenate(notes) if notes else np.zeros(0)
+
+    def transcription(self):
+        """ Tempo, refined notes and segments of the audio so far
+        ----------
+        Returns:
+            tempo: as calc_tempo returns it (array)
+            note: refined MIDI note per 10ms frame (array)
+            segment: [start(s), end(s), pitch] rows (array)
+        """
+        fl_note = self.frame_notes()
+        tempo = self.tempo()
+        if len(fl_note) == 0:
+            return tempo, fl_note, np.zeros((0, 3))
+        # refine_note and segment_to_midi only see the rounded beat length and the integer tempo
+        tempo_key = (one_beat_frame_size(tempo), int(np.squeeze(tempo)))
+        if self.finished or self._note is None or tempo_key != self._tempo_key:
+            note = refine_note(fl_note, tempo)
+        else:
+            start = max(0, self._stable - self.context_beats * tempo_key[0])
+            tail = refine_note(fl_note[start:], tempo)
+            note = np.concatenate([self._note[: self._stable], tail[self._stable - start :]])
+        self._note, self._tempo_key = note, tempo_key
+
+        # medfilt reaches half a beat, segment cleaning the neighbouring segments: the frames
+        # before the last two segments and the last context_beats beats no longer change
+        changes = np.flatnonzero(note[1:] != note[:-1]) + 1
+        last_segments = changes[-4] if len(changes) >= 4 else 0
+        self._stable = int(max(0, min(last_segments, len(note) - self.context_beats * tempo_key[0])))
+        return tempo, note, note_to_segment_array(note)
+
+    def query(self):
+        """ [time, pitch] rows of the transcription so far, as transcribe_query returns them (array) """
+        tempo, _, segment = self.transcription()
+        if len(segment) == 0:
+            return np.zeros((0, 2))
+        return segments_to_query(segment, tempo)
@@ -0,0 +1,64 @@
+import threading
+import numpy as np
+
+
+def load_interpreter(path_model, num_threads=None):
+    """ TFLite interpreter of a model file, from tflite_runtime when installed, else from TensorFlow """
+    try:
+        # the standalone runtime is a few MB, against the whole of TensorFlow
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=str(path_model), num_threads=num_threads)
+
+
+class TFLiteModel:
+    """ melody_ResNet_JDC exported by export_model.py, behind the part of the keras.Model API the code uses
+    ----------
+    Parameters:
+        path_model: .tflite file (str)
+        num_threads: CPU threads of the interpreter, None for the runtime default (int)
+
+    predict and predict_on_batch return [note, voicing] like the Keras model, so
+    SingingTranscription, InferenceScheduler and IngestPipeline take either. The
+    interpreter is not thread-safe, calls are serialized.
+    """
+
+    def __init__(self, path_model, num_threads=None):
+        self.path_model = path_model
+        self.interpreter = load_interpreter(path_model, num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        # output order is not kept by the converter: the note head is the wider one
+        outputs = sorted(self.interpreter.get_output_details(), key=lambda detail: -detail["shape"][-1])
+        self.output_indices = [detail["index"] for detail in outputs]
+        self.input_shape = tuple(self.interpreter.get_input_details()[0]["shape"][1:])
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, x):
+        """ Outputs for one batch of spectrogram windows, resizing the interpreter when the batch size changes (list) """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        with self._lock:
+            if len(x) != self._batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, [len(x), *self.input_shape])
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(x)
+            self.interpreter.set_tensor(self.input_index, x)
+            self.interpreter.invoke()
+            return [self.interpreter.get_tensor(index).copy() for index in self.output_indices]
+
+    def predict(self, x, batch_size=64, verbose=0):
+        """ Outputs for any number of windows, batch_size at a time (list) """
+        blocks = []
+        for start in range(0, len(x), batch_size):
+            x_block = x[start : start + batch_size]
+            num_rows = len(x_block)
+            if num_rows < batch_size and start > 0:
+                # pad the last block so the interpreter keeps its tensor sizes
+                padding = np.zeros((batch_size - num_rows, *x_block.shape[1:]), dtype=x_block.dtype)
+                x_block = np.concatenate([x_block, padding])
+            blocks.append([output[:num_rows] for output in self.predict_on_batch(x_block)])
+        return [np.concatenate([block[k] for block in blocks]) for k in range(len(blocks[0]))]
@@ -0,0 +1,212 @@
+import os
+import json
+import pathlib
+import hashlib
+import threading
+from functools import lru_cache
+import numpy as np
+from featureExtraction import STREAM_MIN_SECONDS
+from quantization import REFINE_PARAMS, calc_tempo, refine_note
+from MIDI import note_to_segment_array
+from metrics import stage
+
+CACHE_VERSION = 1
+# eviction frees space down to this fraction of max_bytes, so a full cache is not scanned on every write
+EVICT_TO = 0.9
+
+
+def audio_digest(audio):
+    """ SHA-256 of the decoded samples, so renamed copies of the same audio share a key
+    ----------
+    Parameters:
+        audio: DecodedAudio
+
+    ----------
+    Returns:
+        digest: hex digest (str)
+    """
+    h = hashlib.sha256()
+    h.update(f"{audio.sr}:{audio.samples.dtype}:".encode())
+    h.update(np.ascontiguousarray(audio.samples).tobytes())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=8)
+def _file_digest(path, size, mtime_ns):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """ SHA-256 of a file, hashed again only when its size or mtime changes """
+    stat = os.stat(path)
+    return _file_digest(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+class TranscriptionCache:
+    """ Transcriptions stored on disk by content, shared by ingestion and the query service
+    ----------
+    Parameters:
+        cache_folder: folder of the cached .npz entries (str)
+        path_weight: model weights the transcriptions come from (str)
+        max_bytes: total size of the entries kept, least recently used go first (int)
+
+    An entry is keyed by the decoded audio, the weight file and REFINE_PARAMS, so
+    a renamed file hits while a changed file, new weights or new refine settings
+    miss. It holds the refined frame-level note track, the tempo and the segments.
+    The total size is tracked in memory from one scan of the folder, which is
+    scanned again, counting the entries other processes wrote, only when that
+    estimate goes over max_bytes.
+    """
+
+    def __init__(self, cache_folder="transcription_cache", path_weight=None, max_bytes=512 * 2 ** 20):
+        if path_weight is None:
+            path_weight = f"{pathlib.Path(__file__).absolute().parent.parent}/data/weight_ST.hdf5"
+        self.cache_folder = cache_folder
+        self.path_weight = path_weight
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # size of the entries as of the last scan plus the writes since, None before the first scan
+        self._bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def key(self, audio):
+        """ Cache key of a DecodedAudio (str) """
+        parts = {
+            "version": CACHE_VERSION,
+            "audio": audio_digest(audio),
+            "weights": file_digest(self.path_weight),
+            "refine": REFINE_PARAMS,
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, f"{key}.npz")
+
+    def get(self, key):
+        """ Cached transcription of a key
+        ----------
+        Parameters:
+            key: as returned by key (str)
+
+        ----------
+        Returns:
+            (note, tempo, segment) or None on a miss
+                note: refined MIDI note per 10ms frame (array)
+                tempo: tempo of the audio (array)
+                segment: [start(s), end(s), pitch] rows (array)
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                result = entry["note"], entry["tempo"], entry["segment"]
+            # the mtime orders the entries for eviction
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key, note, tempo, segment):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, note=note, tempo=tempo, segment=np.asarray(segment).reshape(-1, 3))
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+            over = self._bytes is None or self._bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def entries(self):
+        """ (mtime_ns, size, path) of every entry, oldest first (list) """
+        entries = []
+        for entry in os.scandir(self.cache_folder):
+            if entry.is_file() and entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in EVICT_TO of max_bytes """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= EVICT_TO * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        with self._lock:
+            self._bytes = total
+
+    def stats(self):
+        entries = self.entries()
+        with self._lock:
+            self._bytes = sum(size for _, size, _ in entries)
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def transcribe_audio(ST, model_ST, audio, cache=None):
+    """ Refined note track, tempo and segments of a DecodedAudio, through the cache when given
+    ----------
+    Parameters:
+        ST: SingingTranscription
+        model_ST: loaded transcription model (keras.Model)
+        audio: DecodedAudio
+        cache: TranscriptionCache or None
+
+    ----------
+    Returns:
+        note: refined MIDI note per 10ms frame (array)
+        tempo: tempo of the audio (array)
+        segment: [start(s), end(s), pitch] rows (array)
+    """
+    key = None
+    if cache is not None:
+        with stage("cache_lookup"):
+            key = cache.key(audio)
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    # streaming computes the STFT twice, worth it only when the windows of the whole track are large
+    fl_note = ST.predict_melody(model_ST, audio, stream=audio.duration > STREAM_MIN_SECONDS)
+    with stage("calc_tempo"):
+        tempo = calc_tempo(audio)
+    with stage("refine_note"):
+        note = refine_note(fl_note, tempo)
+    with stage("note_to_segment"):
+        segment = note_to_segment_array(note)
+
+    if key is not None:
+        with stage("cache_write"):
+            cache.put(key, note, tempo, segment)
+    return note, tempo, segment
@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+import threading
+import pytest
+from download_pool import DownloadPool
+
+
+class FakeExtractor:
+    """ Local stand-in for yt_dlp.YoutubeDL: no network, downloads are sleeps that write the MP3
+
+    plan maps a video id to the errors its first attempts raise; attempts and
+    the number of downloads running at the same time are recorded.
+    """
+
+    def __init__(self, titles, duration=0.05, durations=None, plan=None):
+        self.titles = titles
+        self.duration = duration
+        self.durations = durations or {}
+        self.plan = {video_id: list(errors) for video_id, errors in (plan or {}).items()}
+        self.attempts = {}
+        self.finished = {}
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.options = None
+
+    def __call__(self, options):
+        self.options = options
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        return {"entries": [{"id": title, "title": title} for title in self.titles]}
+
+    def prepare_filename(self, entry):
+        folder = os.path.dirname(self.options["outtmpl"])
+        return os.path.join(folder, f"{entry['title']}.webm")
+
+    def process_ie_result(self, entry, download=True):
+        video_id = entry["id"]
+        with self.lock:
+            self.attempts.setdefault(video_id, []).append(time.perf_counter())
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            errors = self.plan.get(video_id)
+            error = errors.pop(0) if errors else None
+        try:
+            time.sleep(self.durations.get(video_id, self.duration))
+            if error is not None:
+                raise Exception(error)
+            with open(self.prepare_filename(entry).replace(".webm", ".mp3"), "wb") as f:
+                f.write(b"mp3")
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.finished[video_id] = time.perf_counter()
+
+
+def run_pool(extractor, tmp_path, **options):
+    pool = DownloadPool(str(tmp_path / "downloads"), ydl_factory=extractor, **options)
+
+    async def consume():
+        return [item async for item in pool.iter_downloads("https://example.invalid/playlist")]
+
+    try:
+        return asyncio.run(consume())
+    finally:
+        pool.close()
+
+
+def test_concurrency_limit_holds(tmp_path):
+    extractor = FakeExtractor([f"song{k}" for k in range(9)])
+    items = run_pool(extractor, tmp_path, concurrency=3)
+
+    assert extractor.max_running == 3
+    assert [item.status for item in items] == ["done"] * 9
+    assert all(os.path.exists(item.file_path) for item in items)
+
+
+def test_failing_entry_backs_off_without_stalling_the_batch(tmp_path):
+    titles = ["flaky"] + [f"song{k}" for k in range(5)]
+    extractor = FakeExtractor(titles, plan={"flaky": ["HTTP Error 503", "HTTP Error 503"]})
+    items = run_pool(extractor, tmp_path, concurrency=2, max_attempts=3, retry_delay=0.2)
+
+    flaky = next(item for item in items if item.video_id == "flaky")
+    assert flaky.status == "done" and flaky.attempts == 3
+    # exponential backoff between the attempts of the flaky entry
+    first, second, third = extractor.attempts["flaky"]
+    assert second - first >= 0.2 and third - second >= 0.4
+    # the other entries used the slot during the backoff and finished before the retries
+    assert items[-1] is flaky
+    assert max(extractor.finished[title] for title in titles[1:]) < second
+
+
+def test_permanent_failures_are_reported_and_unavailable_is_not_retried(tmp_path):
+    titles = ["broken", "gone", "song0", "song1"]
+    plan = {"broken": ["HTTP Error 500"] * 3, "gone": ["Video unavailable"]}
+    extractor = FakeExtractor(titles, plan=plan)
+    items = {item.video_id: item for item in run_pool(extractor, tmp_path, concurrency=2, max_attempts=3,
+                                                      retry_delay=0.01)}
+
+    assert (items["broken"].status, items["broken"].attempts) == ("failed", 3)
+    assert (items["gone"].status, items["gone"].attempts) == ("failed", 1)
+    assert "Video unavailable" in items["gone"].error
+    assert items["song0"].status == items["song1"].status == "done"
+
+
+def test_transcription_starts_before_the_last_download_finishes(tmp_path, monkeypatch):
+    app = pytest.importorskip("app")
+    from transcription_cache import TranscriptionCache
+
+    monkeypatch.chdir(tmp_path)
+    weights = tmp_path / "weights.hdf5"
+    weights.write_bytes(b"weights")
+    monkeypatch.setattr(app, "transcription_cache", TranscriptionCache(str(tmp_path / "cache"), str(weights)))
+    monkeypatch.setattr(app.SingingTranscription, "load_inference_model", lambda self, path_weight: object())
+    started = {}
+
+    def transcribe_to_midi(ST, model_ST, mp3_path, output_folder, cache):
+        started[os.path.basename(mp3_path)] = time.perf_counter()
+        return os.path.join(output_folder, os.path.basename(mp3_path).replace(".mp3", ".mid"))
+
+    monkeypatch.setattr(app, "transcribe_to_midi", transcribe_to_midi)
+    extractor = FakeExtractor(["quick", "slow"], durations={"quick": 0.05, "slow": 0.5})
+    midi_paths = asyncio.run(app.process_youtube_to_midi("https://example.invalid/playlist", "midi", concurrency=2,
+                                                         ydl_factory=extractor))
+
+    assert sorted(os.path.basename(path) for path in midi_paths) == ["quick.mid", "slow.mid"]
+    assert started["quick.mp3"] < extractor.finished["slow"]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from dtw import cost_matrix, subsequence_dtw
+
+
+def reference_dtw(query, database, open_ends=True):
+    """ Cell by cell DTW, with a free start and end in the database when open_ends """
+    costs = cost_matrix(query, database)
+    m, n = costs.shape
+    D = np.full((m, n), np.inf)
+    for i in range(m):
+        for j in range(n):
+            if i == 0:
+                best = 0.0 if open_ends or j == 0 else D[0, j - 1]
+            else:
+                best = min(D[i - 1, j], D[i - 1, j - 1] if j > 0 else np.inf, D[i, j - 1] if j > 0 else np.inf)
+            D[i, j] = costs[i, j] + best
+    return D[-1].min() if open_ends else D[-1, -1]
+
+
+def random_intervals(rng, length):
+    return np.column_stack([rng.uniform(0.1, 1.0, length), rng.integers(-7, 8, length)]).astype(np.float64)
+
+
+@pytest.mark.parametrize("len_query,len_database", [(1, 1), (1, 9), (6, 4), (8, 8), (12, 40), (20, 90)])
+def test_subsequence_dtw_is_exact(len_query, len_database):
+    rng = np.random.default_rng(len_query * 100 + len_database)
+    for _ in range(5):
+        query = random_intervals(rng, len_query)
+        database = random_intervals(rng, len_database)
+        distance, start, end = subsequence_dtw(query, database)
+
+        assert distance == pytest.approx(reference_dtw(query, database))
+        # the reported offsets delimit a part of the song aligned end to end at that cost
+        assert 0 <= start <= end < len_database
+        assert distance == pytest.approx(reference_dtw(query, database[start : end + 1], open_ends=False))
+
+
+def test_embedded_query_is_found_at_its_offset():
+    rng = np.random.default_rng(0)
+    database = random_intervals(rng, 60)
+    distance, start, end = subsequence_dtw(database[23:35], database)
+    assert (distance, start, end) == (0.0, 23, 34)
+
+
+def test_early_abandon_only_drops_matches_above_max_distance():
+    search = pytest.importorskip("search")
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        query = random_intervals(rng, 10)
+        database = random_intervals(rng, 50)
+        costs = cost_matrix(query, database)
+        lb_suffix = search.lb_pairs(costs)
+        distance, start, end = subsequence_dtw(query, database)
+
+        assert lb_suffix[0] <= distance + 1e-9
+        assert subsequence_dtw(query, database, distance, lb_suffix, costs) == (distance, start, end)
+        assert subsequence_dtw(query, database, distance * 0.99, lb_suffix, costs)[0] == float("inf")
+
+
+def test_no_worse_than_the_sliding_fastdtw_loop():
+    matching = pytest.importorskip("matching")
+    rng = np.random.default_rng(2)
+    for _ in range(5):
+        query = random_intervals(rng, 8)
+        database = random_intervals(rng, 30)
+        assert subsequence_dtw(query, database)[0] <= matching.sliding_fastdtw(query, database)[0] + 1e-9
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import numpy as np
+from inference_scheduler import InferenceScheduler
+from metrics import metrics
+
+
+class BlockingModel:
+    """ Stand-in model: echoes the first feature of each window, the first call waits for release """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.batch_sizes = []
+
+    def predict_on_batch(self, x):
+        if not self.batch_sizes:
+            self.release.wait(5)
+        self.batch_sizes.append(len(x))
+        return [x[:, 0, 0, 0], x[:, 0, 0, 0] * 2]
+
+
+def gauge(name):
+    for line in metrics.render().splitlines():
+        if line.startswith(f"hum2song_{name} "):
+            return float(line.split()[1])
+
+
+def test_queue_depth_counts_windows_and_is_exported():
+    model = BlockingModel()
+
+    async def run():
+        scheduler = InferenceScheduler(model, max_batch_size=4, max_wait=0.01)
+        await scheduler.start()
+        requests = [np.full((n, 31, 513, 1), k, dtype=np.float32) for k, n in enumerate((3, 6, 1))]
+        first = asyncio.ensure_future(scheduler.predict(requests[0]))
+        await asyncio.sleep(0.05)
+        # the first batch holds the model, the other requests wait: 6 + 1 windows in 3 chunks
+        others = [asyncio.ensure_future(scheduler.predict(x)) for x in requests[1:]]
+        await asyncio.sleep(0.05)
+        waiting = (scheduler.stats(), gauge("inference_queue_windows"))
+        model.release.set()
+        outputs = await asyncio.gather(first, *others)
+        done = (scheduler.stats(), gauge("inference_queue_windows"), gauge("inference_batch_fill_rate"))
+        await scheduler.stop()
+        return requests, outputs, waiting, done
+
+    requests, outputs, (stats, exported), (final, exported_after, fill_rate) = asyncio.run(run())
+
+    assert stats["queue_windows"] == exported == 7
+    assert final["queue_windows"] == exported_after == 0
+    assert fill_rate == final["batch_fill_rate"] == sum(model.batch_sizes) / (4 * len(model.batch_sizes))
+    for x, y_predict in zip(requests, outputs):
+        np.testing.assert_array_equal(y_predict[0], x[:, 0, 0, 0])
+        np.testing.assert_array_equal(y_predict[1], x[:, 0, 0, 0] * 2)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+search = pytest.importorskip("search")
+bench_search = pytest.importorskip("bench_search")
+from dtw import subsequence_dtw
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return bench_search.synthetic_catalog(150, mean_notes=120)
+
+
+def queries(catalog, count, seed=3):
+    rng = np.random.default_rng(seed)
+    return [bench_search.hum_query(catalog, rng, 12)[0] for _ in range(count)]
+
+
+def exhaustive(query, catalog):
+    """ (distance, song index) of every song, scored without any bound """
+    int_query = np.diff(query, axis=0)
+    scores = [(subsequence_dtw(int_query, np.diff(catalog.notes(idx), axis=0))[0], idx) for idx in range(len(catalog))]
+    return sorted(scores)
+
+
+def pruned_songs(stats):
+    return stats["lb_kim"] + stats["lb_keogh"] + stats["lb_pairs"] + stats["early_abandon"]
+
+
+def test_pruned_top_k_equals_the_exhaustive_top_k(catalog):
+    for query in queries(catalog, 4):
+        expected = exhaustive(query, catalog)
+        hits, stats = search.search_catalog(query, catalog, top_k=5)
+
+        assert [idx for _, idx, _, _ in hits] == [idx for _, idx in expected[:5]]
+        assert [distance for distance, _, _, _ in hits] == pytest.approx([distance for distance, _ in expected[:5]])
+        # every song is accounted for by exactly one stage
+        assert stats["too_short"] + pruned_songs(stats) + stats["dtw"] == stats["songs"] == len(catalog)
+
+
+def test_max_distance_keeps_exactly_the_songs_below_it(catalog):
+    for query in queries(catalog, 4, seed=4):
+        expected = exhaustive(query, catalog)
+        max_distance = 1.5 * expected[0][0] + 1.0
+        hits, _ = search.search_catalog(query, catalog, top_k=20, max_distance=max_distance)
+
+        assert [idx for _, idx, _, _ in hits] == [idx for distance, idx in expected[:20] if distance <= max_distance]
+
+
+def test_the_bounds_skip_most_songs(catalog):
+    totals = {}
+    for query in queries(catalog, 4):
+        _, stats = search.search_catalog(query, catalog, top_k=5)
+        # most songs are dropped before a full DTW, and not only by abandoning it
+        assert stats["dtw"] < stats["songs"] / 4
+        assert stats["lb_pairs"] > 0
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    for query in queries(catalog, 4, seed=4):
+        _, stats = search.search_catalog(query, catalog, top_k=5, max_distance=1.5 * exhaustive(query, catalog)[0][0])
+        for key in ("lb_kim", "lb_keogh"):
+            totals[key] += stats[key]
+    # with a tight threshold the cheap bounds fire before any cost matrix is built
+    assert totals["lb_keogh"] > 0 and totals["lb_kim"] > 0
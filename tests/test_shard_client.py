@@ -0,0 +1,121 @@
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import shard_client
+from shard_client import search_shards
+
+
+class StandInShard:
+    """ Local stand-in for shard_server.py: answers /search with fixed hits after a delay
+
+    trickle sends the body a byte at a time over that many seconds once the
+    headers are out, like a shard stalling halfway through its answer.
+    """
+
+    def __init__(self, name, delay=0.0, trickle=0.0):
+        shard = self
+        self.name = name
+        self.delay = delay
+        self.trickle = trickle
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                shard.requests.append(request)
+                time.sleep(shard.delay)
+                results = [{"file": f"{shard.name}_{k}.mid", "distance": float(k) + len(shard.name) / 10}
+                           for k in range(request["top_k"])]
+                body = json.dumps({"shard": shard.name, "results": results, "stats": {"dtw": len(results)}})
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if shard.trickle:
+                    for k in range(len(body)):
+                        self.wfile.write(body[k : k + 1].encode())
+                        self.wfile.flush()
+                        time.sleep(shard.trickle / len(body))
+                else:
+                    self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def shards():
+    started = []
+
+    def start(*specs):
+        started.extend(StandInShard(name, **options) for name, options in specs)
+        return started
+
+    yield start
+    for shard in started:
+        shard.close()
+
+
+def test_concurrent_queries_do_not_time_out_healthy_shards(shards, monkeypatch):
+    # fewer threads than requests: queued requests must not be charged for the wait
+    monkeypatch.setattr(shard_client, "MAX_CONCURRENT_QUERIES", 2)
+    monkeypatch.setattr(shard_client, "_executor", None)
+    servers = shards(("a", {"delay": 0.3}), ("b", {"delay": 0.3}), ("c", {"delay": 0.3}))
+    urls = [server.url for server in servers]
+
+    with ThreadPoolExecutor(max_workers=6) as queries:
+        answers = list(queries.map(lambda k: search_shards([[0.0, 60.0]], urls, top_k=2, timeout=0.8), range(6)))
+
+    for results, stats in answers:
+        assert not stats["partial"] and stats["shards"]["answered"] == 3
+        assert [hit["file"] for hit in results] == ["a_0.mid", "b_0.mid"]
+        assert stats["dtw"] == 6
+    assert all(len(server.requests) == 6 for server in servers)
+
+
+def test_slow_shard_is_left_out(shards):
+    servers = shards(("a", {}), ("b", {"delay": 3.0}))
+    start = time.perf_counter()
+    results, stats = search_shards([[0.0, 60.0]], [server.url for server in servers], top_k=3, timeout=0.5)
+
+    assert time.perf_counter() - start < 1.5
+    assert stats["partial"] and stats["shards"]["answered"] == 1
+    assert list(stats["shards"]["failed"]) == [servers[1].url]
+    assert [hit["file"] for hit in results] == ["a_0.mid", "a_1.mid", "a_2.mid"]
+
+
+def test_timeout_bounds_the_whole_answer_not_each_read(shards):
+    servers = shards(("a", {}), ("b", {"trickle": 3.0}))
+    start = time.perf_counter()
+    _, stats = search_shards([[0.0, 60.0]], [server.url for server in servers], timeout=0.5)
+
+    assert time.perf_counter() - start < 1.5
+    assert stats["shards"]["answered"] == 1
+    assert "timed out" in stats["shards"]["failed"][servers[1].url]
+    # the request itself gives up, instead of holding a fan-out thread until the shard is done
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        shard_client.post_json(servers[1].url + "/search", {"top_k": 10}, 0.5)
+    assert time.perf_counter() - start < 1.5
+
+
+def test_unreachable_shard_is_reported(shards):
+    servers = shards(("a", {}))
+    down = StandInShard("down")
+    down.close()
+    _, stats = search_shards([[0.0, 60.0]], [servers[0].url, down.url], timeout=0.5)
+
+    assert stats["partial"] and stats["shards"]["answered"] == 1
+    assert down.url in stats["shards"]["failed"]